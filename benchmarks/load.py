@@ -0,0 +1,389 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2017 Luis López <luis@cuarentaydos.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
+# USA.
+
+
+
+# Load test of every storage backend, both through the HTTP API (served by
+# a threaded wsgiref server, driven by the async Client) and directly
+# against the storage. Reports ops/s and p50/p99 latencies per operation as
+# JSON, so runs of different commits can be compared. Workloads are seeded
+# and therefore repeatable.
+#
+#   PYTHONPATH=. python benchmarks/load.py --backends memory sqlalchemy \
+#       --concurrency 16 --keys 1000 --value-size 256 --read-ratio 0.9 \
+#       --attachment-ratio 0.05 --output results.json
+
+
+import grandcentral
+import grandcentral.logstorage
+import grandcentral.ringstorage
+import grandcentral.storage
+from grandcentral import client
+
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import socketserver
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import wsgiref.simple_server
+
+
+try:
+    import grandcentral.shardedstorage
+    import grandcentral.sqlalchemystorage
+except ImportError:
+    grandcentral.sqlalchemystorage = None
+
+
+def _memory(tmpdir):
+    return grandcentral.storage.MemoryStorage()
+
+
+def _ring(tmpdir):
+    return grandcentral.ringstorage.RingStorage()
+
+
+def _log(tmpdir):
+    return grandcentral.logstorage.LogStorage(tmpdir + '/')
+
+
+def _sqlalchemy(tmpdir):
+    return grandcentral.sqlalchemystorage.SQLAlchemyStorage(
+        storage_path=tmpdir + '/')
+
+
+def _sharded(tmpdir):
+    return grandcentral.shardedstorage.ShardedStorage(
+        storage_path=tmpdir + '/', shards=4)
+
+
+BACKENDS = {
+    'memory': _memory,
+    'ring': _ring,
+    'log': _log,
+}
+if grandcentral.sqlalchemystorage is not None:
+    BACKENDS['sqlalchemy'] = _sqlalchemy
+    BACKENDS['sharded'] = _sharded
+
+# The rest raise NotImplementedError on attachments, they run without them
+ATTACHMENT_BACKENDS = ('sqlalchemy', 'sharded')
+
+
+class _QuietHandler(wsgiref.simple_server.WSGIRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+class _ThreadingWSGIServer(socketserver.ThreadingMixIn,
+                           wsgiref.simple_server.WSGIServer):
+    daemon_threads = True
+
+
+def percentile(sorted_values, p):
+    # Nearest rank
+    if not sorted_values:
+        return None
+
+    idx = max(int(round(p / 100 * len(sorted_values))) - 1, 0)
+    return sorted_values[min(idx, len(sorted_values) - 1)]
+
+
+def summarize(latencies, elapsed=None):
+    # {op: [seconds]} -> {op: stats}, plus an 'all' entry. Rates are over
+    # elapsed wall time if given (concurrent runs), over the time spent in
+    # each operation otherwise
+    latencies = dict(latencies)
+    latencies['all'] = [x for values in latencies.values() for x in values]
+
+    ret = {}
+    for (op, values) in latencies.items():
+        values = sorted(values)
+        spent = elapsed if elapsed is not None else sum(values)
+        ret[op] = {
+            'ops': len(values),
+            'ops_per_sec': len(values) / spent if spent else None,
+            'p50_ms': _ms(percentile(values, 50)),
+            'p99_ms': _ms(percentile(values, 99)),
+            'max_ms': _ms(values[-1] if values else None),
+        }
+
+    return ret
+
+
+def _ms(seconds):
+    return None if seconds is None else seconds * 1000
+
+
+class Workload:
+    def __init__(self, keys, value_size, read_ratio, attachment_ratio,
+                 attachment_size, seed=0):
+        self.keys = ['key-{}'.format(x) for x in range(keys)]
+        self.value = 'x' * value_size
+        self.read_ratio = read_ratio
+        self.attachment_ratio = attachment_ratio
+        self.attachment = random.Random(seed).getrandbits(
+            attachment_size * 8).to_bytes(attachment_size, 'little')
+        self.seed = seed
+
+    def operations(self, n, worker=0):
+        # Yields (op, key, attachment) tuples, same sequence for same seed
+        rnd = random.Random('{}-{}'.format(self.seed, worker))
+        for x in range(n):
+            key = rnd.choice(self.keys)
+            if rnd.random() < self.read_ratio:
+                yield ('read', key, None)
+            elif rnd.random() < self.attachment_ratio:
+                # Unique content, dedup would skip the write otherwise
+                yield ('write_attachment', key,
+                       struct.pack('<Qd', x, rnd.random()) + self.attachment)
+            else:
+                yield ('write', key, None)
+
+
+def run_http(storage, workload, ops, concurrency, read_cache_size=0,
+             accept_encoding='identity'):
+    app = grandcentral.API(storage, metrics=False)
+    server = wsgiref.simple_server.make_server(
+        '127.0.0.1', 0, app,
+        server_class=_ThreadingWSGIServer,
+        handler_class=_QuietHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    url = 'http://127.0.0.1:{}/'.format(server.server_address[1])
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(
+            _run_http(url, workload, ops, concurrency, read_cache_size,
+                      accept_encoding))
+    finally:
+        loop.close()
+        server.shutdown()
+        server.server_close()
+        thread.join()
+
+
+async def _run_http(url, workload, ops, concurrency, read_cache_size,
+                    accept_encoding):
+    latencies = {}
+
+    # With a read cache, repeated reads are mostly 304 revalidations.
+    # aiohttp asks for gzip unless told otherwise, which compresses values
+    # over 1K
+    async with client.Client(url, limit_per_host=concurrency,
+                             read_cache_size=read_cache_size) as c:
+        c.session.headers['Accept-Encoding'] = accept_encoding
+
+        async def _worker(idx):
+            n = ops // concurrency + (idx < ops % concurrency)
+            for (op, key, attachment) in workload.operations(n, idx):
+                t0 = time.perf_counter()
+                if op == 'read':
+                    await c.read(key)
+                else:
+                    await c.write(key, workload.value, attachment)
+                latencies.setdefault(op, []).append(time.perf_counter() - t0)
+
+        t0 = time.perf_counter()
+        await asyncio.gather(*[_worker(x) for x in range(concurrency)])
+        elapsed = time.perf_counter() - t0
+
+    return summarize(latencies, elapsed)
+
+
+def run_storage(storage, workload, ops, batch_size):
+    # Single thread, no HTTP
+    latencies = {}
+
+    def _timed(op, fn, *args):
+        t0 = time.perf_counter()
+        ret = fn(*args)
+        latencies.setdefault(op, []).append(time.perf_counter() - t0)
+        return ret
+
+    for (op, key, attachment) in workload.operations(ops):
+        if op == 'read':
+            _timed('read', storage.read, key)
+        elif attachment is not None:
+            _timed('write_attachment', storage.write, key, workload.value,
+                   attachment)
+        else:
+            _timed('write', storage.write, key, workload.value)
+
+    for key in workload.keys[:ops // 10 or 1]:
+        _timed('backlog', lambda: list(storage.backlog(key, limit=100)))
+
+    messages = [(key, workload.value) for (op, key, attachment)
+                in workload.operations(ops)]
+    for idx in range(0, len(messages), batch_size):
+        _timed('write_many', storage.write_many,
+               messages[idx:idx + batch_size])
+
+    ret = summarize(latencies)
+    # Batches count as one operation above, report rows too
+    ret['write_many']['rows_per_sec'] = (
+        len(messages) / sum(latencies['write_many']))
+    return ret
+
+
+def _git_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--backends',
+        nargs='+',
+        choices=sorted(BACKENDS),
+        default=sorted(BACKENDS),
+        help='Storage backends to run')
+    parser.add_argument(
+        '--ops',
+        type=int,
+        default=5000,
+        help='Operations per run')
+    parser.add_argument(
+        '--concurrency',
+        type=int,
+        default=8,
+        help='Concurrent HTTP clients')
+    parser.add_argument(
+        '--keys',
+        type=int,
+        default=1000,
+        help='Number of distinct keys')
+    parser.add_argument(
+        '--value-size',
+        type=int,
+        default=100,
+        help='Size of values, in characters')
+    parser.add_argument(
+        '--read-ratio',
+        type=float,
+        default=0.8,
+        help='Fraction of operations that are reads')
+    parser.add_argument(
+        '--attachment-ratio',
+        type=float,
+        default=0.0,
+        help='Fraction of writes carrying an attachment')
+    parser.add_argument(
+        '--attachment-size',
+        type=int,
+        default=64 * 1024,
+        help='Size of attachments, in bytes')
+    parser.add_argument(
+        '--batch-size',
+        type=int,
+        default=100,
+        help='Messages per write_many() in storage runs')
+    parser.add_argument(
+        '--seed',
+        type=int,
+        default=0,
+        help='Workload seed')
+    parser.add_argument(
+        '--client-read-cache',
+        type=int,
+        default=0,
+        help='Size of the HTTP client read cache, 0 disables it')
+    parser.add_argument(
+        '--accept-encoding',
+        default='identity',
+        help='Accept-Encoding of HTTP requests')
+    parser.add_argument(
+        '--skip-http',
+        action='store_true',
+        help='Only run the storage benchmarks')
+    parser.add_argument(
+        '--output',
+        help='Write JSON results here instead of stdout')
+
+    args = parser.parse_args(sys.argv[1:])
+
+    results = {
+        'revision': _git_revision(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'time': time.time(),
+        'parameters': vars(args),
+        'backends': {},
+    }
+
+    for name in args.backends:
+        attachment_ratio = (args.attachment_ratio
+                            if name in ATTACHMENT_BACKENDS else 0.0)
+        workload = Workload(
+            args.keys, args.value_size, args.read_ratio, attachment_ratio,
+            args.attachment_size, seed=args.seed)
+
+        ret = results['backends'][name] = {
+            'attachment_ratio': attachment_ratio
+        }
+        print('{}...'.format(name), file=sys.stderr)
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            storage = BACKENDS[name](tmpdir)
+            # Reads of missing keys would be measuring 404s
+            storage.write_many([(key, workload.value)
+                                for key in workload.keys])
+            ret['storage'] = run_storage(
+                storage, workload, args.ops, args.batch_size)
+            storage.close()
+
+        if args.skip_http:
+            continue
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            storage = BACKENDS[name](tmpdir)
+            storage.write_many([(key, workload.value)
+                                for key in workload.keys])
+            ret['http'] = run_http(
+                storage, workload, args.ops, args.concurrency,
+                read_cache_size=args.client_read_cache,
+                accept_encoding=args.accept_encoding)
+            storage.close()
+
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as fh:
+            fh.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2017 Luis López <luis@cuarentaydos.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
+# USA.
+
+
+# Write and read throughput of LogStorage against SQLAlchemyStorage under
+# the same workload: single writes, batched writes, latest-value reads and
+# backlog pages over a set of keys.
+#
+#   PYTHONPATH=. python benchmarks/log_vs_sqlite.py --records 20000 --keys 100
+
+
+import grandcentral.logstorage
+import grandcentral.sqlalchemystorage
+
+
+import argparse
+import random
+import sys
+import tempfile
+import time
+
+
+def _rate(n, fn):
+    t0 = time.perf_counter()
+    fn()
+    return n / (time.perf_counter() - t0)
+
+
+def run(storage, keys, n_records, batch_size, value_size):
+    rnd = random.Random(0)
+    value = 'x' * value_size
+    messages = [(rnd.choice(keys), value) for x in range(n_records)]
+    reads = [rnd.choice(keys) for x in range(n_records)]
+
+    def _writes():
+        for (key, value) in messages:
+            storage.write(key, value)
+
+    def _batched_writes():
+        for idx in range(0, len(messages), batch_size):
+            storage.write_many(messages[idx:idx + batch_size])
+
+    def _reads():
+        for key in reads:
+            storage.read(key)
+
+    def _backlogs():
+        for key in reads:
+            list(storage.backlog(key, limit=10))
+
+    return (
+        _rate(len(messages), _writes),
+        _rate(len(messages), _batched_writes),
+        _rate(len(reads), _reads),
+        _rate(len(reads), _backlogs))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--records',
+        type=int,
+        default=20000,
+        help='Records written (and reads done) per phase')
+    parser.add_argument(
+        '--keys',
+        type=int,
+        default=100,
+        help='Number of distinct keys')
+    parser.add_argument(
+        '--batch-size',
+        type=int,
+        default=500,
+        help='Records per write_many call')
+    parser.add_argument(
+        '--value-size',
+        type=int,
+        default=100,
+        help='Length of the stored string values')
+
+    args = parser.parse_args(sys.argv[1:])
+
+    keys = ['key-{}'.format(x) for x in range(args.keys)]
+    backends = [
+        ('log', lambda tmpdir: grandcentral.logstorage.LogStorage(
+            storage_path=tmpdir)),
+        # No LRU so reads hit SQLite as they hit the log
+        ('sqlalchemy', lambda tmpdir:
+            grandcentral.sqlalchemystorage.SQLAlchemyStorage(
+                storage_path=tmpdir + '/', cache_size=0))
+    ]
+
+    print('backend     writes/s  batched/s  reads/s  backlogs/s')
+    for (name, factory) in backends:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            storage = factory(tmpdir)
+            try:
+                rates = run(storage, keys, args.records, args.batch_size,
+                            args.value_size)
+            finally:
+                storage.close()
+
+        print('{:10s}  {:8.0f}  {:9.0f}  {:7.0f}  {:10.0f}'.format(
+            name, *rates))
+
+
+if __name__ == '__main__':
+    main()
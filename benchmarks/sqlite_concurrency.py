@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2017 Luis López <luis@cuarentaydos.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
+# USA.
+
+
+
+# Read throughput of SQLAlchemyStorage as reader threads are added while a
+# writer keeps committing. The LRU is disabled so every read hits SQLite.
+#
+#   PYTHONPATH=. python benchmarks/sqlite_concurrency.py --threads 1 2 4 8
+
+
+import grandcentral.sqlalchemystorage
+
+
+import argparse
+import random
+import sys
+import tempfile
+import threading
+import time
+
+
+def run(storage, n_threads, keys, duration):
+    stop = threading.Event()
+    counts = [0] * n_threads
+    writes = [0]
+
+    def _reader(idx):
+        rnd = random.Random(idx)
+        while not stop.is_set():
+            storage.read(rnd.choice(keys))
+            counts[idx] += 1
+
+    def _writer():
+        rnd = random.Random()
+        while not stop.is_set():
+            storage.write(rnd.choice(keys), rnd.random())
+            writes[0] += 1
+
+    threads = [threading.Thread(target=_reader, args=(idx,))
+               for idx in range(n_threads)]
+    threads.append(threading.Thread(target=_writer))
+
+    for t in threads:
+        t.start()
+    time.sleep(duration)
+    stop.set()
+    for t in threads:
+        t.join()
+
+    return sum(counts) / duration, writes[0] / duration
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--threads',
+        type=int,
+        nargs='+',
+        default=[1, 2, 4, 8],
+        help='Reader thread counts to try')
+    parser.add_argument(
+        '--keys',
+        type=int,
+        default=1000,
+        help='Number of distinct keys')
+    parser.add_argument(
+        '--duration',
+        type=float,
+        default=5,
+        help='Seconds per run')
+    parser.add_argument(
+        '--synchronous',
+        default='NORMAL',
+        help='SQLite synchronous pragma')
+
+    args = parser.parse_args(sys.argv[1:])
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        storage = grandcentral.sqlalchemystorage.SQLAlchemyStorage(
+            storage_path=tmpdir + '/',
+            cache_size=0,
+            pool_size=max(args.threads) + 1,
+            synchronous=args.synchronous)
+
+        keys = ['key-{}'.format(x) for x in range(args.keys)]
+        storage.write_many([(key, 0) for key in keys])
+
+        print('threads  reads/s  writes/s')
+        for n in args.threads:
+            reads, writes = run(storage, n, keys, args.duration)
+            print('{:7d}  {:7.0f}  {:8.0f}'.format(n, reads, writes))
+
+
+if __name__ == '__main__':
+    main()
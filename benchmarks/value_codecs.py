@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2017 Luis López <luis@cuarentaydos.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
+# USA.
+
+
+# CPU time per GET /message/{key} and GET /message/{key}/backlog with large
+# values, for each storage codec and response format. "decoded" is the old
+# path (decode the stored value, encode the response) kept as a reference.
+#
+#   PYTHONPATH=. python benchmarks/value_codecs.py --value-size 100000
+
+
+import grandcentral
+import grandcentral.codecs
+import grandcentral.sqlalchemystorage
+
+
+import argparse
+import json
+import sys
+import tempfile
+import time
+
+
+import falcon.testing
+
+
+ACCEPT = {
+    'json': 'application/json',
+    'msgpack': 'application/msgpack'
+}
+
+
+def _value(size):
+    # A list of small records, which is what large values tend to be
+    n = max(size // 40, 1)
+    return [{'id': x, 'name': 'item-{}'.format(x), 'score': x * 0.5}
+            for x in range(n)]
+
+
+def _cpu_per_call(n, fn):
+    t0 = time.process_time()
+    for dummy in range(n):
+        fn()
+    return (time.process_time() - t0) / n
+
+
+def run(storage, requests):
+    client = falcon.testing.TestClient(grandcentral.API(storage))
+    results = {}
+
+    for (fmt, accept) in ACCEPT.items():
+        if grandcentral.codecs.CONTENT_TYPES.get(accept) is None:
+            continue
+
+        headers = {'Accept': accept}
+        results[fmt] = (
+            _cpu_per_call(requests, lambda: client.simulate_get(
+                '/message/key', headers=headers)),
+            _cpu_per_call(requests, lambda: client.simulate_get(
+                '/message/key/backlog',
+                query_string='limit=10', headers=headers)))
+
+    def _decoded_read():
+        json.dumps({'key': 'key', 'value': storage.read('key')})
+
+    def _decoded_backlog():
+        json.dumps([
+            {'timestamp': ts, 'message': {'key': 'key', 'value': value}}
+            for (ts, value) in storage.backlog('key', limit=10)])
+
+    results['decoded'] = (
+        _cpu_per_call(requests, _decoded_read),
+        _cpu_per_call(requests, _decoded_backlog))
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--value-size',
+        type=int,
+        default=100000,
+        help='Approximate size of each value in bytes')
+    parser.add_argument(
+        '--requests',
+        type=int,
+        default=200,
+        help='Requests per measurement')
+
+    args = parser.parse_args(sys.argv[1:])
+
+    value = _value(args.value_size)
+
+    print('storage  response  read (ms CPU)  backlog (ms CPU)')
+    for codec in grandcentral.codecs.CODECS:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            # No LRU, every request reads from SQLite
+            storage = grandcentral.sqlalchemystorage.SQLAlchemyStorage(
+                storage_path=tmpdir + '/', cache_size=0, codec=codec)
+            storage.write_many([('key', value)] * 10)
+
+            for (fmt, (read, backlog)) in run(storage, args.requests).items():
+                print('{:7s}  {:8s}  {:13.3f}  {:16.3f}'.format(
+                    codec, fmt, read * 1000, backlog * 1000))
+
+            storage.close()
+
+
+if __name__ == '__main__':
+    main()
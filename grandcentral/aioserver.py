@@ -0,0 +1,610 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2017 Luis López <luis@cuarentaydos.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
+# USA.
+
+
+
+import grandcentral.asyncstorage
+import grandcentral.series
+import grandcentral.storage
+
+
+import asyncio
+import email.utils
+import json
+import math
+import tempfile
+
+
+from aiohttp import web
+
+
+class AsyncAPI:
+    # The /message routes of grandcentral.api.API served from an asyncio
+    # event loop. Only a subset of the WSGI API: responses are always JSON
+    # (no msgpack negotiation), bodies are never compressed, and the
+    # replication, export/import, chunk upload and metrics routes in
+    # UNSUPPORTED_ROUTES answer 501
+    UNSUPPORTED_ROUTES = (
+        '/changes',
+        '/export',
+        '/import',
+        '/attachment/{digest}',
+        '/chunks/missing',
+        '/chunks/{digest}',
+        '/metrics',
+    )
+
+    MAX_BACKLOG_LIMIT = 1000
+    DEFAULT_WATCH_TIMEOUT = 30
+    MAX_WATCH_TIMEOUT = 300
+    HEARTBEAT_INTERVAL = 15
+    CHUNK_SIZE = 64 * 1024
+    DEFAULT_SERIES_BUCKET = 60
+    MAX_READ_KEYS = 1000
+
+    def __init__(self, storage, max_messages=100, max_workers=8):
+        if isinstance(storage, grandcentral.storage.BaseStorage):
+            storage = grandcentral.asyncstorage.ThreadPoolStorage(
+                storage, max_workers=max_workers)
+
+        if not isinstance(storage, grandcentral.asyncstorage.AsyncBaseStorage):
+            raise TypeError(storage)
+
+        self.storage = storage
+        self.limit = max_messages
+        self.series_cache = grandcentral.series.SeriesCache(storage.signaler)
+
+        self.app = web.Application()
+        self.app.router.add_get('/message', self.get_messages)
+        self.app.router.add_post('/message', self.post_message)
+        self.app.router.add_post('/message/batch', self.post_batch)
+        self.app.router.add_post(
+            '/message/batch/read', self.post_batch_read)
+        self.app.router.add_get('/message/{key}', self.get_message)
+        self.app.router.add_get('/message/{key}/backlog', self.get_backlog)
+        self.app.router.add_get(
+            '/message/{key}/attachment', self.get_attachment)
+        self.app.router.add_get('/message/{key}/range', self.get_range)
+        self.app.router.add_get('/message/{key}/series', self.get_series)
+        self.app.router.add_get('/message/{key}/watch', self.get_watch)
+
+        for path in self.UNSUPPORTED_ROUTES:
+            self.app.router.add_route('*', path, self.not_implemented)
+
+    async def not_implemented(self, request):
+        return web.json_response({
+            'title': 'Not implemented',
+            'description': 'not served by the asyncio server, use '
+                           'grandcentral.server'
+        }, status=501)
+
+    async def post_message(self, request):
+        attachment = None
+
+        if request.content_type in ['multipart/form-data', 'multipart/mixed']:
+            message = None
+            reader = await request.multipart()
+
+            while True:
+                part = await reader.next()
+                if part is None:
+                    break
+
+                if part.name == 'message':
+                    message = _loads(await part.text())
+
+                elif part.name == 'attachment':
+                    attachment = await self._spool(part)
+
+            # Message not found in request
+            if message is None:
+                raise web.HTTPBadRequest(text='Missing message')
+
+        elif request.content_type == 'application/json':
+            message = _loads(await request.text())
+
+        else:
+            raise web.HTTPBadRequest(text='Unknow request')
+
+        try:
+            key = message['key']
+            value = message['value']
+        except (KeyError, TypeError) as e:
+            raise web.HTTPBadRequest(text='Malformed message') from e
+
+        try:
+            await self.storage.write(key, value, attachment)
+        finally:
+            if attachment is not None:
+                attachment.close()
+
+        return web.Response(status=204)
+
+    async def _spool(self, part):
+        # Uploads are copied in chunks to a (spooled) temporary file so
+        # memory stays bounded whatever the attachment size
+        fh = tempfile.SpooledTemporaryFile(max_size=1024 * 1024)
+        while True:
+            chunk = await part.read_chunk(self.CHUNK_SIZE)
+            if not chunk:
+                break
+
+            fh.write(chunk)
+
+        fh.seek(0)
+        return fh
+
+    async def post_batch(self, request):
+        body = await request.text()
+
+        if request.content_type == 'application/json':
+            messages = _loads(body)
+
+        elif request.content_type in ['application/x-ndjson',
+                                      'application/ndjson']:
+            messages = [_loads(line) for line in body.splitlines()
+                        if line.strip()]
+
+        else:
+            raise web.HTTPBadRequest(text='Unknow request')
+
+        if not isinstance(messages, list):
+            raise web.HTTPBadRequest(text='Malformed message')
+
+        try:
+            messages = [(msg['key'], msg['value']) for msg in messages]
+        except (KeyError, TypeError) as e:
+            raise web.HTTPBadRequest(text='Malformed message') from e
+
+        await self.storage.write_many(messages)
+        return web.Response(status=204)
+
+    async def get_messages(self, request):
+        keys = request.query.get('keys')
+        if keys is None:
+            raise web.HTTPBadRequest(text='keys is required')
+
+        return await self._read_many(keys.split(','))
+
+    async def post_batch_read(self, request):
+        doc = _loads(await request.text())
+        try:
+            keys = doc['keys']
+        except (KeyError, TypeError) as e:
+            raise web.HTTPBadRequest(text='Malformed request') from e
+
+        if not isinstance(keys, list):
+            raise web.HTTPBadRequest(text='keys must be a list')
+
+        return await self._read_many(keys)
+
+    async def _read_many(self, keys):
+        if not all(isinstance(key, str) for key in keys):
+            raise web.HTTPBadRequest(text='keys must be strings')
+
+        keys = list(dict.fromkeys(keys))
+        if not 0 < len(keys) <= self.MAX_READ_KEYS:
+            raise web.HTTPBadRequest(
+                text='between 1 and {} keys are required'.format(
+                    self.MAX_READ_KEYS))
+
+        found = await self.storage.read_many(keys)
+        return web.json_response({
+            'messages': [
+                {'key': key, 'value': found[key]}
+                for key in keys if key in found
+            ],
+            'missing': [key for key in keys if key not in found]
+        })
+
+    async def get_message(self, request):
+        key = request.match_info['key']
+
+        try:
+            headers, fresh = await self._validators(request, key)
+            if fresh:
+                return web.Response(status=304, headers=headers)
+
+            value = await self.storage.read(key)
+        except KeyError:
+            return web.json_response({'key': key}, status=404)
+
+        return web.json_response({
+            'key': key,
+            'value': value
+        }, headers=headers)
+
+    async def _validators(self, request, key, backlog=False):
+        # (ETag and Last-Modified headers, whether the client's copy is
+        # fresh), derived from the latest record of key. Responses are
+        # always JSON here. Backlogs are validated as in the WSGI API: by
+        # ETag only, covering the oldest record and the record count too
+        if backlog:
+            (oldest, ts, count) = await self.storage.backlog_summary(key)
+            etag = '{}-{}-{}-json'.format(repr(ts), repr(oldest), count)
+            headers = {'ETag': '"{}"'.format(etag)}
+        else:
+            ts = await self.storage.latest_timestamp(key)
+            etag = '{}-json'.format(repr(ts))
+            headers = {
+                'ETag': '"{}"'.format(etag),
+                'Last-Modified': email.utils.formatdate(int(ts), usegmt=True)
+            }
+
+        if_none_match = request.headers.get('If-None-Match')
+        if if_none_match is not None:
+            candidates = [_unquote_etag(x) for x in if_none_match.split(',')]
+            return headers, '*' in candidates or etag in candidates
+
+        if request.if_modified_since is not None and not backlog:
+            since = request.if_modified_since.timestamp()
+            return headers, int(ts) <= since
+
+        return headers, False
+
+    async def get_backlog(self, request):
+        key = request.match_info['key']
+
+        limit = _get_param_as(request, 'limit', int)
+        if limit is None:
+            limit = self.limit
+        elif not 0 < limit <= self.MAX_BACKLOG_LIMIT:
+            raise web.HTTPBadRequest(
+                text='limit must be between 1 and {}'.format(
+                    self.MAX_BACKLOG_LIMIT))
+
+        before = _get_param_as(request, 'before', float)
+        after = _get_param_as(request, 'after', float)
+
+        # Ask for one extra row to know if there is a next page
+        try:
+            headers, fresh = await self._validators(
+                request, key, backlog=True)
+            if fresh:
+                return web.Response(status=304, headers=headers)
+
+            rows = await self.storage.backlog(
+                key, limit=limit + 1, before=before, after=after)
+        except KeyError:
+            return web.json_response({'key': key}, status=404)
+
+        if len(rows) > limit:
+            rows = rows[:limit]
+            query = {'before': repr(rows[-1][0]), 'limit': limit}
+            if after is not None:
+                query['after'] = repr(after)
+
+            headers['Link'] = '<{}>; rel=next'.format(
+                request.rel_url.with_query(query))
+
+        return web.json_response(
+            [_change_doc(key, ts, value) for (ts, value) in rows],
+            headers=headers)
+
+    async def get_range(self, request):
+        key = request.match_info['key']
+        start = _get_param_as(request, 'from', float)
+        end = _get_param_as(request, 'to', float)
+
+        rows = self.storage.range(key, start=start, end=end)
+
+        # Pull the first row before streaming so a missing key can still be
+        # answered with a 404
+        try:
+            first = await rows.__anext__()
+        except KeyError:
+            return web.json_response({'key': key}, status=404)
+        except StopAsyncIteration:
+            first = None
+
+        resp = web.StreamResponse()
+        resp.content_type = 'application/x-ndjson'
+        await resp.prepare(request)
+
+        if first is not None:
+            await resp.write(_ndjson_line(key, *first))
+            async for (ts, value) in rows:
+                await resp.write(_ndjson_line(key, ts, value))
+
+        await resp.write_eof()
+        return resp
+
+    async def get_series(self, request):
+        key = request.match_info['key']
+        start = _get_param_as(request, 'from', float)
+        end = _get_param_as(request, 'to', float)
+        bucket = _get_param_as(request, 'bucket', float)
+        agg = request.query.get('agg') or 'mean'
+
+        if bucket is None:
+            bucket = self.DEFAULT_SERIES_BUCKET
+        elif not math.isfinite(bucket) or bucket <= 0:
+            raise web.HTTPBadRequest(text='bucket must be a positive number')
+
+        if agg not in grandcentral.series.AGGREGATIONS:
+            raise web.HTTPBadRequest(
+                text='agg must be one of: ' +
+                ', '.join(grandcentral.series.AGGREGATIONS))
+
+        try:
+            points = self.series_cache.get(key, bucket, agg, start, end)
+
+        except KeyError:
+            generation = self.series_cache.generation(key)
+
+            try:
+                timestamps, values = await self.storage.timeseries(
+                    key, start=start, end=end)
+            except KeyError:
+                return web.json_response({'key': key}, status=404)
+
+            # Aggregation is CPU bound, keep it off the loop
+            loop = asyncio.get_event_loop()
+            try:
+                points = await loop.run_in_executor(
+                    None, grandcentral.series.downsample,
+                    timestamps, values, bucket, agg)
+            except TypeError as e:
+                raise web.HTTPBadRequest(
+                    text='values of key are not numbers') from e
+
+            self.series_cache.set(
+                key, bucket, agg, start, end, points, generation)
+
+        return web.json_response({
+            'key': key,
+            'bucket': bucket,
+            'agg': agg,
+            'points': points
+        })
+
+    async def get_attachment(self, request):
+        key = request.match_info['key']
+        timestamp = _get_param_as(request, 'timestamp', float)
+
+        try:
+            digest, fh, size = await self.storage.open_attachment(
+                key, timestamp=timestamp)
+        except KeyError:
+            return web.json_response({'key': key}, status=404)
+
+        try:
+            # Attachments are content-addressed so the digest is a strong
+            # ETag
+            etag = '"{}"'.format(digest)
+            if_none_match = request.headers.get('If-None-Match')
+            if if_none_match is not None:
+                candidates = [x.strip() for x in if_none_match.split(',')]
+                if '*' in candidates or etag in candidates:
+                    return web.Response(status=304, headers={'ETag': etag})
+
+            headers = {'ETag': etag, 'Accept-Ranges': 'bytes'}
+            start, end = 0, size - 1
+            status = 200
+
+            try:
+                byte_range = request.http_range
+            except ValueError as e:
+                raise web.HTTPBadRequest(text='Invalid range') from e
+
+            if byte_range.start is not None or byte_range.stop is not None:
+                start, stop, dummy = byte_range.indices(size)
+                end = stop - 1
+                if start >= size or start > end:
+                    return web.Response(status=416, headers={
+                        'Content-Range': 'bytes */{}'.format(size)})
+
+                status = 206
+                headers['Content-Range'] = 'bytes {}-{}/{}'.format(
+                    start, end, size)
+
+            resp = web.StreamResponse(status=status, headers=headers)
+            resp.content_type = 'application/octet-stream'
+            resp.content_length = end - start + 1
+            await resp.prepare(request)
+
+            await fh.seek(start)
+            remaining = end - start + 1
+            while remaining > 0:
+                chunk = await fh.read(min(self.CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+
+                remaining -= len(chunk)
+                await resp.write(chunk)
+
+            await resp.write_eof()
+            return resp
+
+        finally:
+            fh.close()
+
+    async def get_watch(self, request):
+        key = request.match_info['key']
+
+        since = _get_param_as(request, 'since', float)
+        timeout = _get_param_as(request, 'timeout', float)
+        if timeout is None:
+            timeout = self.DEFAULT_WATCH_TIMEOUT
+        elif not 0 <= timeout <= self.MAX_WATCH_TIMEOUT:
+            raise web.HTTPBadRequest(
+                text='timeout must be between 0 and {}'.format(
+                    self.MAX_WATCH_TIMEOUT))
+
+        accept = request.headers.get('Accept', '')
+        event_stream = 'text/event-stream' in accept and \
+            'application/json' not in accept
+
+        # SSE clients resume with Last-Event-ID, which is a timestamp
+        if event_stream and since is None:
+            try:
+                since = float(request.headers['Last-Event-ID'])
+            except (KeyError, ValueError):
+                pass
+
+        # Without a cursor only changes from now on are reported
+        if since is None:
+            since = await self._latest_timestamp(key)
+
+        if event_stream:
+            return await self._event_stream(request, key, since)
+
+        changes = await self._changes(key, since)
+        if not changes and await self.storage.wait(key, since, timeout):
+            changes = await self._changes(key, since)
+
+        if not changes:
+            return web.Response(status=204)
+
+        # Watchers further behind resume from the last change returned
+        headers = {}
+        if len(changes) == self.limit:
+            headers['Link'] = '<{}>; rel=next'.format(
+                request.rel_url.with_query(
+                    {'since': repr(changes[-1][0]), 'timeout': 0}))
+
+        return web.json_response(
+            [_change_doc(key, ts, value) for (ts, value) in changes],
+            headers=headers)
+
+    async def _latest_timestamp(self, key):
+        try:
+            rows = await self.storage.backlog(key, limit=1)
+        except KeyError:
+            rows = []
+
+        return rows[0][0] if rows else float('-inf')
+
+    async def _changes(self, key, since):
+        # Up to limit changes after since, in write order
+        changes = []
+        rows = self.storage.range(key, start=since)
+        try:
+            async for row in rows:
+                if row[0] > since:
+                    changes.append(row)
+                    if len(changes) == self.limit:
+                        break
+
+        except KeyError:
+            return []
+
+        finally:
+            await rows.aclose()
+
+        return changes
+
+    async def _event_stream(self, request, key, since):
+        resp = web.StreamResponse(headers={'Cache-Control': 'no-cache'})
+        resp.content_type = 'text/event-stream'
+        await resp.prepare(request)
+
+        while True:
+            changes = await self._changes(key, since)
+            for (ts, value) in changes:
+                event = 'id: {}\ndata: {}\n\n'.format(
+                    repr(ts), json.dumps(_change_doc(key, ts, value)))
+                await resp.write(event.encode('utf-8'))
+                since = ts
+
+            if changes:
+                continue
+
+            if not await self.storage.wait(
+                    key, since, timeout=self.HEARTBEAT_INTERVAL):
+                # Comment line, keeps proxies from closing an idle stream
+                await resp.write(b': keep-alive\n\n')
+
+
+def _unquote_etag(etag):
+    # Weak comparison, W/ is dropped
+    etag = etag.strip()
+    if etag.startswith('W/'):
+        etag = etag[2:]
+
+    return etag.strip('"')
+
+
+def _loads(text):
+    try:
+        return json.loads(text)
+    except ValueError as e:
+        raise web.HTTPBadRequest(text='Malformed message') from e
+
+
+def _get_param_as(request, name, typ):
+    value = request.query.get(name)
+    if value is None:
+        return None
+
+    try:
+        return typ(value)
+    except ValueError as e:
+        raise web.HTTPBadRequest(
+            text='{} must be a valid {}'.format(name, typ.__name__)) from e
+
+
+def _change_doc(key, ts, value):
+    return {
+        'timestamp': ts,
+        'message': {
+            'key': key,
+            'value': value
+        }
+    }
+
+
+def _ndjson_line(key, ts, value):
+    return (json.dumps(_change_doc(key, ts, value)) + '\n').encode('utf-8')
+
+
+def main():
+    import argparse
+    import sys
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--host',
+        default='127.0.0.1',
+        help='Address to listen on')
+    parser.add_argument(
+        '-p', '--port',
+        type=int,
+        default=8000,
+        help='Port to listen on')
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=8,
+        help='Threads used to run blocking storage calls')
+
+    args = parser.parse_args(sys.argv[1:])
+
+    try:
+        import grandcentral.sqlalchemystorage
+        storage_cls = grandcentral.sqlalchemystorage.SQLAlchemyStorage
+    except ImportError:
+        storage_cls = grandcentral.storage.MemoryStorage
+
+    api = AsyncAPI(storage_cls(), max_workers=args.workers)
+    web.run_app(api.app, host=args.host, port=args.port)
+
+
+if __name__ == '__main__':
+    main()
@@ -18,10 +18,21 @@
 # USA.
 
 
+import grandcentral.codecs
+import grandcentral.compression
+import grandcentral.metrics
+import grandcentral.series
+import grandcentral.signaler
 import grandcentral.storage
 
 
+import calendar
+import datetime
+import itertools
 import json
+import math
+import tempfile
+import urllib.parse
 
 
 import falcon
@@ -30,30 +41,312 @@ import mimeparse
 
 
 class API(falcon.API):
-    def __init__(self, storage, *args, **kwargs):
-        super().__init__(
-            *args,
-            middleware=[falcon_multipart.middleware.MultipartMiddleware()],
-            **kwargs)
+    def __init__(self, storage, *args, read_only=False, metrics=True,
+                 **kwargs):
+        # metrics can be a grandcentral.metrics.Metrics to share or False to
+        # leave requests and storage uninstrumented
+        if metrics is True:
+            metrics = grandcentral.metrics.Metrics()
+
+        # Bodies must be decompressed before multipart parsing
+        middleware = [
+            CompressionMiddleware(),
+            falcon_multipart.middleware.MultipartMiddleware()
+        ]
+        if read_only:
+            middleware.insert(0, ReadOnlyMiddleware())
+        if metrics:
+            middleware.insert(
+                0, grandcentral.metrics.MetricsMiddleware(metrics))
+
+        super().__init__(*args, middleware=middleware, **kwargs)
 
         if not isinstance(storage, grandcentral.storage.BaseStorage):
             raise TypeError(storage)
 
+        if metrics:
+            storage = grandcentral.metrics.InstrumentedStorage(
+                storage, metrics)
+
+        self.metrics = metrics
         self.storage = storage
-        self.signaler = None
+        if not isinstance(storage.signaler, grandcentral.signaler.Signaler):
+            storage.signaler = grandcentral.signaler.Signaler()
+        self.signaler = storage.signaler
 
         msg_col_rsrc = MessagesCollectionResource(storage=self.storage)
+        msg_batch_rsrc = MessagesBatchResource(storage=self.storage)
+        msg_batch_read_rsrc = MessagesBatchReadResource(storage=self.storage)
         msg_item_rsrc = MessagesItemResource(storage=self.storage)
         msg_blacklog_rsrc = MessageBacklogCollection(storage=self.storage)
+        msg_attachment_rsrc = MessageAttachmentResource(storage=self.storage)
+        msg_range_rsrc = MessageRangeCollection(storage=self.storage)
+        msg_series_rsrc = MessageSeriesCollection(
+            storage=self.storage, signaler=self.signaler)
+        msg_watch_rsrc = MessageWatchResource(
+            storage=self.storage, signaler=self.signaler)
         self.add_route('/message', msg_col_rsrc)
+        self.add_route('/message/batch', msg_batch_rsrc)
+        self.add_route('/message/batch/read', msg_batch_read_rsrc)
         self.add_route('/message/{key}', msg_item_rsrc)
         self.add_route('/message/{key}/backlog', msg_blacklog_rsrc)
+        self.add_route('/message/{key}/attachment', msg_attachment_rsrc)
+        self.add_route('/message/{key}/range', msg_range_rsrc)
+        self.add_route('/message/{key}/series', msg_series_rsrc)
+        self.add_route('/message/{key}/watch', msg_watch_rsrc)
+        self.add_route('/changes', ChangesCollection(storage=self.storage))
+        self.add_route('/export', ExportCollection(storage=self.storage))
+        self.add_route('/import', ImportResource(storage=self.storage))
+        self.add_route('/attachment/{digest}',
+                       AttachmentResource(storage=self.storage))
+        self.add_route('/chunks/missing',
+                       ChunksMissingResource(storage=self.storage))
+        self.add_route('/chunks/{digest}',
+                       ChunkResource(storage=self.storage))
+        if metrics:
+            self.add_route('/metrics',
+                           grandcentral.metrics.MetricsResource(metrics))
+
+
+class ReadOnlyMiddleware:
+    # Followers only apply what comes from their primary's change feed
+
+    # POSTs that only read
+    READ_PATHS = ('/message/batch/read',)
+
+    def process_request(self, req, resp):
+        if (req.method not in ('GET', 'HEAD', 'OPTIONS') and
+                req.path not in self.READ_PATHS):
+            raise falcon.HTTPForbidden(
+                'Read only', 'This server is a read only replica')
+
+
+class CompressionMiddleware:
+    # Decompresses request bodies sent with Content-Encoding and compresses
+    # responses per Accept-Encoding. Small bodies, ranges and file streams
+    # (attachments, already compressed if worth it) are left alone
+    MIN_SIZE = 1024
+    MAX_BODY_SIZE = 256 * 1024 * 1024
+    SPOOL_SIZE = 1024 * 1024
+    CHUNK_SIZE = 64 * 1024
+    SKIP_CONTENT_TYPES = ('application/octet-stream', 'text/event-stream')
+
+    def process_request(self, req, resp):
+        encoding = req.get_header('Content-Encoding')
+        if not encoding or encoding.lower() == 'identity':
+            return
+
+        try:
+            compression = grandcentral.compression.get_compression(
+                encoding.lower())
+        except ValueError as e:
+            raise falcon.HTTPUnsupportedMediaType(
+                'Unsupported Content-Encoding: {}'.format(encoding)) from e
+
+        # Read req.stream up to Content-Length as bounded_stream would, but
+        # without touching it: falcon builds bounded_stream lazily from
+        # req.stream and CONTENT_LENGTH, so once those are swapped below it
+        # wraps the decompressed body
+        body = tempfile.SpooledTemporaryFile(max_size=self.SPOOL_SIZE)
+        obj = compression.decompressobj()
+        size = 0
+        remaining = req.content_length or 0
+        try:
+            while remaining > 0:
+                chunk = req.stream.read(min(self.CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+
+                data = obj.decompress(chunk)
+                size += len(data)
+                if size > self.MAX_BODY_SIZE:
+                    raise falcon.HTTPPayloadTooLarge(
+                        'Payload too large',
+                        'decompressed body exceeds {} bytes'.format(
+                            self.MAX_BODY_SIZE))
+                body.write(data)
+
+        except Exception as e:
+            body.close()
+            if isinstance(e, falcon.HTTPError):
+                raise
+            raise falcon.HTTPBadRequest(
+                'Malformed body',
+                'body is not valid {}'.format(compression.name)) from e
+
+        body.seek(0)
+
+        # Handlers and the multipart parser read these, make them see the
+        # decompressed body
+        req.env['wsgi.input'] = body
+        req.env['CONTENT_LENGTH'] = str(size)
+        req.env.pop('HTTP_CONTENT_ENCODING', None)
+        req.stream = body
+
+    def process_response(self, req, resp, resource, req_succeeded):
+        if (resp.get_header('Content-Encoding') is not None or
+                resp.status in (falcon.HTTP_206, falcon.HTTP_304) or
+                resp.content_type in self.SKIP_CONTENT_TYPES):
+            return
+
+        data = resp.data
+        if data is None and resp.body is not None:
+            data = resp.body.encode('utf-8')
+
+        if data is not None:
+            if len(data) < self.MIN_SIZE:
+                return
+
+        elif resp.stream is None or hasattr(resp.stream, 'read'):
+            return
+
+        self._add_vary(resp)
+        compression = grandcentral.compression.negotiate(
+            req.get_header('Accept-Encoding'))
+        if compression is None:
+            return
+
+        if data is not None:
+            resp.body = None
+            resp.data = compression.compress(data)
+        else:
+            resp.stream = self._compress_stream(compression, resp.stream)
+            resp.content_length = None
+
+        resp.set_header('Content-Encoding', compression.name)
+
+        # Compressed bytes differ from the identity ones
+        etag = resp.get_header('ETag')
+        if etag is not None and not etag.startswith('W/'):
+            resp.set_header('ETag', 'W/' + etag)
+
+    def _add_vary(self, resp):
+        vary = resp.get_header('Vary')
+        resp.set_header(
+            'Vary',
+            vary + ', Accept-Encoding' if vary else 'Accept-Encoding')
+
+    def _compress_stream(self, compression, stream):
+        obj = compression.compressobj()
+        for chunk in stream:
+            data = obj.compress(chunk)
+            if data:
+                yield data
+
+        yield obj.flush()
+
+
+def _get_param_as(req, name, typ):
+    value = req.get_param(name)
+    if value is None:
+        return None
+
+    try:
+        return typ(value)
+    except ValueError as e:
+        raise falcon.HTTPBadRequest(
+            'Invalid parameter',
+            '{} must be a valid {}'.format(name, typ.__name__)) from e
+
+
+def _response_codec(req):
+    # Codec picked from the Accept header. JSON goes last so it wins ties
+    # (ie. */*) and is used when nothing matches
+    supported = sorted(
+        grandcentral.codecs.CONTENT_TYPES,
+        key=lambda x: x == grandcentral.codecs.JSON.content_type)
+    match = mimeparse.best_match(supported, req.accept)
+
+    return grandcentral.codecs.CONTENT_TYPES.get(
+        match, grandcentral.codecs.JSON)
+
+
+def _set_validators(req, resp, key, storage, codec, backlog=False):
+    # Sets ETag and Last-Modified from the latest record of key (KeyError if
+    # there is none) and tells if the client's copy is still fresh.
+    # Representations differ per codec and so do their ETags.
+    #
+    # A backlog also changes when expire() or an import removes or adds
+    # older records, so its ETag covers the oldest record and the record
+    # count too. Those changes have no modification time: backlogs get no
+    # Last-Modified and If-Modified-Since is ignored for them
+    if backlog:
+        (oldest, ts, count) = storage.backlog_summary(key)
+        etag = '{}-{}-{}-{}'.format(repr(ts), repr(oldest), count, codec.name)
+    else:
+        ts = storage.latest_timestamp(key)
+        etag = '{}-{}'.format(repr(ts), codec.name)
+        resp.last_modified = datetime.datetime.utcfromtimestamp(int(ts))
+
+    resp.etag = '"{}"'.format(etag)
+    resp.vary = ['Accept']
+
+    # If-Modified-Since only has one second resolution, so it's ignored when
+    # If-None-Match is there
+    if req.if_none_match is not None:
+        return '*' in req.if_none_match or etag in req.if_none_match
+
+    if req.if_modified_since is not None and not backlog:
+        since = calendar.timegm(req.if_modified_since.utctimetuple())
+        return int(ts) <= since
+
+    return False
+
+
+def _reencode(codec, stored_codec, data):
+    # Stored bytes are sent as is when the codecs match
+    if stored_codec is codec:
+        return data
+
+    return codec.encode(stored_codec.decode(data))
+
+
+MAX_READ_KEYS = 1000
+
+
+def _read_many(req, resp, storage, keys):
+    # Answers with the found messages, in request order, and the missing
+    # keys
+    if not all(isinstance(key, str) for key in keys):
+        raise falcon.HTTPBadRequest(
+            'Invalid parameter', 'keys must be strings')
+
+    keys = list(dict.fromkeys(keys))
+    if not 0 < len(keys) <= MAX_READ_KEYS:
+        raise falcon.HTTPBadRequest(
+            'Invalid parameter',
+            'between 1 and {} keys are required'.format(MAX_READ_KEYS))
+
+    found = storage.read_many(keys)
+    codec = _response_codec(req)
+
+    resp.status = falcon.HTTP_200
+    resp.content_type = codec.content_type
+    resp.data = codec.encode({
+        'messages': [
+            {'key': key, 'value': found[key]}
+            for key in keys if key in found
+        ],
+        'missing': [key for key in keys if key not in found]
+    })
 
 
 class MessagesCollectionResource:
     def __init__(self, storage):
         self.storage = storage
 
+    def on_get(self, req, resp):
+        # Multi-key read, GET /message?keys=a,b,c (keys can be repeated
+        # too)
+        values = req.get_param_as_list('keys')
+        if values is None:
+            raise falcon.HTTPBadRequest(
+                'Missing parameter', 'keys is required')
+
+        keys = [key for value in values for key in value.split(',')]
+        _read_many(req, resp, self.storage, keys)
+
     def on_post(self, req, resp):
         typ, subtyp, props = mimeparse.parse_mime_type(req.content_type)
 
@@ -72,15 +365,16 @@ class MessagesCollectionResource:
             except json.decoder.JSONDecodeError as e:
                 raise ValueError('Malformed message') from e
 
+            # Pass the (spooled) file object down so storage can stream it
             form_field = req.get_param('attachment')
-            attachment = form_field.file.read()
+            attachment = form_field.file
 
         elif typ == 'application' and subtyp == 'json':
             # Handle simple requests
 
             # Invalid json for message
             try:
-                message = json.load(req.stream)
+                message = json.load(req.bounded_stream)
             except json.decoder.JSONDecodeError as e:
                 raise ValueError('Malformed message') from e
 
@@ -95,18 +389,117 @@ class MessagesCollectionResource:
         except KeyError as e:
             raise ValueError('Malformed message') from e
 
+        if attachment is None and message.get('chunks') is not None:
+            # Attachment uploaded beforehand to /chunks
+            self._write_chunked(resp, key, value, message['chunks'])
+            return
+
         self.storage.write(key, value, attachment)
 
         resp.status = falcon.HTTP_204
 
+    def _write_chunked(self, resp, key, value, chunks):
+        try:
+            chunks = [(str(digest), int(size)) for (digest, size) in chunks]
+        except (TypeError, ValueError) as e:
+            raise falcon.HTTPBadRequest(
+                'Malformed message',
+                'chunks must be a list of [digest, size]') from e
+
+        try:
+            missing = self.storage.missing_chunks(
+                [digest for (digest, size) in chunks])
+            if missing:
+                # Collected meanwhile or never uploaded
+                resp.status = falcon.HTTP_409
+                resp.content_type = falcon.MEDIA_JSON
+                resp.body = json.dumps({'missing': missing})
+                return
+
+            self.storage.write_chunked(key, value, chunks)
+
+        except NotImplementedError as e:
+            raise falcon.HTTPNotImplemented(
+                'Not implemented', "storage can't store chunks") from e
+
+        except ValueError as e:
+            raise falcon.HTTPBadRequest('Malformed message', str(e)) from e
+
+        resp.status = falcon.HTTP_204
+
+
+class MessagesBatchResource:
+    def __init__(self, storage):
+        self.storage = storage
+
+    def on_post(self, req, resp):
+        typ, subtyp, props = mimeparse.parse_mime_type(req.content_type)
+
+        try:
+            if typ == 'application' and subtyp == 'json':
+                messages = json.load(req.bounded_stream)
+
+            elif typ == 'application' and subtyp in ['x-ndjson', 'ndjson']:
+                messages = [
+                    json.loads(line.decode('utf-8'))
+                    for line in req.bounded_stream.read().splitlines()
+                    if line.strip()
+                ]
+
+            else:
+                raise ValueError('Unknow request')
+
+        except json.decoder.JSONDecodeError as e:
+            raise ValueError('Malformed message') from e
+
+        if not isinstance(messages, list):
+            raise ValueError('Malformed message')
+
+        try:
+            messages = [(msg['key'], msg['value']) for msg in messages]
+        except (KeyError, TypeError) as e:
+            raise ValueError('Malformed message') from e
+
+        self.storage.write_many(messages)
+
+        resp.status = falcon.HTTP_204
+
+
+class MessagesBatchReadResource:
+    # Multi-key read for key lists too long for a query string (or keys
+    # with commas): {"keys": [...]}
+
+    def __init__(self, storage):
+        self.storage = storage
+
+    def on_post(self, req, resp):
+        try:
+            doc = json.load(req.bounded_stream)
+            keys = doc['keys']
+        except (json.decoder.JSONDecodeError, KeyError, TypeError) as e:
+            raise falcon.HTTPBadRequest(
+                'Malformed request', 'expected {"keys": [...]}') from e
+
+        if not isinstance(keys, list):
+            raise falcon.HTTPBadRequest(
+                'Malformed request', 'keys must be a list')
+
+        _read_many(req, resp, self.storage, keys)
+
 
 class MessagesItemResource:
     def __init__(self, storage):
         self.storage = storage
 
     def on_get(self, req, resp, key):
+        codec = _response_codec(req)
+
         try:
-            value = self.storage.read(key)
+            if _set_validators(req, resp, key, self.storage, codec):
+                resp.status = falcon.HTTP_304
+                return
+
+            stored_codec, data = self.storage.read_raw(key)
 
         except KeyError:
             resp.status = falcon.HTTP_404
@@ -116,39 +509,614 @@ class MessagesItemResource:
             return
 
         resp.status = falcon.HTTP_200
-        resp.content_type = falcon.MEDIA_JSON
-        resp.body = json.dumps({
-            'key': key,
-            'value': value
+        resp.content_type = codec.content_type
+        resp.data = codec.envelope({
+            'key': codec.encode(key),
+            'value': _reencode(codec, stored_codec, data)
         })
 
 
 class MessageBacklogCollection:
+    MAX_LIMIT = 1000
+
     def __init__(self, storage, max_messages=100):
         self.storage = storage
         self.limit = max_messages
 
     def on_get(self, req, resp, key):
-        def _backlog():
-            g = self.storage.backlog(key)
-            for dummy in range(self.limit):
-                try:
-                    ts, value = next(g)
-                    yield (ts, value)
-                except StopIteration:
-                    return
+        limit = _get_param_as(req, 'limit', int)
+        if limit is None:
+            limit = self.limit
+        elif not 0 < limit <= self.MAX_LIMIT:
+            raise falcon.HTTPBadRequest(
+                'Invalid parameter',
+                'limit must be between 1 and {}'.format(self.MAX_LIMIT))
+
+        before = _get_param_as(req, 'before', float)
+        after = _get_param_as(req, 'after', float)
+        codec = _response_codec(req)
+
+        # Ask for one extra row to know if there is a next page
+        try:
+            if _set_validators(req, resp, key, self.storage, codec,
+                               backlog=True):
+                resp.status = falcon.HTTP_304
+                return
+
+            rows = list(self.storage.backlog_raw(
+                key, limit=limit + 1, before=before, after=after))
+
+        except KeyError:
+            resp.status = falcon.HTTP_404
+            resp.body = json.dumps({
+                'key': key
+            })
+            return
 
+        if len(rows) > limit:
+            rows = rows[:limit]
+            params = {'before': repr(rows[-1][0]), 'limit': limit}
+            if after is not None:
+                params['after'] = repr(after)
+
+            resp.add_link(
+                '{}?{}'.format(req.path, urllib.parse.urlencode(params)),
+                'next')
+
+        encoded_key = codec.encode(key)
         ret = [
-            {
-                'timestamp': x[0],
+            codec.envelope({
+                'timestamp': codec.encode(ts),
+                'message': codec.envelope({
+                    'key': encoded_key,
+                    'value': _reencode(codec, stored_codec, data)
+                })
+            })
+            for (ts, stored_codec, data) in rows
+        ]
+
+        resp.status = falcon.HTTP_200
+        resp.content_type = codec.content_type
+        resp.data = codec.array(ret)
+
+
+class MessageRangeCollection:
+    def __init__(self, storage):
+        self.storage = storage
+
+    def on_get(self, req, resp, key):
+        start = _get_param_as(req, 'from', float)
+        end = _get_param_as(req, 'to', float)
+
+        rows = self.storage.range(key, start=start, end=end)
+
+        # Pull the first row before streaming so a missing key can still be
+        # answered with a 404
+        try:
+            first = list(itertools.islice(rows, 1))
+
+        except KeyError:
+            resp.status = falcon.HTTP_404
+            resp.body = json.dumps({
+                'key': key
+            })
+            return
+
+        resp.status = falcon.HTTP_200
+        resp.content_type = 'application/x-ndjson'
+        resp.stream = self._ndjson(key, itertools.chain(first, rows))
+
+    def _ndjson(self, key, rows):
+        for (ts, value) in rows:
+            line = json.dumps({
+                'timestamp': ts,
                 'message': {
                     'key': key,
-                    'value': x[1]
+                    'value': value
                 }
-            }
-            for x in _backlog()
-        ]
+            })
+            yield (line + '\n').encode('utf-8')
+
+
+class MessageSeriesCollection:
+    DEFAULT_BUCKET = 60
+
+    def __init__(self, storage, signaler, cache_size=256):
+        self.storage = storage
+        self.cache = grandcentral.series.SeriesCache(
+            signaler, maxsize=cache_size)
+
+    def on_get(self, req, resp, key):
+        start = _get_param_as(req, 'from', float)
+        end = _get_param_as(req, 'to', float)
+        bucket = _get_param_as(req, 'bucket', float)
+        agg = req.get_param('agg') or 'mean'
+
+        if bucket is None:
+            bucket = self.DEFAULT_BUCKET
+        elif not math.isfinite(bucket) or bucket <= 0:
+            raise falcon.HTTPBadRequest(
+                'Invalid parameter', 'bucket must be a positive number')
+
+        if agg not in grandcentral.series.AGGREGATIONS:
+            raise falcon.HTTPBadRequest(
+                'Invalid parameter',
+                'agg must be one of: ' +
+                ', '.join(grandcentral.series.AGGREGATIONS))
+
+        try:
+            points = self.cache.get(key, bucket, agg, start, end)
+
+        except KeyError:
+            generation = self.cache.generation(key)
+
+            try:
+                timestamps, values = self.storage.timeseries(
+                    key, start=start, end=end)
+
+            except KeyError:
+                resp.status = falcon.HTTP_404
+                resp.body = json.dumps({
+                    'key': key
+                })
+                return
+
+            try:
+                points = grandcentral.series.downsample(
+                    timestamps, values, bucket, agg)
+            except TypeError as e:
+                raise falcon.HTTPBadRequest(
+                    'Invalid key', 'values of key are not numbers') from e
+
+            self.cache.set(key, bucket, agg, start, end, points, generation)
+
+        resp.status = falcon.HTTP_200
+        resp.content_type = falcon.MEDIA_JSON
+        resp.body = json.dumps({
+            'key': key,
+            'bucket': bucket,
+            'agg': agg,
+            'points': points
+        })
+
+
+class MessageAttachmentResource:
+    CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, storage):
+        self.storage = storage
+
+    def on_get(self, req, resp, key):
+        timestamp = _get_param_as(req, 'timestamp', float)
+
+        try:
+            digest, fh, size, encoding = self.storage.open_attachment_encoded(
+                key, timestamp=timestamp)
+
+        except KeyError:
+            resp.status = falcon.HTTP_404
+            resp.body = json.dumps({
+                'key': key
+            })
+            return
+
+        # Attachments are content-addressed so the digest is a strong ETag
+        etag = '"{}"'.format(digest)
+
+        # Compressed ones go out as stored to clients accepting their
+        # encoding, ranges are on the uncompressed bytes
+        if encoding is not None:
+            resp.vary = ['Accept-Encoding']
+            compression = grandcentral.compression.get_compression(encoding)
+            accepted = grandcentral.compression.negotiate(
+                req.get_header('Accept-Encoding'), [compression])
+
+            if accepted is not None and req.range is None:
+                etag = '"{}-{}"'.format(digest, encoding)
+                resp.set_header('Content-Encoding', encoding)
+            else:
+                size = compression.uncompressed_size(fh)
+                fh = grandcentral.compression.DecompressingReader(
+                    fh, compression)
+
+        resp.etag = etag
+
+        if_none_match = req.get_header('If-None-Match')
+        if if_none_match is not None:
+            candidates = [x.strip() for x in if_none_match.split(',')]
+            if '*' in candidates or etag in candidates:
+                fh.close()
+                resp.status = falcon.HTTP_304
+                return
+
+        resp.accept_ranges = 'bytes'
+        resp.content_type = 'application/octet-stream'
+
+        byte_range = req.range
+        if byte_range is None:
+            # Falcon hands file objects to wsgi.file_wrapper when the server
+            # provides one (ie. sendfile), so nothing is buffered here
+            resp.status = falcon.HTTP_200
+            resp.set_stream(fh, size)
+            return
+
+        start, end = byte_range
+        if start < 0:
+            start, end = max(size + start, 0), size - 1
+        elif end < 0 or end >= size:
+            end = size - 1
+
+        if start >= size or start > end:
+            fh.close()
+            resp.status = falcon.HTTP_416
+            resp.set_header('Content-Range', 'bytes */{}'.format(size))
+            return
+
+        fh.seek(start)
+        resp.status = falcon.HTTP_206
+        resp.content_range = (start, end, size)
+        resp.set_stream(
+            self._read_range(fh, end - start + 1),
+            end - start + 1)
+
+    def _read_range(self, fh, length):
+        try:
+            while length > 0:
+                chunk = fh.read(min(self.CHUNK_SIZE, length))
+                if not chunk:
+                    break
+
+                length -= len(chunk)
+                yield chunk
+
+        finally:
+            fh.close()
+
+
+class ChangesCollection:
+    DEFAULT_LIMIT = 1000
+    MAX_LIMIT = 10000
+
+    def __init__(self, storage):
+        self.storage = storage
+
+    def on_get(self, req, resp):
+        since = _get_param_as(req, 'since', int) or 0
+        limit = _get_param_as(req, 'limit', int)
+        if limit is None:
+            limit = self.DEFAULT_LIMIT
+        elif not 0 < limit <= self.MAX_LIMIT:
+            raise falcon.HTTPBadRequest(
+                'Invalid parameter',
+                'limit must be between 1 and {}'.format(self.MAX_LIMIT))
+
+        try:
+            changes = self.storage.changes(since=since, limit=limit)
+            first = list(itertools.islice(changes, 1))
+
+        except NotImplementedError as e:
+            raise falcon.HTTPNotImplemented(
+                'Not implemented',
+                "storage doesn't keep a change feed") from e
+
+        resp.status = falcon.HTTP_200
+        resp.content_type = 'application/x-ndjson'
+        resp.stream = self._ndjson(itertools.chain(first, changes))
+
+    def _ndjson(self, changes):
+        for (seq, key, ts, value, attachment) in changes:
+            line = json.dumps({
+                'seq': seq,
+                'timestamp': ts,
+                'attachment': attachment,
+                'message': {
+                    'key': key,
+                    'value': value
+                }
+            })
+            yield (line + '\n').encode('utf-8')
+
+
+class ExportCollection:
+    # Every record as NDJSON, in the same format as range, streamed from
+    # the storage as the client reads. Attachments are not included
+
+    def __init__(self, storage):
+        self.storage = storage
+
+    def on_get(self, req, resp):
+        prefix = req.get_param('prefix')
+        start = _get_param_as(req, 'from', float)
+        end = _get_param_as(req, 'to', float)
+
+        resp.status = falcon.HTTP_200
+        resp.content_type = 'application/x-ndjson'
+        resp.stream = self._ndjson(
+            self.storage.export(prefix=prefix, start=start, end=end))
+
+    def _ndjson(self, records):
+        for (key, ts, value) in records:
+            line = json.dumps({
+                'timestamp': ts,
+                'message': {
+                    'key': key,
+                    'value': value
+                }
+            })
+            yield (line + '\n').encode('utf-8')
+
+
+class ImportResource:
+    # Stores the records of an export keeping their timestamps, BATCH_SIZE
+    # at a time. Batches before a malformed line stay imported
+    BATCH_SIZE = 1000
+    CHUNK_SIZE = 64 * 1024
+    MAX_LINE_SIZE = 16 * 1024 * 1024
+
+    def __init__(self, storage):
+        self.storage = storage
+
+    def on_post(self, req, resp):
+        count = 0
+        batch = []
+
+        try:
+            for (lineno, line) in enumerate(
+                    self._lines(req.bounded_stream), start=1):
+                if not line.strip():
+                    continue
+
+                batch.append(self._parse(lineno, line))
+                if len(batch) >= self.BATCH_SIZE:
+                    self.storage.import_records(batch)
+                    count += len(batch)
+                    batch = []
+
+            if batch:
+                self.storage.import_records(batch)
+                count += len(batch)
+
+        except NotImplementedError as e:
+            raise falcon.HTTPNotImplemented(
+                'Not implemented', "storage can't import records") from e
+
+        resp.status = falcon.HTTP_200
+        resp.content_type = falcon.MEDIA_JSON
+        resp.body = json.dumps({'records': count})
+
+    def _lines(self, stream):
+        # BoundedStream.readline() miscounts the remaining bytes, split
+        # chunks here instead
+        buf = b''
+        for chunk in iter(lambda: stream.read(self.CHUNK_SIZE), b''):
+            lines = (buf + chunk).split(b'\n')
+            buf = lines.pop()
+            yield from lines
+
+            if len(buf) > self.MAX_LINE_SIZE:
+                raise falcon.HTTPPayloadTooLarge(
+                    'Line too long',
+                    'lines must not exceed {} bytes'.format(
+                        self.MAX_LINE_SIZE))
+
+        if buf:
+            yield buf
+
+    def _parse(self, lineno, line):
+        try:
+            doc = json.loads(line.decode('utf-8'))
+            key = doc['message']['key']
+            if not isinstance(key, str):
+                raise TypeError(key)
+
+            return (key, float(doc['timestamp']), doc['message']['value'])
+
+        except (ValueError, KeyError, TypeError) as e:
+            raise falcon.HTTPBadRequest(
+                'Malformed record',
+                'line {} is not valid'.format(lineno)) from e
+
+
+class ChunksMissingResource:
+    # {"digests": [...]} -> {"missing": [...]}, the chunks a chunked upload
+    # still has to send
+    MAX_DIGESTS = 100000
+
+    def __init__(self, storage):
+        self.storage = storage
+
+    def on_post(self, req, resp):
+        try:
+            doc = json.load(req.bounded_stream)
+            digests = doc['digests']
+        except (json.decoder.JSONDecodeError, KeyError, TypeError) as e:
+            raise falcon.HTTPBadRequest(
+                'Malformed request', 'expected {"digests": [...]}') from e
+
+        if (not isinstance(digests, list) or
+                not all(isinstance(x, str) for x in digests)):
+            raise falcon.HTTPBadRequest(
+                'Malformed request', 'digests must be a list of strings')
+
+        if len(digests) > self.MAX_DIGESTS:
+            raise falcon.HTTPBadRequest(
+                'Too many digests',
+                'at most {} digests per request'.format(self.MAX_DIGESTS))
+
+        try:
+            missing = self.storage.missing_chunks(digests)
+        except NotImplementedError as e:
+            raise falcon.HTTPNotImplemented(
+                'Not implemented', "storage can't store chunks") from e
 
         resp.status = falcon.HTTP_200
         resp.content_type = falcon.MEDIA_JSON
-        resp.body = json.dumps(ret)
+        resp.body = json.dumps({'missing': missing})
+
+
+class ChunkResource:
+    # Chunks are content-addressed, PUTting one twice is harmless
+    MAX_CHUNK_SIZE = 4 * 1024 * 1024
+
+    def __init__(self, storage):
+        self.storage = storage
+
+    def on_put(self, req, resp, digest):
+        if (req.content_length or 0) > self.MAX_CHUNK_SIZE:
+            raise falcon.HTTPPayloadTooLarge(
+                'Chunk too large',
+                'chunks must not exceed {} bytes'.format(
+                    self.MAX_CHUNK_SIZE))
+
+        data = req.bounded_stream.read(self.MAX_CHUNK_SIZE + 1)
+        if len(data) > self.MAX_CHUNK_SIZE:
+            raise falcon.HTTPPayloadTooLarge(
+                'Chunk too large',
+                'chunks must not exceed {} bytes'.format(
+                    self.MAX_CHUNK_SIZE))
+
+        try:
+            self.storage.store_chunk(digest, data)
+        except NotImplementedError as e:
+            raise falcon.HTTPNotImplemented(
+                'Not implemented', "storage can't store chunks") from e
+        except ValueError as e:
+            raise falcon.HTTPBadRequest('Digest mismatch', str(e)) from e
+
+        resp.status = falcon.HTTP_204
+
+
+class AttachmentResource:
+    def __init__(self, storage):
+        self.storage = storage
+
+    def on_get(self, req, resp, digest):
+        try:
+            fh, size = self.storage.open_attachment_by_digest(digest)
+
+        except KeyError:
+            resp.status = falcon.HTTP_404
+            resp.body = json.dumps({
+                'digest': digest
+            })
+            return
+
+        resp.status = falcon.HTTP_200
+        resp.etag = '"{}"'.format(digest)
+        resp.content_type = 'application/octet-stream'
+        resp.set_stream(fh, size)
+
+
+class MessageWatchResource:
+    DEFAULT_TIMEOUT = 30
+    MAX_TIMEOUT = 300
+    HEARTBEAT_INTERVAL = 15
+
+    def __init__(self, storage, signaler, max_messages=100):
+        self.storage = storage
+        self.signaler = signaler
+        self.limit = max_messages
+
+    def on_get(self, req, resp, key):
+        since = _get_param_as(req, 'since', float)
+        timeout = _get_param_as(req, 'timeout', float)
+        if timeout is None:
+            timeout = self.DEFAULT_TIMEOUT
+        elif not 0 <= timeout <= self.MAX_TIMEOUT:
+            raise falcon.HTTPBadRequest(
+                'Invalid parameter',
+                'timeout must be between 0 and {}'.format(self.MAX_TIMEOUT))
+
+        event_stream = req.client_accepts('text/event-stream') and \
+            not req.client_accepts_json
+
+        # SSE clients resume with Last-Event-ID, which is a timestamp
+        if event_stream and since is None:
+            last_event_id = req.get_header('Last-Event-ID')
+            if last_event_id:
+                try:
+                    since = float(last_event_id)
+                except ValueError:
+                    pass
+
+        # Without a cursor only changes from now on are reported
+        if since is None:
+            since = self._latest_timestamp(key)
+
+        if event_stream:
+            resp.status = falcon.HTTP_200
+            resp.content_type = 'text/event-stream'
+            resp.cache_control = ['no-cache']
+            resp.stream = self._event_stream(key, since)
+            return
+
+        changes = self._changes(key, since)
+        if not changes and self.signaler.wait(key, since, timeout=timeout):
+            changes = self._changes(key, since)
+
+        if not changes:
+            resp.status = falcon.HTTP_204
+            return
+
+        # Watchers further behind resume from the last change returned
+        if len(changes) == self.limit:
+            params = {'since': repr(changes[-1][0]), 'timeout': 0}
+            resp.add_link(
+                '{}?{}'.format(req.path, urllib.parse.urlencode(params)),
+                'next')
+
+        resp.status = falcon.HTTP_200
+        resp.content_type = falcon.MEDIA_JSON
+        resp.body = json.dumps([
+            self._change_doc(key, ts, value)
+            for (ts, value) in changes
+        ])
+
+    def _latest_timestamp(self, key):
+        try:
+            for (ts, value) in self.storage.backlog(key, limit=1):
+                return ts
+
+        except KeyError:
+            pass
+
+        return float('-inf')
+
+    def _changes(self, key, since):
+        # Up to limit changes after since, in write order
+        rows = self.storage.range(key, start=since)
+        try:
+            return list(itertools.islice(
+                (row for row in rows if row[0] > since), self.limit))
+
+        except KeyError:
+            return []
+
+        finally:
+            rows.close()
+
+    def _change_doc(self, key, ts, value):
+        return {
+            'timestamp': ts,
+            'message': {
+                'key': key,
+                'value': value
+            }
+        }
+
+    def _event_stream(self, key, since):
+        while True:
+            changes = self._changes(key, since)
+            for (ts, value) in changes:
+                event = 'id: {}\ndata: {}\n\n'.format(
+                    repr(ts), json.dumps(self._change_doc(key, ts, value)))
+                yield event.encode('utf-8')
+                since = ts
+
+            if changes:
+                continue
+
+            if not self.signaler.wait(
+                    key, since, timeout=self.HEARTBEAT_INTERVAL):
+                # Comment line, keeps proxies from closing an idle stream
+                yield b': keep-alive\n\n'
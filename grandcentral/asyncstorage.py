@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2017 Luis López <luis@cuarentaydos.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
+# USA.
+
+
+
+import grandcentral.signaler
+import grandcentral.storage
+
+
+import abc
+import asyncio
+import concurrent.futures
+import functools
+import itertools
+
+
+class AsyncBaseStorage:
+    @abc.abstractmethod
+    async def read(self, key):
+        raise NotImplementedError()
+
+    @abc.abstractmethod
+    async def read_many(self, keys):
+        # {key: value} of the keys that exist
+        raise NotImplementedError()
+
+    @abc.abstractmethod
+    async def latest_timestamp(self, key):
+        raise NotImplementedError()
+
+    @abc.abstractmethod
+    async def backlog_summary(self, key):
+        # (oldest timestamp, latest timestamp, number of records) of key
+        raise NotImplementedError()
+
+    @abc.abstractmethod
+    async def write(self, key, value, attachment=None):
+        raise NotImplementedError()
+
+    @abc.abstractmethod
+    async def write_many(self, messages):
+        raise NotImplementedError()
+
+    @abc.abstractmethod
+    async def backlog(self, key, limit=None, before=None, after=None):
+        # Returns a list of (timestamp, value) tuples, newest first
+        raise NotImplementedError()
+
+    @abc.abstractmethod
+    def range(self, key, start=None, end=None):
+        # Async iterator of (timestamp, value) tuples, oldest first
+        raise NotImplementedError()
+
+    @abc.abstractmethod
+    async def timeseries(self, key, start=None, end=None):
+        # Returns a (timestamps, values) tuple of lists
+        raise NotImplementedError()
+
+    @abc.abstractmethod
+    async def open_attachment(self, key, timestamp=None):
+        # Returns a (digest, AsyncFile-like object, size) tuple
+        raise NotImplementedError()
+
+    @abc.abstractmethod
+    async def wait(self, key, since, timeout=None):
+        # Returns True if key was written after since, False on timeout
+        raise NotImplementedError()
+
+
+class AsyncFile:
+    # Runs the blocking calls of a file object in an executor
+
+    def __init__(self, fh, executor=None):
+        self.fh = fh
+        self.executor = executor
+
+    async def _run(self, fn, *args):
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self.executor, fn, *args)
+
+    async def read(self, size=-1):
+        return await self._run(self.fh.read, size)
+
+    async def seek(self, offset):
+        return await self._run(self.fh.seek, offset)
+
+    def close(self):
+        self.fh.close()
+
+
+class ThreadPoolStorage(AsyncBaseStorage):
+    # Adapts a synchronous BaseStorage. Blocking calls run on a bounded pool
+    # of threads so the event loop is free to keep the rest of connections
+    # going.
+
+    RANGE_BATCH_SIZE = 500
+
+    def __init__(self, storage, max_workers=8):
+        if not isinstance(storage, grandcentral.storage.BaseStorage):
+            raise TypeError(storage)
+
+        self.storage = storage
+        if not isinstance(storage.signaler, grandcentral.signaler.Signaler):
+            storage.signaler = grandcentral.signaler.Signaler()
+        self.signaler = storage.signaler
+
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_workers)
+
+        # key -> set of futures of coroutines waiting in wait()
+        self._waiters = {}
+        self._loop = None
+
+    def close(self):
+        if self._loop is not None:
+            self.signaler.remove_listener(self._on_publish)
+            self._loop = None
+
+        self.executor.shutdown(wait=True)
+
+    async def _run(self, fn, *args, **kwargs):
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(
+            self.executor, functools.partial(fn, *args, **kwargs))
+
+    async def read(self, key):
+        return await self._run(self.storage.read, key)
+
+    async def read_many(self, keys):
+        return await self._run(self.storage.read_many, keys)
+
+    async def latest_timestamp(self, key):
+        return await self._run(self.storage.latest_timestamp, key)
+
+    async def backlog_summary(self, key):
+        return await self._run(self.storage.backlog_summary, key)
+
+    async def write(self, key, value, attachment=None):
+        return await self._run(self.storage.write, key, value, attachment)
+
+    async def write_many(self, messages):
+        return await self._run(self.storage.write_many, messages)
+
+    async def backlog(self, key, limit=None, before=None, after=None):
+        def _backlog():
+            return list(self.storage.backlog(
+                key, limit=limit, before=before, after=after))
+
+        return await self._run(_backlog)
+
+    async def range(self, key, start=None, end=None):
+        # One executor round trip per batch. Each batch is a range() call of
+        # its own, resuming after the last timestamp seen, so no storage
+        # iterator (or database session) is left open between batches or
+        # resumed from another thread
+        def _batch(after):
+            rows = self.storage.range(
+                key, start=start if after is None else after, end=end)
+            try:
+                new = rows if after is None else (
+                    row for row in rows if row[0] > after)
+                return list(itertools.islice(new, self.RANGE_BATCH_SIZE))
+
+            finally:
+                rows.close()
+
+        after = None
+        while True:
+            batch = await self._run(_batch, after)
+            for row in batch:
+                yield row
+
+            if len(batch) < self.RANGE_BATCH_SIZE:
+                return
+
+            after = batch[-1][0]
+
+    async def timeseries(self, key, start=None, end=None):
+        return await self._run(
+            self.storage.timeseries, key, start=start, end=end)
+
+    async def open_attachment(self, key, timestamp=None):
+        digest, fh, size = await self._run(
+            self.storage.open_attachment, key, timestamp=timestamp)
+        return (digest, AsyncFile(fh, self.executor), size)
+
+    async def wait(self, key, since, timeout=None):
+        if self._loop is None:
+            self._loop = asyncio.get_event_loop()
+            self.signaler.add_listener(self._on_publish)
+
+        deadline = None if timeout is None else self._loop.time() + timeout
+
+        while True:
+            latest = self.signaler.latest(key)
+            if latest is not None and latest > since:
+                return True
+
+            remaining = None
+            if deadline is not None:
+                remaining = deadline - self._loop.time()
+                if remaining <= 0:
+                    return False
+
+            fut = self._loop.create_future()
+            self._waiters.setdefault(key, set()).add(fut)
+            try:
+                await asyncio.wait_for(fut, remaining)
+            except asyncio.TimeoutError:
+                pass
+            finally:
+                waiters = self._waiters.get(key)
+                if waiters is not None:
+                    waiters.discard(fut)
+                    if not waiters:
+                        del self._waiters[key]
+
+    def _on_publish(self, key, timestamp):
+        # Called from whatever thread did the write
+        loop = self._loop
+        if loop is not None and not loop.is_closed():
+            loop.call_soon_threadsafe(self._wake, key)
+
+    def _wake(self, key):
+        for fut in self._waiters.get(key, ()):
+            if not fut.done():
+                fut.set_result(None)
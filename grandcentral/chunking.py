@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2017 Luis López <luis@cuarentaydos.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
+# USA.
+
+
+# Content-defined chunking. Boundaries are placed where a rolling (gear)
+# hash of the last bytes matches a mask, so an insertion or deletion only
+# changes the chunks around it and the rest keep their digests. See
+# FastCDC (Xia et al., 2016); normalized chunking is left out.
+
+
+import bisect
+import hashlib
+import itertools
+import random
+
+
+def _gear_table(seed):
+    rnd = random.Random(seed)
+    return tuple(rnd.getrandbits(32) for x in range(256))
+
+
+# Fixed seed, clients and servers must agree on boundaries to share chunks
+GEAR = _gear_table(0x67636463)
+
+
+class Chunker:
+    READ_SIZE = 64 * 1024
+
+    def __init__(self, avg_size=64 * 1024, min_size=None, max_size=None):
+        bits = avg_size.bit_length() - 1
+        if avg_size != 1 << bits:
+            raise ValueError('avg_size must be a power of two')
+
+        self.avg_size = avg_size
+        self.min_size = avg_size // 4 if min_size is None else min_size
+        self.max_size = avg_size * 4 if max_size is None else max_size
+
+        # The hash shifts left, high bits depend on more input bytes
+        self.mask = ((1 << bits) - 1) << (32 - bits)
+
+    def cut_point(self, data):
+        # Length of the first chunk of data, which holds at least max_size
+        # bytes unless it's the end of the input
+        n = min(len(data), self.max_size)
+        if n <= self.min_size:
+            return n
+
+        h = 0
+        mask = self.mask
+        gear = GEAR
+        # Bytes before min_size can't end a chunk, don't hash them
+        for (idx, byte) in enumerate(
+                memoryview(data)[self.min_size:n], self.min_size):
+            h = ((h << 1) + gear[byte]) & 0xffffffff
+            if not h & mask:
+                return idx + 1
+
+        return n
+
+    def split(self, fh):
+        # Yields the chunks of binary file object fh
+        buf = b''
+        eof = False
+
+        while True:
+            while not eof and len(buf) < self.max_size:
+                data = fh.read(self.READ_SIZE)
+                if data:
+                    buf += data
+                else:
+                    eof = True
+
+            if not buf:
+                return
+
+            cut = self.cut_point(buf)
+            yield buf[:cut]
+            buf = buf[cut:]
+
+    def manifest(self, fh):
+        # [(chunk digest, size)] and whole content digest of fh
+        sha1 = hashlib.sha1()
+        chunks = []
+        for chunk in self.split(fh):
+            sha1.update(chunk)
+            chunks.append((hashlib.sha1(chunk).hexdigest(), len(chunk)))
+
+        return chunks, sha1.hexdigest()
+
+
+class ChunkedReader:
+    # Read-only file object over the chunks of a manifest, loaded one at a
+    # time with load_chunk(digest)
+
+    def __init__(self, chunks, load_chunk):
+        self.chunks = chunks
+        self.load_chunk = load_chunk
+        self.size = sum(size for (digest, size) in chunks)
+
+        # Start offset of each chunk
+        self._offsets = [0] + list(
+            itertools.accumulate(size for (digest, size) in chunks))[:-1]
+        self._pos = 0
+        self._idx = None
+        self._data = b''
+
+    def read(self, size=-1):
+        if size < 0:
+            size = self.size - self._pos
+
+        parts = []
+        while size > 0 and self._pos < self.size:
+            idx = bisect.bisect_right(self._offsets, self._pos) - 1
+            if idx != self._idx:
+                self._data = self.load_chunk(self.chunks[idx][0])
+                self._idx = idx
+
+            start = self._pos - self._offsets[idx]
+            part = self._data[start:start + size]
+            parts.append(part)
+            self._pos += len(part)
+            size -= len(part)
+
+        return b''.join(parts)
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self._pos
+        elif whence == 2:
+            offset += self.size
+
+        self._pos = max(offset, 0)
+        return self._pos
+
+    def tell(self):
+        return self._pos
+
+    def close(self):
+        self._data = b''
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -19,11 +19,18 @@
 
 
 from grandcentral import asyncutils
+from grandcentral import cache
+from grandcentral import chunking
+from grandcentral import codecs
 
 
+import asyncio
 import io
+import itertools
 import json
 import pathlib
+import re
+import urllib.parse
 
 
 import aiohttp
@@ -31,66 +38,573 @@ import aiohttp
 
 class Client:
     MESSAGE_ENDPOINT = '/message'
-
-    def __init__(self, api_url):
+    CHANGES_ENDPOINT = '/changes'
+    ATTACHMENT_ENDPOINT = '/attachment'
+    EXPORT_ENDPOINT = '/export'
+    IMPORT_ENDPOINT = '/import'
+    CHUNKS_ENDPOINT = '/chunks'
+    IMPORT_BATCH_SIZE = 1000
+    READ_MANY_BATCH_SIZE = 1000
+    MAX_QUERY_LENGTH = 2000
+    CHUNK_SIZE = 64 * 1024
+    CHUNKED_WRITE_ATTEMPTS = 5
+    WATCH_TIMEOUT = 30
+    WATCH_RETRY_DELAY = 1
+    WATCH_MAX_RETRY_DELAY = 30
+
+    # Binary responses when the server (and this host) can do them, JSON
+    # otherwise
+    ACCEPT = (
+        'application/msgpack, application/json;q=0.5'
+        if codecs.MSGPACK is not None else 'application/json')
+
+    def __init__(self, api_url, limit_per_host=8, keepalive_timeout=30,
+                 read_cache_size=1024):
         self.api = api_url.rstrip('/')
+        self.limit_per_host = limit_per_host
+        self.keepalive_timeout = keepalive_timeout
+        self._sess = None
+
+        # key -> (etag, codec, response body) of previous reads, revalidated
+        # with If-None-Match. Bodies are decoded on every hit so callers get
+        # values of their own
+        self.read_cache = cache.LRUCache(maxsize=read_cache_size)
+
+    @property
+    def session(self):
+        # Session is created lazily so it gets bound to the running loop
+        if self._sess is None or self._sess.closed:
+            connector = aiohttp.TCPConnector(
+                limit_per_host=self.limit_per_host,
+                keepalive_timeout=self.keepalive_timeout)
+            self._sess = aiohttp.ClientSession(connector=connector)
+
+        return self._sess
+
+    async def close(self):
+        if self._sess is not None and not self._sess.closed:
+            await self._sess.close()
+
+        self._sess = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
 
     async def read(self, key):
+        headers = {'Accept': self.ACCEPT}
+        try:
+            etag, codec, body = self.read_cache.get(key)
+            headers['If-None-Match'] = etag
+        except KeyError:
+            pass
+
         resp = await self._request(
             'GET',
-            self.MESSAGE_ENDPOINT + '/{}'.format(key))
+            self.MESSAGE_ENDPOINT + '/{}'.format(key),
+            headers=headers)
+
+        try:
+            if resp.status == 304:
+                return codec.decode(body)['value']
+
+            elif resp.status == 200:
+                codec = codecs.CONTENT_TYPES.get(
+                    resp.content_type, codecs.JSON)
+                body = await resp.read()
+                if 'ETag' in resp.headers:
+                    self.read_cache.set(
+                        key, (resp.headers['ETag'], codec, body))
+                return codec.decode(body)['value']
+
+            elif resp.status == 404:
+                self.read_cache.discard(key)
+                raise KeyError(key)
+
+            else:
+                raise TypeError()
+
+        finally:
+            resp.release()
+
+    async def read_many(self, keys):
+        # Latest values of keys as a {key: value} dict, missing keys are
+        # left out. Key lists that don't fit a query string are POSTed
+        keys = list(keys)
+        ret = {}
+        for idx in range(0, len(keys), self.READ_MANY_BATCH_SIZE):
+            ret.update(await self._read_many(
+                keys[idx:idx + self.READ_MANY_BATCH_SIZE]))
+
+        return ret
+
+    async def _read_many(self, keys):
+        if not keys:
+            return {}
+
+        query = ','.join(keys)
+        if (len(query) > self.MAX_QUERY_LENGTH or
+                any(',' in key for key in keys)):
+            resp = await self._request(
+                'POST',
+                self.MESSAGE_ENDPOINT + '/batch/read',
+                json={'keys': keys},
+                headers={'Accept': self.ACCEPT})
 
-        if resp.status == 200:
-            doc = (await resp.json())
-            return doc['value']
+        else:
+            resp = await self._request(
+                'GET',
+                self.MESSAGE_ENDPOINT,
+                params={'keys': query},
+                headers={'Accept': self.ACCEPT})
+
+        try:
+            if resp.status != 200:
+                raise TypeError()
+
+            doc = await self._decode(resp)
+
+        finally:
+            resp.release()
+
+        return {x['key']: x['value'] for x in doc['messages']}
+
+    async def map_keys(self, fn, keys, concurrency=None):
+        # Awaits fn(key) for every key, at most concurrency (defaults to
+        # limit_per_host) at a time. Returns a {key: result} dict without
+        # the keys fn raised KeyError for
+        return await self._map_keys(fn, keys, concurrency)
+
+    async def _map_keys(self, fn, keys, concurrency):
+        # SyncClient overrides map_keys()
+        sem = asyncio.Semaphore(concurrency or self.limit_per_host)
+
+        async def _call(key):
+            async with sem:
+                try:
+                    return (key, await fn(key), True)
+                except KeyError:
+                    return (key, None, False)
+
+        results = await asyncio.gather(*[_call(key) for key in keys])
+        return {key: value for (key, value, found) in results if found}
+
+    async def backlog_many(self, keys, limit=None, before=None, after=None,
+                           concurrency=None):
+        # First backlog page of every key, see map_keys()
+        async def _page(key):
+            page, next_before = await self._backlog_page(
+                key, limit=limit, before=before, after=after)
+            return page
+
+        return await self._map_keys(_page, keys, concurrency)
+
+    async def backlog(self, key, limit=None, before=None, after=None):
+        page, next_before = await self._backlog_page(
+            key, limit=limit, before=before, after=after)
+        return page
+
+    async def iter_backlog(self, key, page_size=None, before=None,
+                           after=None):
+        # Walks the whole backlog of key lazily, one page per request
+        while True:
+            page, before = await self._backlog_page(
+                key, limit=page_size, before=before, after=after)
+
+            for x in page:
+                yield x
+
+            if before is None:
+                return
+
+    async def _backlog_page(self, key, limit=None, before=None, after=None):
+        params = {}
+        if limit is not None:
+            params['limit'] = limit
+        if before is not None:
+            params['before'] = repr(before)
+        if after is not None:
+            params['after'] = repr(after)
 
-        elif resp.status == 404:
-            raise KeyError(key)
+        resp = await self._request(
+            'GET',
+            self.MESSAGE_ENDPOINT + '/{}/backlog'.format(key),
+            params=params,
+            headers={'Accept': self.ACCEPT})
+
+        try:
+            if resp.status == 200:
+                page = await self._decode(resp)
+
+            elif resp.status == 404:
+                raise KeyError(key)
+
+            else:
+                raise TypeError()
+
+        finally:
+            resp.release()
+
+        # Server sends a 'next' link with the cursor for the following page
+        # only when there is one
+        next_before = None
+        m = re.search(r'<([^>]*)>;\s*rel="?next"?', resp.headers.get('Link', ''))
+        if m:
+            query = urllib.parse.urlsplit(m.group(1)).query
+            next_before = float(urllib.parse.parse_qs(query)['before'][0])
+
+        return page, next_before
+
+    async def watch(self, key, since=None):
+        # Yields backlog-like documents for each new value of key using
+        # long-polling. Connection errors are retried with backoff and the
+        # watch resumes from the last timestamp seen, so nothing is lost.
+        delay = self.WATCH_RETRY_DELAY
+
+        # Pin the cursor up front, otherwise writes between two polls could
+        # be missed
+        if since is None:
+            since = await self._latest_timestamp(key)
+
+        while True:
+            params = {'timeout': self.WATCH_TIMEOUT, 'since': repr(since)}
+
+            try:
+                resp = await self._request(
+                    'GET',
+                    self.MESSAGE_ENDPOINT + '/{}/watch'.format(key),
+                    params=params)
+
+                try:
+                    if resp.status == 200:
+                        changes = await resp.json()
+                    elif resp.status == 204:
+                        changes = []
+                    else:
+                        raise TypeError()
+
+                finally:
+                    resp.release()
+
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, self.WATCH_MAX_RETRY_DELAY)
+                continue
+
+            delay = self.WATCH_RETRY_DELAY
+
+            for x in changes:
+                since = x['timestamp']
+                yield x
+
+    async def _latest_timestamp(self, key):
+        try:
+            page = await self.backlog(key, limit=1)
+        except KeyError:
+            page = []
+
+        return page[0]['timestamp'] if page else float('-inf')
+
+    async def read_attachment(self, key, dest, timestamp=None):
+        params = {}
+        if timestamp is not None:
+            params['timestamp'] = repr(timestamp)
 
-        else:
-            raise TypeError()
+        resp = await self._request(
+            'GET',
+            self.MESSAGE_ENDPOINT + '/{}/attachment'.format(key),
+            params=params)
+
+        try:
+            if resp.status == 404:
+                raise KeyError(key)
+
+            elif resp.status != 200:
+                raise TypeError()
+
+            if isinstance(dest, pathlib.Path):
+                with dest.open('wb') as fh:
+                    await self._copy_content(resp, fh)
+
+            else:
+                await self._copy_content(resp, dest)
 
-    async def backlog(self, key):
+        finally:
+            resp.release()
+
+    async def read_attachment_by_digest(self, digest, dest):
         resp = await self._request(
             'GET',
-            self.MESSAGE_ENDPOINT + '/{}/backlog'.format(key))
+            self.ATTACHMENT_ENDPOINT + '/{}'.format(digest))
 
-        if resp.status == 200:
-            return await resp.json()
+        try:
+            if resp.status == 404:
+                raise KeyError(digest)
 
-        elif resp.status == 404:
-            raise KeyError(key)
+            elif resp.status != 200:
+                raise TypeError()
 
-        else:
-            raise TypeError()
+            await self._copy_content(resp, dest)
+
+        finally:
+            resp.release()
+
+    async def changes(self, since=0, limit=None):
+        # One batch of the server's change feed, oldest first
+        params = {'since': since}
+        if limit is not None:
+            params['limit'] = limit
+
+        resp = await self._request(
+            'GET', self.CHANGES_ENDPOINT, params=params)
+
+        try:
+            if resp.status != 200:
+                raise TypeError()
+
+            body = await resp.read()
+
+        finally:
+            resp.release()
+
+        return [
+            json.loads(line.decode('utf-8'))
+            for line in body.splitlines()
+            if line.strip()
+        ]
+
+    async def export(self, dest, prefix=None, start=None, end=None):
+        # Copies the server's NDJSON export into the binary file object
+        # dest as it arrives
+        params = {}
+        if prefix is not None:
+            params['prefix'] = prefix
+        if start is not None:
+            params['from'] = repr(start)
+        if end is not None:
+            params['to'] = repr(end)
+
+        resp = await self._request(
+            'GET', self.EXPORT_ENDPOINT, params=params)
+
+        try:
+            if resp.status != 200:
+                raise TypeError()
+
+            await self._copy_content(resp, dest)
+
+        finally:
+            resp.release()
+
+    async def import_records(self, src):
+        # Sends the NDJSON export read from the binary file object src,
+        # IMPORT_BATCH_SIZE lines per request. Returns the records sent
+        count = 0
+        while True:
+            lines = list(itertools.islice(src, self.IMPORT_BATCH_SIZE))
+            if not lines:
+                return count
+
+            resp = await self._request(
+                'POST', self.IMPORT_ENDPOINT,
+                data=b''.join(lines),
+                headers={'Content-Type': 'application/x-ndjson'})
+
+            try:
+                if resp.status != 200:
+                    raise TypeError()
+
+                count += (await resp.json())['records']
+
+            finally:
+                resp.release()
+
+    async def _copy_content(self, resp, fh):
+        while True:
+            chunk = await resp.content.read(self.CHUNK_SIZE)
+            if not chunk:
+                break
+
+            fh.write(chunk)
 
     async def write(self, key, value, attachment=None):
         req_kwargs = self._build_request_arguments(key, value, attachment)
         resp = await self._request('POST', self.MESSAGE_ENDPOINT, **req_kwargs)
 
-        if resp.status == 204:
-            resp.close()
-            return
+        try:
+            if resp.status == 204:
+                return
 
-        elif resp.status == 404:
-            raise KeyError(key)
+            elif resp.status == 404:
+                raise KeyError(key)
 
-        else:
-            raise TypeError()
+            else:
+                raise TypeError()
+
+        finally:
+            resp.release()
+
+    async def write_chunked(self, key, value, attachment, chunker=None):
+        # Same as write() but the attachment (bytes, pathlib.Path or a
+        # seekable binary file object) is split into content-defined chunks
+        # and only those the server doesn't have are uploaded. Returns the
+        # number of attachment bytes sent
+        if isinstance(attachment, (bytes, bytearray, memoryview)):
+            attachment = io.BytesIO(attachment)
+        elif isinstance(attachment, pathlib.Path):
+            with attachment.open('rb') as fh:
+                return await self._write_chunked(key, value, fh, chunker)
+
+        return await self._write_chunked(key, value, attachment, chunker)
+
+    async def _write_chunked(self, key, value, attachment, chunker):
+        # SyncClient overrides write_chunked()
+        chunker = chunker or chunking.Chunker()
+        start = attachment.tell()
+        chunks, dummy = await asyncio.get_event_loop().run_in_executor(
+            None, chunker.manifest, attachment)
+
+        offsets = {}
+        offset = start
+        for (digest, size) in chunks:
+            offsets.setdefault(digest, (offset, size))
+            offset += size
+
+        sent = 0
+        missing = await self._missing_chunks(list(offsets))
+
+        # Chunks can be collected between requests (server side they're
+        # unreferenced until the POST). Asking for missing chunks again
+        # after an upload restarts the grace period of the stored ones right
+        # before the POST, and whatever went missing is sent again
+        for attempt in range(self.CHUNKED_WRITE_ATTEMPTS):
+            if missing:
+                sent += await self._upload_chunks(attachment, offsets, missing)
+                missing = await self._missing_chunks(list(offsets))
+                if missing:
+                    continue
+
+            resp = await self._request(
+                'POST', self.MESSAGE_ENDPOINT,
+                json={'key': key, 'value': value, 'chunks': chunks})
+            try:
+                if resp.status == 204:
+                    return sent
+
+                elif resp.status == 409:
+                    missing = (await resp.json())['missing']
+
+                else:
+                    raise TypeError()
+
+            finally:
+                resp.release()
+
+        raise TypeError()
+
+    async def _missing_chunks(self, digests):
+        resp = await self._request(
+            'POST', self.CHUNKS_ENDPOINT + '/missing',
+            json={'digests': digests})
+
+        try:
+            if resp.status != 200:
+                raise TypeError()
+
+            return (await resp.json())['missing']
+
+        finally:
+            resp.release()
+
+    async def _upload_chunks(self, fh, offsets, digests):
+        async def _put(digest):
+            # Read before awaiting, uploads share fh
+            (offset, size) = offsets[digest]
+            fh.seek(offset)
+            data = fh.read(size)
+
+            resp = await self._request(
+                'PUT', self.CHUNKS_ENDPOINT + '/{}'.format(digest),
+                data=data,
+                headers={'Content-Type': 'application/octet-stream'})
+            try:
+                if resp.status != 204:
+                    raise TypeError()
+
+            finally:
+                resp.release()
+
+            return size
+
+        sizes = await self._map_keys(_put, digests, None)
+        return sum(sizes.values())
+
+    async def write_many(self, messages):
+        payload = [
+            {'key': key, 'value': value}
+            for (key, value) in messages
+        ]
+        resp = await self._request(
+            'POST',
+            self.MESSAGE_ENDPOINT + '/batch',
+            json=payload)
+
+        try:
+            if resp.status == 204:
+                return
+
+            else:
+                raise TypeError()
+
+        finally:
+            resp.release()
 
     async def query(self, key, min=None, max=None):
+        return [x async for x in self.iter_range(key, start=min, end=max)]
+
+    async def iter_range(self, key, start=None, end=None):
+        # Values of key with start <= timestamp < end, oldest first. The
+        # NDJSON response is decoded line by line as it arrives
+        params = {}
+        if start is not None:
+            params['from'] = repr(start)
+        if end is not None:
+            params['to'] = repr(end)
+
         resp = await self._request(
             'GET',
-            self.MESSAGE_ENDPOINT,
-            params='key={}'.format(key))
+            self.MESSAGE_ENDPOINT + '/{}/range'.format(key),
+            params=params)
 
-        return (await resp.json())
+        try:
+            if resp.status == 404:
+                raise KeyError(key)
+
+            elif resp.status != 200:
+                raise TypeError()
+
+            while True:
+                line = await resp.content.readline()
+                if not line:
+                    break
+
+                if line.strip():
+                    yield json.loads(line.decode('utf-8'))
+
+        finally:
+            resp.release()
+
+    async def _decode(self, resp):
+        codec = codecs.CONTENT_TYPES.get(resp.content_type, codecs.JSON)
+        return codec.decode(await resp.read())
 
     async def _request(self, method, path, *args, **kwargs):
+        # Callers must release() the response so the connection goes back
+        # to the pool
         url = self.api + path
-        async with aiohttp.ClientSession() as sess:
-            async with sess.request(method, url, *args, **kwargs) as resp:
-                return resp
+        return await self.session.request(method, url, *args, **kwargs)
 
     def _build_request_arguments(self, key, value, attachment=None):
         json_data = {
@@ -101,12 +615,9 @@ class Client:
         if attachment is None:
             return dict(json=json_data)
 
+        # File objects are streamed by aiohttp in chunks and closed once sent
         elif isinstance(attachment, pathlib.Path):
-            with attachment.open('rb') as fh:
-                attachment = fh.read()
-
-        elif isinstance(attachment, (io.BufferedIOBase, io.TextIOBase)):
-            attachment = attachment.read()
+            attachment = attachment.open('rb')
 
         with aiohttp.MultipartWriter('form-data') as payload:
             payload.append(json.dumps(json_data), {
@@ -122,21 +633,79 @@ class Client:
 
 
 class SyncClient(Client):
-    @asyncutils.sync
-    async def read(self, key):
-        return (await super().read(key))
+    # Reuses one event loop (and thus one pooled session) across calls
+    # instead of spinning a new one per call
 
-    @asyncutils.sync
-    async def backlog(self, key):
-        return (await super().backlog(key))
+    def __init__(self, *args, loop=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._owns_loop = loop is None
+        self.loop = loop or asyncio.new_event_loop()
 
-    @asyncutils.sync
-    async def write(self, key, value, attachment=None):
-        return (await super().write(key, value, attachment))
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def _run(self, coro):
+        return asyncutils.wait_for(coro, loop=self.loop)
+
+    def close(self):
+        if self.loop.is_closed():
+            return
+
+        self._run(super().close())
+        if self._owns_loop:
+            self.loop.close()
+
+    def read(self, key):
+        return self._run(super().read(key))
+
+    def read_many(self, keys):
+        return self._run(super().read_many(keys))
+
+    def backlog(self, key, limit=None, before=None, after=None):
+        return self._run(super().backlog(
+            key, limit=limit, before=before, after=after))
+
+    def backlog_many(self, keys, limit=None, before=None, after=None,
+                     concurrency=None):
+        return self._run(super().backlog_many(
+            keys, limit=limit, before=before, after=after,
+            concurrency=concurrency))
+
+    def map_keys(self, fn, keys, concurrency=None):
+        # fn is still a coroutine function
+        return self._run(super().map_keys(fn, keys, concurrency=concurrency))
+
+    def read_attachment(self, key, dest, timestamp=None):
+        return self._run(super().read_attachment(key, dest, timestamp))
+
+    def read_attachment_by_digest(self, digest, dest):
+        return self._run(super().read_attachment_by_digest(digest, dest))
+
+    def changes(self, since=0, limit=None):
+        return self._run(super().changes(since=since, limit=limit))
+
+    def export(self, dest, prefix=None, start=None, end=None):
+        return self._run(super().export(
+            dest, prefix=prefix, start=start, end=end))
+
+    def import_records(self, src):
+        return self._run(super().import_records(src))
+
+    def write(self, key, value, attachment=None):
+        return self._run(super().write(key, value, attachment))
 
-    @asyncutils.sync
-    async def query(self, key):
-        return (await super().query(key))
+    def write_chunked(self, key, value, attachment, chunker=None):
+        return self._run(super().write_chunked(
+            key, value, attachment, chunker=chunker))
+
+    def write_many(self, messages):
+        return self._run(super().write_many(messages))
+
+    def query(self, key, min=None, max=None):
+        return self._run(super().query(key, min=min, max=max))
 
 
 def main():
@@ -156,12 +725,38 @@ def main():
     parser.add_argument(
         '--attachment',
         help='Attach file to key')
+    parser.add_argument(
+        '--chunked',
+        action='store_true',
+        help='Upload the attachment in chunks, skipping the ones the server '
+             'already has')
     parser.add_argument(
         '--backlog',
         action='store_true',
         help='Show backlog for a key')
+    parser.add_argument(
+        '--export',
+        action='store_true',
+        help='Write every record as NDJSON to stdout, key is an optional '
+             'prefix')
+    parser.add_argument(
+        '--import',
+        dest='import_',
+        action='store_true',
+        help='Read NDJSON records (as written by --export) from stdin')
+    parser.add_argument(
+        '--from',
+        dest='start',
+        type=float,
+        help='Export records since this timestamp')
+    parser.add_argument(
+        '--to',
+        dest='end',
+        type=float,
+        help='Export records before this timestamp')
     parser.add_argument(
         dest='key',
+        nargs='?',
         help='Destination key')
     parser.add_argument(
         dest='value',
@@ -170,6 +765,20 @@ def main():
 
     args = parser.parse_args(sys.argv[1:])
 
+    if args.export and args.import_:
+        raise ValueError("export and import is not a valid operation")
+
+    if (args.export or args.import_) and (args.value or args.attachment or
+                                          args.backlog):
+        msg = "export or import and other operations is not valid"
+        raise ValueError(msg)
+
+    if args.import_ and args.key:
+        raise ValueError("import doesn't take a key")
+
+    if not (args.export or args.import_) and not args.key:
+        parser.error('key is required')
+
     if args.backlog and (args.value or args.attachment):
         msg = "backlog and value or attachments is not a valid operation"
         raise ValueError(msg)
@@ -178,10 +787,29 @@ def main():
         msg = "attachment needs a value"
         raise ValueError(msg)
 
-    client = SyncClient(args.url)
+    if args.chunked and not args.attachment:
+        raise ValueError("chunked needs an attachment")
+
+    with SyncClient(args.url) as client:
+        _main(client, args)
+
+
+def _main(client, args):
+    import sys
+
+    # Mode: export
+    if args.export:
+        client.export(sys.stdout.buffer, prefix=args.key, start=args.start,
+                      end=args.end)
+        sys.stdout.buffer.flush()
+
+    # Mode: import
+    elif args.import_:
+        n = client.import_records(sys.stdin.buffer)
+        print('{} records imported'.format(n), file=sys.stderr)
 
     # Mode: backlog
-    if args.backlog:
+    elif args.backlog:
         for x in client.backlog(args.key):
             value = x['message']['value']
             if args.json:
@@ -205,6 +833,11 @@ def main():
         if args.attachment:
             args.attachment = pathlib.Path(args.attachment)
 
+        if args.attachment and args.chunked:
+            n = client.write_chunked(args.key, args.value, args.attachment)
+            print('{} attachment bytes sent'.format(n), file=sys.stderr)
+            return
+
         client.write(
             args.key,
             args.value,
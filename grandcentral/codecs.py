@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2017 Luis López <luis@cuarentaydos.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
+# USA.
+
+
+from grandcentral import compression
+
+
+import json
+
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+class JSONCodec:
+    name = 'json'
+    id = 0
+    content_type = 'application/json'
+
+    def encode(self, value):
+        return json.dumps(value).encode('utf-8')
+
+    def decode(self, data):
+        return json.loads(data)
+
+    def envelope(self, fields):
+        # Encodes a dict whose values are already encoded with this codec,
+        # without decoding them again
+        return (
+            b'{' +
+            b', '.join(
+                json.dumps(name).encode('utf-8') + b': ' + data
+                for (name, data) in fields.items()) +
+            b'}')
+
+    def array(self, items):
+        return b'[' + b', '.join(items) + b']'
+
+
+class MsgpackCodec:
+    name = 'msgpack'
+    id = 1
+    content_type = 'application/msgpack'
+
+    def encode(self, value):
+        return msgpack.packb(value, use_bin_type=True)
+
+    def decode(self, data):
+        return msgpack.unpackb(data, raw=False)
+
+    def envelope(self, fields):
+        return (
+            self._header(len(fields), 0x80, 0xde) +
+            b''.join(
+                self.encode(name) + data
+                for (name, data) in fields.items()))
+
+    def array(self, items):
+        return self._header(len(items), 0x90, 0xdc) + b''.join(items)
+
+    def _header(self, n, fix, prefix16):
+        # fixmap/fixarray or their 16/32 bit length variants
+        if n < 16:
+            return bytes([fix | n])
+        elif n < 0x10000:
+            return bytes([prefix16]) + n.to_bytes(2, 'big')
+        else:
+            return bytes([prefix16 + 1]) + n.to_bytes(4, 'big')
+
+
+JSON = JSONCodec()
+MSGPACK = MsgpackCodec() if msgpack is not None else None
+
+CODECS = {JSON.name: JSON}
+if MSGPACK is not None:
+    CODECS[MSGPACK.name] = MSGPACK
+
+# Also accepted in Accept headers
+CONTENT_TYPES = {JSON.content_type: JSON}
+if MSGPACK is not None:
+    CONTENT_TYPES[MSGPACK.content_type] = MSGPACK
+    CONTENT_TYPES['application/x-msgpack'] = MSGPACK
+
+
+def default_codec():
+    # Codec used by storages to keep values
+    return MSGPACK or JSON
+
+
+def get_codec(name):
+    try:
+        return CODECS[name]
+    except KeyError as e:
+        raise ValueError('Unknown codec: {}'.format(name)) from e
+
+
+BY_ID = {x.id: x for x in CODECS.values()}
+
+
+# Stored values. SQLite keeps JSON values as TEXT and binary ones as BLOB,
+# so the column type tells which codec wrote each row and databases written
+# before values were binary keep working.
+#
+# Compressed values are BLOBs starting with 0xc1, a byte msgpack never
+# uses, followed by the codec id, the compression id and the compressed
+# encoded value.
+
+COMPRESSED_MARKER = 0xc1
+
+
+def encode_stored(codec, value, compression=None, threshold=0):
+    try:
+        data = codec.encode(value)
+    except (OverflowError, TypeError):
+        # msgpack can't hold every JSON value (ie. integers over 64 bits).
+        # Rows tell which codec wrote them, those go in as JSON
+        if codec is JSON:
+            raise
+
+        codec = JSON
+        data = codec.encode(value)
+
+    if compression is not None and len(data) >= threshold:
+        return (bytes([COMPRESSED_MARKER, codec.id, compression.id]) +
+                compression.compress(data))
+
+    return data.decode('utf-8') if codec is JSON else data
+
+
+def decode_stored(stored):
+    codec, data = stored_bytes(stored)
+    return codec.decode(data)
+
+
+def stored_bytes(stored):
+    # (codec, encoded bytes) of a stored value
+    if isinstance(stored, str):
+        return JSON, stored.encode('utf-8')
+
+    if stored[0] == COMPRESSED_MARKER:
+        codec = BY_ID[stored[1]]
+        return codec, compression.BY_ID[stored[2]].decompress(stored[3:])
+
+    return MSGPACK, stored
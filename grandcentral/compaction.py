@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2017 Luis López <luis@cuarentaydos.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
+# USA.
+
+
+import collections
+import logging
+import threading
+import time
+
+
+_logger = logging.getLogger(__name__)
+
+
+RetentionPolicy = collections.namedtuple(
+    'RetentionPolicy', ['prefix', 'keep_last', 'max_age'])
+RetentionPolicy.__new__.__defaults__ = (None, None)
+
+
+class Compactor:
+    # Applies retention policies to a storage. A policy whose prefix equals
+    # the key wins, otherwise the longest matching prefix does. Keys without
+    # a matching policy are left alone ('' matches every key).
+
+    def __init__(self, storage, policies, interval=60, batch_size=1000):
+        self.storage = storage
+        self.policies = sorted(policies, key=lambda x: len(x.prefix),
+                               reverse=True)
+        self.interval = interval
+        self.batch_size = batch_size
+        self.last_report = None
+
+        self._stop = threading.Event()
+        self._thread = None
+
+    def policy_for(self, key):
+        for policy in self.policies:
+            if policy.prefix == key:
+                return policy
+
+        for policy in self.policies:
+            if key.startswith(policy.prefix):
+                return policy
+
+        return None
+
+    def run_once(self):
+        t0 = time.monotonic()
+        report = {'keys': 0, 'rows': 0, 'attachments': 0, 'bytes': 0,
+                  'vacuum_bytes': 0}
+        digests = set()
+
+        # Materialize the key list, expire() writes to the same storage
+        for key in list(self.storage.keys()):
+            policy = self.policy_for(key)
+            if policy is None:
+                continue
+
+            if policy.keep_last is None and policy.max_age is None:
+                continue
+
+            expired = 0
+            while not self._stop.is_set():
+                (n, batch_digests) = self.storage.expire(
+                    key, keep_last=policy.keep_last,
+                    max_age=policy.max_age, limit=self.batch_size)
+                expired += n
+                digests.update(batch_digests)
+                if n < self.batch_size:
+                    break
+
+            if expired:
+                report['keys'] += 1
+                report['rows'] += expired
+
+        # Even without new digests, attachments a previous run skipped for
+        # being within the grace period are retried
+        (files, size) = self.storage.collect_attachments(digests)
+        report['attachments'] = files
+        report['bytes'] = size
+
+        if report['rows']:
+            report['vacuum_bytes'] = self.storage.vacuum()
+
+        report['elapsed'] = time.monotonic() - t0
+        self.last_report = report
+
+        _logger.info(
+            "compaction: {rows} rows from {keys} keys, {attachments} "
+            "attachments ({bytes} bytes), {vacuum_bytes} bytes "
+            "vacuumed".format(**report))
+
+        return report
+
+    def start(self):
+        if self._thread is not None:
+            return
+
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._run, name='grandcentral-compactor', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.run_once()
+            except Exception:
+                _logger.exception("compaction run failed")
+
+            self._stop.wait(self.interval)
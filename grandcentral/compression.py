@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2017 Luis López <luis@cuarentaydos.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
+# USA.
+
+
+import struct
+import zlib
+
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+class GzipCompression:
+    # gzip framing (not bare zlib) so stored data can be sent as is with
+    # Content-Encoding: gzip
+    name = 'gzip'
+    id = 1
+    suffix = '.gz'
+
+    # ISIZE, the trailer's uncompressed size, is only 32 bits
+    MAX_SIZE = 0xffffffff
+
+    def __init__(self, level=6):
+        self.level = level
+
+    def compressobj(self):
+        return zlib.compressobj(self.level, zlib.DEFLATED, 31)
+
+    def decompressobj(self):
+        return zlib.decompressobj(31)
+
+    def compress(self, data):
+        obj = self.compressobj()
+        return obj.compress(data) + obj.flush()
+
+    def decompress(self, data):
+        return zlib.decompress(data, 31)
+
+    def copy_stream(self, src, dst, size, chunk_size=64 * 1024):
+        obj = self.compressobj()
+        for chunk in iter(lambda: src.read(chunk_size), b''):
+            dst.write(obj.compress(chunk))
+        dst.write(obj.flush())
+
+    def uncompressed_size(self, fh):
+        fh.seek(-4, 2)
+        (size,) = struct.unpack('<I', fh.read(4))
+        fh.seek(0)
+        return size
+
+
+class ZstdCompression:
+    name = 'zstd'
+    id = 2
+    suffix = '.zst'
+    MAX_SIZE = None
+
+    def __init__(self, level=3):
+        self.level = level
+
+    def compressobj(self):
+        return zstandard.ZstdCompressor(level=self.level).compressobj()
+
+    def decompressobj(self):
+        return zstandard.ZstdDecompressor().decompressobj()
+
+    def compress(self, data):
+        return zstandard.ZstdCompressor(level=self.level).compress(data)
+
+    def decompress(self, data):
+        # Frames from compressobj() don't record their size, so go through
+        # the streaming decoder
+        return self.decompressobj().decompress(data)
+
+    def copy_stream(self, src, dst, size, chunk_size=64 * 1024):
+        # The known size ends up in the frame header for uncompressed_size()
+        zstandard.ZstdCompressor(level=self.level).copy_stream(
+            src, dst, size=size, read_size=chunk_size, write_size=chunk_size)
+
+    def uncompressed_size(self, fh):
+        header = fh.read(zstandard.FRAME_HEADER_SIZE_MAX)
+        fh.seek(0)
+        return zstandard.frame_content_size(header)
+
+
+GZIP = GzipCompression()
+ZSTD = ZstdCompression() if zstandard is not None else None
+
+COMPRESSIONS = {GZIP.name: GZIP}
+if ZSTD is not None:
+    COMPRESSIONS[ZSTD.name] = ZSTD
+
+BY_ID = {x.id: x for x in COMPRESSIONS.values()}
+
+
+def get_compression(name):
+    try:
+        return COMPRESSIONS[name]
+    except KeyError as e:
+        raise ValueError('Unknown compression: {}'.format(name)) from e
+
+
+def negotiate(accept_encoding, available=None):
+    # Best available compression for an Accept-Encoding header, or None for
+    # identity. Ties go to the first one in available
+    if not accept_encoding:
+        return None
+
+    if available is None:
+        available = list(COMPRESSIONS.values())
+
+    weights = {}
+    for item in accept_encoding.split(','):
+        coding, dummy, params = item.strip().partition(';')
+        q = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        weights[coding.strip().lower()] = q
+
+    best, best_q = None, 0.0
+    for compression in available:
+        q = weights.get(compression.name, weights.get('*', 0.0))
+        if q > best_q:
+            best, best_q = compression, q
+
+    return best
+
+
+class DecompressingReader:
+    # Read-only file object decompressing fh on the fly. Seeking forwards
+    # reads and drops data, seeking backwards starts over
+    CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, fh, compression):
+        self.fh = fh
+        self.compression = compression
+        self._restart()
+
+    def _restart(self):
+        self.fh.seek(0)
+        self._obj = self.compression.decompressobj()
+        self._buffer = b''
+        self._pos = 0
+
+    def read(self, size=-1):
+        while size < 0 or len(self._buffer) < size:
+            chunk = self.fh.read(self.CHUNK_SIZE)
+            if not chunk:
+                break
+            self._buffer += self._obj.decompress(chunk)
+
+        if size < 0:
+            size = len(self._buffer)
+
+        ret, self._buffer = self._buffer[:size], self._buffer[size:]
+        self._pos += len(ret)
+        return ret
+
+    def seek(self, offset, whence=0):
+        if whence != 0:
+            raise ValueError('only absolute seeks are supported')
+
+        if offset < self._pos:
+            self._restart()
+
+        while self._pos < offset:
+            if not self.read(min(self.CHUNK_SIZE, offset - self._pos)):
+                break
+
+        return self._pos
+
+    def tell(self):
+        return self._pos
+
+    def close(self):
+        self.fh.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
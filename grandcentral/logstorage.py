@@ -0,0 +1,525 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2017 Luis López <luis@cuarentaydos.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
+# USA.
+
+
+import grandcentral.storage
+from grandcentral import codecs
+
+
+import bisect
+import collections
+import hashlib
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+from os import path
+
+
+# Segment record: body length, crc32 of everything after the crc, timestamp,
+# key length. Followed by the key and the JSON encoded value
+RECORD_HEADER = struct.Struct('<IIdH')
+
+# Index file: magic, entry count, key length, then the key. Entries follow
+# at INDEX_HEADER_SIZE + key length
+INDEX_MAGIC = b'GCIX'
+INDEX_HEADER = struct.Struct('<4sQH')
+
+# Index entry: timestamp, segment number, record offset, record size
+INDEX_ENTRY = struct.Struct('<dIQI')
+
+
+class CorruptRecord(Exception):
+    pass
+
+
+def _encode_record(key, ts, value):
+    key = key.encode('utf-8')
+    body = key + json.dumps(value).encode('utf-8')
+    head = struct.pack('<dH', ts, len(key))
+    crc = zlib.crc32(body, zlib.crc32(head))
+
+    return RECORD_HEADER.pack(len(body), crc, ts, len(key)) + body
+
+
+def _decode_record(buf):
+    (ts, value) = _raw_record(buf)
+    return ts, json.loads(value)
+
+
+def _raw_record(buf):
+    # Timestamp and JSON encoded value of a record
+    (length, crc, ts, key_len) = RECORD_HEADER.unpack_from(buf)
+    return ts, buf[RECORD_HEADER.size + key_len:RECORD_HEADER.size + length]
+
+
+class _Index:
+    # Memory mapped, append-only array of INDEX_ENTRY for one key. The file
+    # is grown in GROW_ENTRIES steps so appends are plain writes into the
+    # map. Indexing yields timestamps so bisect works on it directly.
+
+    GROW_ENTRIES = 1024
+
+    def __init__(self, filepath, key=None):
+        if key is not None and not path.exists(filepath):
+            encoded = key.encode('utf-8')
+            with open(filepath, 'wb') as fh:
+                fh.write(INDEX_HEADER.pack(INDEX_MAGIC, 0, len(encoded)))
+                fh.write(encoded)
+                fh.truncate(INDEX_HEADER.size + len(encoded) +
+                            self.GROW_ENTRIES * INDEX_ENTRY.size)
+
+        self.filepath = filepath
+        with open(filepath, 'r+b') as fh:
+            self._mm = mmap.mmap(fh.fileno(), 0)
+
+        (magic, self._count, key_len) = INDEX_HEADER.unpack_from(self._mm)
+        if magic != INDEX_MAGIC:
+            raise CorruptRecord(filepath)
+
+        self.key = bytes(self._mm[INDEX_HEADER.size:
+                                  INDEX_HEADER.size + key_len]).decode('utf-8')
+        self._base = INDEX_HEADER.size + key_len
+
+    @staticmethod
+    def read_key(filepath):
+        with open(filepath, 'rb') as fh:
+            (magic, count, key_len) = INDEX_HEADER.unpack(
+                fh.read(INDEX_HEADER.size))
+            if magic != INDEX_MAGIC:
+                raise CorruptRecord(filepath)
+
+            return fh.read(key_len).decode('utf-8')
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, idx):
+        if idx < 0:
+            idx += self._count
+        return INDEX_ENTRY.unpack_from(
+            self._mm, self._base + idx * INDEX_ENTRY.size)[0]
+
+    def entry(self, idx):
+        if idx < 0:
+            idx += self._count
+        return INDEX_ENTRY.unpack_from(
+            self._mm, self._base + idx * INDEX_ENTRY.size)
+
+    def entries(self, lo, hi):
+        return [self.entry(idx) for idx in range(lo, hi)]
+
+    def append(self, ts, segment, offset, size):
+        end = self._base + (self._count + 1) * INDEX_ENTRY.size
+        if end > len(self._mm):
+            self._mm.resize(len(self._mm) +
+                            self.GROW_ENTRIES * INDEX_ENTRY.size)
+
+        INDEX_ENTRY.pack_into(
+            self._mm, self._base + self._count * INDEX_ENTRY.size,
+            ts, segment, offset, size)
+        self._set_count(self._count + 1)
+
+    def truncate(self, count):
+        self._set_count(min(count, self._count))
+
+    def drop(self, n):
+        # Removes the n oldest entries
+        n = min(n, self._count)
+        start = self._base + n * INDEX_ENTRY.size
+        size = (self._count - n) * INDEX_ENTRY.size
+        self._mm.move(self._base, start, size)
+        self._set_count(self._count - n)
+
+    def _set_count(self, count):
+        self._count = count
+        struct.pack_into('<Q', self._mm, len(INDEX_MAGIC), count)
+
+    def flush(self):
+        self._mm.flush()
+
+    def close(self):
+        self._mm.flush()
+        self._mm.close()
+
+
+class LogStorage(grandcentral.storage.BaseStorage):
+    # Append-only storage. Records go to numbered segment files under
+    # segments/, the active one is rolled once it grows over segment_size.
+    # Each key has an index file under index/ mapping timestamps to record
+    # locations, memory mapped so lookups and bisects don't copy or parse
+    # anything. Records are fetched with a single pread() each.
+    #
+    # Indexes are written after their records and only sealed segments are
+    # synced, so on startup the active segment is scanned: a torn tail is
+    # truncated away and records missing from the indexes are re-added.
+
+    SEGMENT_NAME = '{:08d}.log'
+
+    def __init__(self, storage_path=None, segment_size=64 * 1024 * 1024,
+                 fsync=False, max_open_indexes=256):
+        if storage_path is None:
+            storage_path = path.realpath(__file__)
+            storage_path = path.dirname(storage_path)
+            storage_path = path.dirname(storage_path)
+            storage_path = storage_path + '/data/log/'
+
+        self.segment_size = segment_size
+        self.fsync = fsync
+        self.max_open_indexes = max_open_indexes
+
+        self._segments_path = path.join(storage_path, 'segments')
+        self._index_path = path.join(storage_path, 'index')
+        os.makedirs(self._segments_path, exist_ok=True)
+        os.makedirs(self._index_path, exist_ok=True)
+
+        self._lock = threading.RLock()
+
+        # segment number -> read-only fd
+        self._segment_fds = {}
+
+        # key -> open _Index, least recently used first
+        self._indexes = collections.OrderedDict()
+
+        # All stored keys
+        self._keys = set()
+        for name in os.listdir(self._index_path):
+            if name.endswith('.idx'):
+                self._keys.add(
+                    _Index.read_key(path.join(self._index_path, name)))
+
+        segments = sorted(
+            int(x[:-4]) for x in os.listdir(self._segments_path)
+            if x.endswith('.log'))
+        for segment in segments:
+            self._segment_fds[segment] = os.open(
+                self._segment_filepath(segment), os.O_RDONLY)
+
+        self._active = segments[-1] if segments else 0
+        self._active_fd = os.open(
+            self._segment_filepath(self._active),
+            os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        if self._active not in self._segment_fds:
+            self._segment_fds[self._active] = os.open(
+                self._segment_filepath(self._active), os.O_RDONLY)
+
+        self._active_size = 0
+        self._recover()
+
+    def _segment_filepath(self, segment):
+        return path.join(self._segments_path, self.SEGMENT_NAME.format(segment))
+
+    def _index_filepath(self, key):
+        digest = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        return path.join(self._index_path, digest + '.idx')
+
+    def _recover(self):
+        with open(self._segment_filepath(self._active), 'rb') as fh:
+            data = fh.read()
+
+        offset = 0
+        records = []
+        while offset + RECORD_HEADER.size <= len(data):
+            (length, crc, ts, key_len) = RECORD_HEADER.unpack_from(data, offset)
+            size = RECORD_HEADER.size + length
+            if offset + size > len(data) or key_len > length:
+                break
+
+            body = data[offset + RECORD_HEADER.size:offset + size]
+            head = struct.pack('<dH', ts, key_len)
+            if zlib.crc32(body, zlib.crc32(head)) != crc:
+                break
+
+            records.append(
+                (body[:key_len].decode('utf-8'), ts, offset, size))
+            offset += size
+
+        if offset < len(data):
+            os.truncate(self._segment_filepath(self._active), offset)
+        self._active_size = offset
+
+        for (key, ts, record_offset, size) in records:
+            index = self._index(key, create=True)
+            if len(index) and index.entry(-1)[1:3] >= (self._active,
+                                                       record_offset):
+                continue
+            index.append(ts, self._active, record_offset, size)
+
+    def _index(self, key, create=False):
+        # Must be called with the lock held
+        try:
+            index = self._indexes[key]
+            self._indexes.move_to_end(key)
+            return index
+        except KeyError:
+            pass
+
+        if key not in self._keys and not create:
+            raise KeyError(key)
+
+        index = _Index(self._index_filepath(key), key=key)
+        self._keys.add(key)
+
+        # Drop entries pointing past the end of the log, their records were
+        # lost in a crash
+        end = (self._active, self._active_size)
+        count = len(index)
+        while count and index.entry(count - 1)[1:3] >= end:
+            count -= 1
+        index.truncate(count)
+
+        self._indexes[key] = index
+        while len(self._indexes) > self.max_open_indexes:
+            self._indexes.popitem(last=False)[1].close()
+
+        return index
+
+    def close(self):
+        with self._lock:
+            if self._active_fd is None:
+                return
+
+            for index in self._indexes.values():
+                index.close()
+            self._indexes.clear()
+
+            if self.fsync:
+                os.fsync(self._active_fd)
+            os.close(self._active_fd)
+            self._active_fd = None
+
+            for fd in self._segment_fds.values():
+                os.close(fd)
+            self._segment_fds.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'keys': len(self._keys),
+                'segments': len(self._segment_fds),
+                'active_segment': self._active,
+                'active_segment_size': self._active_size,
+                'open_indexes': len(self._indexes)
+            }
+
+    def _append(self, messages):
+        # Must be called with the lock held. All records go out in a single
+        # write() and are indexed afterwards
+        buf = bytearray()
+        located = []
+        last = {}
+        for (key, value) in messages:
+            index = self._index(key, create=True)
+
+            # Keep timestamps strictly increasing so they can be used as
+            # cursors
+            prev = last.get(key, index[-1] if len(index) else None)
+            ts = time.time()
+            if prev is not None and ts <= prev:
+                ts = prev + 1e-6
+            last[key] = ts
+
+            record = _encode_record(key, ts, value)
+            located.append((key, ts, self._active_size + len(buf), len(record)))
+            buf += record
+
+        os.write(self._active_fd, buf)
+        if self.fsync:
+            os.fsync(self._active_fd)
+        self._active_size += len(buf)
+
+        for (key, ts, offset, size) in located:
+            self._index(key, create=True).append(ts, self._active, offset, size)
+
+        if self._active_size >= self.segment_size:
+            self._roll()
+
+        return [(key, ts) for (key, ts, offset, size) in located]
+
+    def _roll(self):
+        # Seal the active segment: everything indexed so far is synced so
+        # recovery only ever needs to look at the new one
+        os.fsync(self._active_fd)
+        for index in self._indexes.values():
+            index.flush()
+        os.close(self._active_fd)
+
+        self._active += 1
+        self._active_size = 0
+        self._active_fd = os.open(
+            self._segment_filepath(self._active),
+            os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        self._segment_fds[self._active] = os.open(
+            self._segment_filepath(self._active), os.O_RDONLY)
+
+    def _pread(self, entry):
+        (ts, segment, offset, size) = entry
+        return os.pread(self._segment_fds[segment], size, offset)
+
+    def read(self, key):
+        with self._lock:
+            index = self._index(key)
+            if not len(index):
+                raise KeyError(key)
+            buf = self._pread(index.entry(-1))
+
+        return _decode_record(buf)[1]
+
+    def latest_timestamp(self, key):
+        with self._lock:
+            index = self._index(key)
+            if not len(index):
+                raise KeyError(key)
+
+            return index[-1]
+
+    def backlog_summary(self, key):
+        with self._lock:
+            index = self._index(key)
+            if not len(index):
+                raise KeyError(key)
+
+            return (index[0], index[-1], len(index))
+
+    def read_raw(self, key):
+        with self._lock:
+            index = self._index(key)
+            if not len(index):
+                raise KeyError(key)
+            buf = self._pread(index.entry(-1))
+
+        return (codecs.JSON, _raw_record(buf)[1])
+
+    def write(self, key, value, attachment=None):
+        if attachment is not None:
+            raise NotImplementedError()
+
+        with self._lock:
+            ((key, ts),) = self._append([(key, value)])
+
+        self._notify(key, ts)
+
+    def write_many(self, messages):
+        with self._lock:
+            written = self._append(messages)
+
+        for (key, ts) in written:
+            self._notify(key, ts)
+
+    def _slice(self, key, lo_ts, hi_ts, after=None, limit=None):
+        # Raw records of key in [lo_ts, hi_ts) (or (after, hi_ts)), oldest
+        # first
+        with self._lock:
+            index = self._index(key)
+            if after is not None:
+                lo = bisect.bisect_right(index, after)
+            else:
+                lo = 0 if lo_ts is None else bisect.bisect_left(index, lo_ts)
+            hi = len(index) if hi_ts is None else bisect.bisect_left(index, hi_ts)
+            if limit is not None:
+                lo = max(lo, hi - limit)
+
+            return [self._pread(x) for x in index.entries(lo, hi)]
+
+    def backlog(self, key, limit=None, before=None, after=None):
+        bufs = self._slice(key, None, before, after=after, limit=limit)
+        for buf in reversed(bufs):
+            yield _decode_record(buf)
+
+    def backlog_raw(self, key, limit=None, before=None, after=None):
+        bufs = self._slice(key, None, before, after=after, limit=limit)
+        for buf in reversed(bufs):
+            (ts, data) = _raw_record(buf)
+            yield (ts, codecs.JSON, data)
+
+    def range(self, key, start=None, end=None):
+        for buf in self._slice(key, start, end):
+            yield _decode_record(buf)
+
+    def timeseries(self, key, start=None, end=None):
+        timestamps, values = [], []
+        for buf in self._slice(key, start, end):
+            (ts, value) = _decode_record(buf)
+            timestamps.append(ts)
+            values.append(value)
+
+        return timestamps, values
+
+    def open_attachment(self, key, timestamp=None):
+        # Attachments are not supported, so there is never one to open
+        raise KeyError(key)
+
+    def keys(self, prefix=None):
+        with self._lock:
+            keys = sorted(self._keys)
+
+        for key in keys:
+            if prefix is None or key.startswith(prefix):
+                yield key
+
+    def expire(self, key, keep_last=None, max_age=None, limit=1000):
+        # Records are only dropped from the index, vacuum() deletes the
+        # segments nothing points to anymore
+        with self._lock:
+            try:
+                index = self._index(key)
+            except KeyError:
+                return (0, set())
+
+            def _nth_newest(n):
+                if n > len(index):
+                    raise IndexError(n)
+                return index[len(index) - n]
+
+            cutoff = grandcentral.storage._expire_cutoff(
+                index[-1], keep_last, max_age, _nth_newest)
+            n = min(bisect.bisect_left(index, cutoff), limit)
+            if n:
+                newest = index[n - 1]
+                index.drop(n)
+
+        if n:
+            self._notify_expired(key, newest)
+
+        return (n, set())
+
+    def vacuum(self, pages=None):
+        # Deletes sealed segments older than the oldest one still referenced
+        # by any index. Returns reclaimed bytes
+        with self._lock:
+            oldest = self._active
+            for key in self._keys:
+                index = self._index(key)
+                if len(index):
+                    oldest = min(oldest, index.entry(0)[1])
+
+            reclaimed = 0
+            for segment in sorted(self._segment_fds):
+                if segment >= oldest:
+                    break
+
+                filepath = self._segment_filepath(segment)
+                reclaimed += os.stat(filepath).st_size
+                os.close(self._segment_fds.pop(segment))
+                os.unlink(filepath)
+
+        return reclaimed
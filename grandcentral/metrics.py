@@ -0,0 +1,436 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2017 Luis López <luis@cuarentaydos.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
+# USA.
+
+
+import grandcentral.storage
+
+
+import bisect
+import time
+
+
+import falcon
+
+
+# Counters are updated without locks. Under the GIL an increment can very
+# rarely be lost when two threads race on the same bucket, which is fine
+# for monitoring and keeps the hot path to a bisect and two additions.
+
+LATENCY_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+    1.0, 2.5, 5.0, 10.0)
+
+SIZE_BUCKETS = (
+    64, 256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        # Last slot is +Inf
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def cumulative(self):
+        # (upper bound, count of observations <= bound) pairs
+        total = 0
+        for (bound, count) in zip(self.buckets + (float('inf'),),
+                                  self.counts):
+            total += count
+            yield (bound, total)
+
+
+class RouteStats:
+    def __init__(self):
+        self.statuses = {}
+        self.latency = Histogram(LATENCY_BUCKETS)
+        self.request_size = Histogram(SIZE_BUCKETS)
+        self.response_size = Histogram(SIZE_BUCKETS)
+
+
+class StorageStats:
+    def __init__(self):
+        self.latency = Histogram(LATENCY_BUCKETS)
+        self.errors = 0
+        self.rows = 0
+        self.attachment_bytes = 0
+
+
+class Metrics:
+    PREFIX = 'grandcentral_'
+
+    def __init__(self):
+        self.routes = {}
+        self.storage = {}
+
+    def route(self, method, route):
+        try:
+            return self.routes[(method, route)]
+        except KeyError:
+            return self.routes.setdefault((method, route), RouteStats())
+
+    def storage_op(self, op):
+        try:
+            return self.storage[op]
+        except KeyError:
+            return self.storage.setdefault(op, StorageStats())
+
+    def observe_request(self, method, route, status, elapsed,
+                        request_size=None, response_size=None):
+        stats = self.route(method, route)
+        stats.statuses[status] = stats.statuses.get(status, 0) + 1
+        stats.latency.observe(elapsed)
+        if request_size is not None:
+            stats.request_size.observe(request_size)
+        if response_size is not None:
+            stats.response_size.observe(response_size)
+
+    def observe_storage(self, op, elapsed, rows=0, attachment_bytes=0,
+                        error=False):
+        stats = self.storage_op(op)
+        stats.latency.observe(elapsed)
+        stats.rows += rows
+        stats.attachment_bytes += attachment_bytes
+        if error:
+            stats.errors += 1
+
+    def render(self):
+        # Prometheus text exposition format (version 0.0.4)
+        lines = []
+
+        def header(name, typ, doc):
+            lines.append('# HELP {}{} {}'.format(self.PREFIX, name, doc))
+            lines.append('# TYPE {}{} {}'.format(self.PREFIX, name, typ))
+
+        def sample(name, labels, value):
+            lines.append('{}{}{{{}}} {}'.format(
+                self.PREFIX, name,
+                ','.join('{}="{}"'.format(k, _escape(v))
+                         for (k, v) in labels),
+                _format_value(value)))
+
+        def histogram(name, labels, hist):
+            for (bound, count) in hist.cumulative():
+                sample(name + '_bucket', labels + [('le', bound)], count)
+            sample(name + '_sum', labels, hist.sum)
+            sample(name + '_count', labels, sum(hist.counts))
+
+        routes = sorted(self.routes.items())
+        storage = sorted(self.storage.items())
+
+        header('http_requests_total', 'counter',
+               'HTTP requests by route and status')
+        for ((method, route), stats) in routes:
+            for (status, count) in sorted(stats.statuses.items()):
+                sample('http_requests_total',
+                       [('method', method), ('route', route),
+                        ('status', status)],
+                       count)
+
+        for (name, attr, doc) in (
+                ('http_request_duration_seconds', 'latency',
+                 'Time spent handling HTTP requests'),
+                ('http_request_size_bytes', 'request_size',
+                 'HTTP request body sizes'),
+                ('http_response_size_bytes', 'response_size',
+                 'HTTP response body sizes, streams excluded')):
+            header(name, 'histogram', doc)
+            for ((method, route), stats) in routes:
+                histogram(name, [('method', method), ('route', route)],
+                          getattr(stats, attr))
+
+        header('storage_operation_duration_seconds', 'histogram',
+               'Time spent in storage operations')
+        for (op, stats) in storage:
+            histogram('storage_operation_duration_seconds', [('op', op)],
+                      stats.latency)
+
+        for (name, attr, doc) in (
+                ('storage_errors_total', 'errors',
+                 'Storage operations ending in an exception'),
+                ('storage_rows_total', 'rows',
+                 'Rows read or written by storage operations'),
+                ('storage_attachment_bytes_total', 'attachment_bytes',
+                 'Attachment bytes written or opened for reading')):
+            header(name, 'counter', doc)
+            for (op, stats) in storage:
+                sample(name, [('op', op)], getattr(stats, attr))
+
+        return '\n'.join(lines) + '\n'
+
+
+def _escape(value):
+    if isinstance(value, float):
+        return _format_value(value)
+
+    return str(value).replace('\\', r'\\').replace(
+        '"', r'\"').replace('\n', r'\n')
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+
+    return repr(value)
+
+
+class MetricsMiddleware:
+    # Outermost middleware, so sizes are the ones on the wire. Streamed
+    # responses are timed until the handler returns, not until the last
+    # chunk is sent
+
+    def __init__(self, metrics):
+        self.metrics = metrics
+
+    def process_request(self, req, resp):
+        req.context.metrics_start = time.perf_counter()
+
+    def process_response(self, req, resp, resource, req_succeeded):
+        start = getattr(req.context, 'metrics_start', None)
+        if start is None:
+            return
+
+        if resp.data is not None:
+            response_size = len(resp.data)
+        elif resp.body is not None:
+            response_size = len(resp.body.encode('utf-8'))
+        elif resp.stream is None:
+            response_size = 0
+        else:
+            response_size = None
+
+        self.metrics.observe_request(
+            req.method, req.uri_template or 'unmatched',
+            int(resp.status[:3]), time.perf_counter() - start,
+            request_size=req.content_length or 0,
+            response_size=response_size)
+
+
+class MetricsResource:
+    CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+    def __init__(self, metrics):
+        self.metrics = metrics
+
+    def on_get(self, req, resp):
+        resp.status = falcon.HTTP_200
+        resp.content_type = self.CONTENT_TYPE
+        resp.body = self.metrics.render()
+
+
+def _attachment_size(attachment):
+    if attachment is None:
+        return 0
+
+    if isinstance(attachment, (bytes, bytearray, memoryview)):
+        return len(attachment)
+
+    # File objects, measured without consuming them
+    try:
+        pos = attachment.tell()
+        size = attachment.seek(0, 2) - pos
+        attachment.seek(pos)
+    except (AttributeError, OSError, ValueError):
+        return 0
+
+    return size
+
+
+class InstrumentedStorage(grandcentral.storage.BaseStorage):
+    # Times the operations of another storage. Anything not wrapped here
+    # goes straight to it
+
+    def __init__(self, storage, metrics):
+        self.storage = storage
+        self.metrics = metrics
+
+    def __getattr__(self, name):
+        return getattr(self.storage, name)
+
+    @property
+    def signaler(self):
+        return self.storage.signaler
+
+    @signaler.setter
+    def signaler(self, value):
+        self.storage.signaler = value
+
+    # Missing keys (KeyError) are answers, not errors
+
+    def _call(self, op, fn, *args, rows=1, attachment_bytes=0, **kwargs):
+        start = time.perf_counter()
+        done, error = False, False
+        try:
+            ret = fn(*args, **kwargs)
+            done = True
+            return ret
+
+        except KeyError:
+            raise
+
+        except BaseException:
+            error = True
+            raise
+
+        finally:
+            self.metrics.observe_storage(
+                op, time.perf_counter() - start,
+                rows=rows if done else 0,
+                attachment_bytes=attachment_bytes if done else 0,
+                error=error)
+
+    def _iter(self, op, rows):
+        # Only time spent producing rows counts, not the consumer's
+        elapsed, n, error = 0, 0, False
+        it = iter(rows)
+        try:
+            while True:
+                start = time.perf_counter()
+                try:
+                    row = next(it)
+                except StopIteration:
+                    break
+                except KeyError:
+                    raise
+                except BaseException:
+                    error = True
+                    raise
+                finally:
+                    elapsed += time.perf_counter() - start
+
+                n += 1
+                yield row
+
+        finally:
+            # Consumers stopping early release the storage's iterator too
+            if hasattr(it, 'close'):
+                it.close()
+            self.metrics.observe_storage(op, elapsed, rows=n, error=error)
+
+    def read(self, key):
+        return self._call('read', self.storage.read, key)
+
+    def read_raw(self, key):
+        return self._call('read', self.storage.read_raw, key)
+
+    def read_many(self, keys):
+        ret = self._call('read_many', self.storage.read_many, keys, rows=0)
+        self.metrics.storage_op('read_many').rows += len(ret)
+        return ret
+
+    def write(self, key, value, attachment=None):
+        return self._call(
+            'write', self.storage.write, key, value, attachment,
+            attachment_bytes=_attachment_size(attachment))
+
+    def write_many(self, messages):
+        messages = list(messages)
+        return self._call('write', self.storage.write_many, messages,
+                          rows=len(messages))
+
+    def backlog(self, key, limit=None, before=None, after=None):
+        return self._iter('backlog', self.storage.backlog(
+            key, limit=limit, before=before, after=after))
+
+    def backlog_raw(self, key, limit=None, before=None, after=None):
+        return self._iter('backlog', self.storage.backlog_raw(
+            key, limit=limit, before=before, after=after))
+
+    def range(self, key, start=None, end=None):
+        return self._iter(
+            'range', self.storage.range(key, start=start, end=end))
+
+    def timeseries(self, key, start=None, end=None):
+        timestamps, values = self._call(
+            'range', self.storage.timeseries, key, start=start, end=end,
+            rows=0)
+        self.metrics.storage_op('range').rows += len(timestamps)
+        return timestamps, values
+
+    def open_attachment(self, key, timestamp=None):
+        ret = self._call('open_attachment', self.storage.open_attachment,
+                         key, timestamp=timestamp, rows=0)
+        self.metrics.storage_op('open_attachment').attachment_bytes += ret[2]
+        return ret
+
+    def open_attachment_encoded(self, key, timestamp=None):
+        ret = self._call(
+            'open_attachment', self.storage.open_attachment_encoded,
+            key, timestamp=timestamp, rows=0)
+        self.metrics.storage_op('open_attachment').attachment_bytes += ret[2]
+        return ret
+
+    def open_attachment_by_digest(self, digest):
+        ret = self._call(
+            'open_attachment', self.storage.open_attachment_by_digest,
+            digest, rows=0)
+        self.metrics.storage_op('open_attachment').attachment_bytes += ret[1]
+        return ret
+
+    def latest_timestamp(self, key):
+        return self._call('latest_timestamp', self.storage.latest_timestamp,
+                          key, rows=0)
+
+    def backlog_summary(self, key):
+        return self._call('backlog_summary', self.storage.backlog_summary,
+                          key, rows=0)
+
+    def changes(self, since=0, limit=None):
+        return self._iter(
+            'changes', self.storage.changes(since=since, limit=limit))
+
+    def keys(self, prefix=None):
+        return self.storage.keys(prefix=prefix)
+
+    def export(self, prefix=None, start=None, end=None):
+        return self._iter('export', self.storage.export(
+            prefix=prefix, start=start, end=end))
+
+    def import_records(self, records):
+        records = list(records)
+        return self._call('import', self.storage.import_records, records,
+                          rows=len(records))
+
+    def missing_chunks(self, digests):
+        return self.storage.missing_chunks(digests)
+
+    def store_chunk(self, digest, data):
+        return self._call('store_chunk', self.storage.store_chunk, digest,
+                          data, attachment_bytes=len(data))
+
+    def write_chunked(self, key, value, chunks):
+        return self._call('write', self.storage.write_chunked, key, value,
+                          chunks)
+
+    def expire(self, key, keep_last=None, max_age=None, limit=1000):
+        return self.storage.expire(
+            key, keep_last=keep_last, max_age=max_age, limit=limit)
+
+    def collect_attachments(self, digests):
+        return self.storage.collect_attachments(digests)
+
+    def vacuum(self, pages=None):
+        return self.storage.vacuum(pages=pages)
+
+    def close(self):
+        self.storage.close()
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2017 Luis López <luis@cuarentaydos.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
+# USA.
+
+
+from grandcentral import client
+
+
+import logging
+import tempfile
+import threading
+
+
+_logger = logging.getLogger(__name__)
+
+
+class Follower:
+    # Tails the change feed of a primary server and applies it to a local
+    # storage, in batches of batch_size. Attachments not present locally
+    # are fetched by digest before the records referencing them are
+    # applied. The local storage must not take writes from anywhere else,
+    # serve it with API(storage, read_only=True).
+
+    SPOOL_SIZE = 1024 * 1024
+
+    def __init__(self, storage, primary_url, batch_size=500, interval=1.0):
+        self.storage = storage
+        self.batch_size = batch_size
+        self.interval = interval
+        self.client = client.SyncClient(primary_url)
+
+        self._stop = threading.Event()
+        self._thread = None
+
+    def sync_once(self):
+        # Applies the next batch, returns the number of changes applied
+        since = self.storage.last_seq()
+        docs = self.client.changes(since=since, limit=self.batch_size)
+
+        changes = []
+        for doc in docs:
+            digest = doc['attachment']
+            if digest is not None and not self.storage.has_attachment(digest):
+                self._fetch_attachment(digest)
+
+            changes.append((
+                doc['seq'], doc['message']['key'], doc['timestamp'],
+                doc['message']['value'], digest))
+
+        self.storage.apply_changes(changes)
+        return len(changes)
+
+    def _fetch_attachment(self, digest):
+        with tempfile.SpooledTemporaryFile(max_size=self.SPOOL_SIZE) as fh:
+            self.client.read_attachment_by_digest(digest, fh)
+            fh.seek(0)
+            self.storage.import_attachment(digest, fh)
+
+    def start(self):
+        if self._thread is not None:
+            return
+
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._run, name='grandcentral-follower', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+        self.client.close()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                n = self.sync_once()
+            except Exception:
+                _logger.exception("sync with primary failed")
+                n = 0
+
+            # Full batches mean the follower is behind, keep going
+            if n < self.batch_size:
+                self._stop.wait(self.interval)
@@ -0,0 +1,257 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2017 Luis López <luis@cuarentaydos.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
+# USA.
+
+
+import grandcentral.storage
+
+
+import array
+import bisect
+import collections
+import sys
+import threading
+import time
+
+
+class _Ring:
+    # Fixed capacity buffer of (timestamp, value) records. Timestamps live in
+    # a packed array of doubles, values in a parallel list. Physical slots
+    # grow up to capacity and then wrap, overwriting the oldest record.
+    # Indexing yields timestamps in logical (oldest first) order so bisect
+    # can be used on the ring directly.
+
+    __slots__ = ('capacity', 'timestamps', 'values', 'start', 'size')
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.timestamps = array.array('d')
+        self.values = []
+        self.start = 0
+
+        # Estimated bytes held by this ring
+        self.size = 0
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def __getitem__(self, idx):
+        return self.timestamps[(self.start + idx) % len(self.timestamps)]
+
+    def value(self, idx):
+        return self.values[(self.start + idx) % len(self.values)]
+
+    def last(self):
+        return self.value(len(self) - 1)
+
+    def append(self, ts, value):
+        vsize = sys.getsizeof(value)
+
+        if len(self.timestamps) < self.capacity:
+            self.timestamps.append(ts)
+            self.values.append(value)
+            self.size += self.timestamps.itemsize + vsize
+        else:
+            self.size += vsize - sys.getsizeof(self.values[self.start])
+            self.timestamps[self.start] = ts
+            self.values[self.start] = value
+            self.start = (self.start + 1) % self.capacity
+
+    def drop(self, n):
+        # Removes the n oldest records
+        keep = range(n, len(self))
+        self.timestamps = array.array('d', (self[idx] for idx in keep))
+        self.values = [self.value(idx) for idx in keep]
+        self.start = 0
+        self.size = (self.timestamps.itemsize * len(self.timestamps) +
+                     sum(sys.getsizeof(x) for x in self.values))
+
+    def slice(self, lo, hi):
+        return ([self[idx] for idx in range(lo, hi)],
+                [self.value(idx) for idx in range(lo, hi)])
+
+
+class RingStorage(grandcentral.storage.BaseStorage):
+    # Bounded in-memory storage for high-rate ephemeral keys. Each key keeps
+    # its last `capacity` records. When the estimated size of all keys goes
+    # over `memory_budget` bytes the least recently used keys are dropped
+    # entirely (the key being written is never evicted).
+
+    KEY_OVERHEAD = 256
+
+    def __init__(self, capacity=1024, memory_budget=64 * 1024 * 1024):
+        if capacity < 1:
+            raise ValueError(capacity)
+
+        self.capacity = capacity
+        self.memory_budget = memory_budget
+        self.evictions = 0
+
+        # key -> _Ring, least recently used first
+        self._rings = collections.OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'keys': len(self._rings),
+                'bytes': self._size,
+                'memory_budget': self.memory_budget,
+                'evictions': self.evictions
+            }
+
+    def _get(self, key):
+        # Must be called with the lock held
+        ring = self._rings[key]
+        self._rings.move_to_end(key)
+        return ring
+
+    def read(self, key):
+        with self._lock:
+            return self._get(key).last()
+
+    def latest_timestamp(self, key):
+        with self._lock:
+            return self._get(key)[-1]
+
+    def backlog_summary(self, key):
+        with self._lock:
+            ring = self._get(key)
+            return (ring[0], ring[-1], len(ring))
+
+    def write(self, key, value, attachment=None):
+        if attachment is not None:
+            raise NotImplementedError()
+
+        with self._lock:
+            ts = self._append(key, value)
+            self._evict(key)
+
+        self._notify(key, ts)
+
+    def write_many(self, messages):
+        written = []
+        with self._lock:
+            for (key, value) in messages:
+                written.append((key, self._append(key, value)))
+                self._evict(key)
+
+        for (key, ts) in written:
+            self._notify(key, ts)
+
+    def _append(self, key, value):
+        try:
+            ring = self._get(key)
+        except KeyError:
+            ring = self._rings[key] = _Ring(self.capacity)
+            self._size += self.KEY_OVERHEAD + sys.getsizeof(key)
+
+        # Keep timestamps strictly increasing so they can be used as cursors
+        ts = time.time()
+        if len(ring) and ts <= ring[-1]:
+            ts = ring[-1] + 1e-6
+
+        self._size -= ring.size
+        ring.append(ts, value)
+        self._size += ring.size
+
+        return ts
+
+    def _evict(self, keep):
+        if self.memory_budget is None:
+            return
+
+        while self._size > self.memory_budget and len(self._rings) > 1:
+            key = next(iter(self._rings))
+            if key == keep:
+                self._rings.move_to_end(key)
+                continue
+
+            self._drop_key(key)
+            self.evictions += 1
+
+    def _drop_key(self, key):
+        ring = self._rings.pop(key)
+        self._size -= ring.size + self.KEY_OVERHEAD + sys.getsizeof(key)
+
+    def _slice(self, key, start, end):
+        with self._lock:
+            ring = self._get(key)
+            lo = 0 if start is None else bisect.bisect_left(ring, start)
+            hi = len(ring) if end is None else bisect.bisect_left(ring, end)
+
+            return ring.slice(lo, hi)
+
+    def backlog(self, key, limit=None, before=None, after=None):
+        with self._lock:
+            ring = self._get(key)
+            lo = 0 if after is None else bisect.bisect_right(ring, after)
+            hi = (len(ring) if before is None
+                  else bisect.bisect_left(ring, before))
+            if limit is not None:
+                lo = max(lo, hi - limit)
+
+            timestamps, values = ring.slice(lo, hi)
+
+        yield from zip(reversed(timestamps), reversed(values))
+
+    def range(self, key, start=None, end=None):
+        timestamps, values = self._slice(key, start, end)
+        yield from zip(timestamps, values)
+
+    def timeseries(self, key, start=None, end=None):
+        return self._slice(key, start, end)
+
+    def open_attachment(self, key, timestamp=None):
+        # Attachments are not supported, so there is never one to open
+        raise KeyError(key)
+
+    def keys(self, prefix=None):
+        with self._lock:
+            keys = sorted(self._rings)
+
+        for key in keys:
+            if prefix is None or key.startswith(prefix):
+                yield key
+
+    def expire(self, key, keep_last=None, max_age=None, limit=1000):
+        with self._lock:
+            try:
+                ring = self._rings[key]
+            except KeyError:
+                return (0, set())
+
+            def _nth_newest(n):
+                if n > len(ring):
+                    raise IndexError(n)
+                return ring[len(ring) - n]
+
+            cutoff = grandcentral.storage._expire_cutoff(
+                ring[-1], keep_last, max_age, _nth_newest)
+            n = min(bisect.bisect_left(ring, cutoff), limit)
+            if n:
+                newest = ring[n - 1]
+                self._size -= ring.size
+                ring.drop(n)
+                self._size += ring.size
+
+        if n:
+            self._notify_expired(key, newest)
+
+        return (n, set())
@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2017 Luis López <luis@cuarentaydos.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
+# USA.
+
+
+
+from grandcentral import cache
+
+
+import collections
+import itertools
+import math
+import numbers
+import threading
+
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+AGGREGATIONS = ('mean', 'min', 'max', 'last', 'count')
+
+
+def downsample(timestamps, values, bucket, agg='mean'):
+    # timestamps must be sorted. Buckets are aligned to multiples of bucket
+    # and returned as (bucket start, aggregated value) pairs
+    if agg not in AGGREGATIONS:
+        raise ValueError(agg)
+
+    if bucket <= 0:
+        raise ValueError(bucket)
+
+    if not all(isinstance(x, numbers.Real) and not isinstance(x, bool)
+               for x in values):
+        raise TypeError('values must be numbers')
+
+    if not timestamps:
+        return []
+
+    if numpy is not None:
+        return _downsample_numpy(timestamps, values, bucket, agg)
+    else:
+        return _downsample_python(timestamps, values, bucket, agg)
+
+
+def _downsample_numpy(timestamps, values, bucket, agg):
+    ts = numpy.asarray(timestamps, dtype=numpy.float64)
+    vals = numpy.asarray(values, dtype=numpy.float64)
+
+    # Since timestamps are sorted, each bucket is a contiguous slice
+    idx = numpy.floor(ts / bucket)
+    starts = numpy.concatenate(
+        ([0], numpy.flatnonzero(numpy.diff(idx)) + 1))
+    counts = numpy.diff(numpy.append(starts, len(ts)))
+
+    if agg == 'mean':
+        res = numpy.add.reduceat(vals, starts) / counts
+    elif agg == 'min':
+        res = numpy.minimum.reduceat(vals, starts)
+    elif agg == 'max':
+        res = numpy.maximum.reduceat(vals, starts)
+    elif agg == 'last':
+        res = vals[starts + counts - 1]
+    else:
+        res = counts
+
+    return list(zip((idx[starts] * bucket).tolist(), res.tolist()))
+
+
+def _downsample_python(timestamps, values, bucket, agg):
+    ret = []
+
+    rows = zip(timestamps, values)
+    for (b, group) in itertools.groupby(
+            rows, key=lambda x: math.floor(x[0] / bucket)):
+        group = [x[1] for x in group]
+
+        if agg == 'mean':
+            res = sum(group) / len(group)
+        elif agg == 'min':
+            res = min(group)
+        elif agg == 'max':
+            res = max(group)
+        elif agg == 'last':
+            res = group[-1]
+        else:
+            res = len(group)
+
+        ret.append((float(b * bucket), res))
+
+    return ret
+
+
+class SeriesCache:
+    # Downsampled series keyed by (key, bucket, agg, start, end). A write to
+    # key drops the entries whose window contains the written timestamp.
+
+    def __init__(self, signaler, maxsize=256, max_generations=10000):
+        self._cache = cache.LRUCache(maxsize=maxsize)
+        self._lock = threading.Lock()
+
+        # key -> set of cache keys, may contain already evicted entries.
+        # Pruned once it holds more keys than the cache can
+        self._windows = {}
+
+        # key -> counter value of its last invalidation, for the
+        # max_generations keys invalidated last. Computations capture it
+        # before reading from storage and are only cached if it didn't
+        # move. Forgotten keys report the newest value forgotten, which is
+        # never lower than what they had
+        self.max_generations = max_generations
+        self._generations = collections.OrderedDict()
+        self._counter = 0
+        self._forgotten = 0
+
+        signaler.add_listener(self.invalidate)
+        signaler.add_expire_listener(self.invalidate_expired)
+
+    def generation(self, key):
+        with self._lock:
+            return self._generations.get(key, self._forgotten)
+
+    def get(self, key, bucket, agg, start, end):
+        return self._cache.get((key, bucket, agg, start, end))
+
+    def set(self, key, bucket, agg, start, end, points, generation):
+        cache_key = (key, bucket, agg, start, end)
+        with self._lock:
+            if self._generations.get(key, self._forgotten) != generation:
+                return
+
+            self._windows.setdefault(key, set()).add(cache_key)
+            self._cache.set(cache_key, points)
+
+            if len(self._windows) > 2 * self._cache.maxsize:
+                self._prune_windows()
+
+    def _prune_windows(self):
+        for key in list(self._windows):
+            windows = set(x for x in self._windows[key] if x in self._cache)
+            if windows:
+                self._windows[key] = windows
+            else:
+                del self._windows[key]
+
+    def invalidate(self, key, timestamp):
+        # A write at timestamp
+        self._drop(key, lambda start, end: (
+            (start is None or start <= timestamp) and
+            (end is None or timestamp < end)))
+
+    def invalidate_expired(self, key, timestamp):
+        # Records up to timestamp expired
+        self._drop(key, lambda start, end: (
+            start is None or start <= timestamp))
+
+    def _drop(self, key, affected):
+        with self._lock:
+            self._counter += 1
+            self._generations[key] = self._counter
+            self._generations.move_to_end(key)
+            while len(self._generations) > self.max_generations:
+                (dummy, forgotten) = self._generations.popitem(last=False)
+                self._forgotten = max(self._forgotten, forgotten)
+
+            windows = self._windows.get(key)
+            if not windows:
+                return
+
+            for cache_key in list(windows):
+                if affected(cache_key[3], cache_key[4]):
+                    windows.discard(cache_key)
+                    self._cache.discard(cache_key)
+
+            if not windows:
+                del self._windows[key]
+
+    def stats(self):
+        return self._cache.stats()
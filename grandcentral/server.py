@@ -21,6 +21,9 @@
 from grandcentral import api
 
 
+import os
+
+
 try:
     import grandcentral.sqlalchemystorage
     storage_cls = grandcentral.sqlalchemystorage.SQLAlchemyStorage
@@ -28,4 +31,26 @@ except ImportError:
     import grandcentral.storage
     storage_cls = grandcentral.storage.MemoryStorage
 
-app = api.API(storage_cls())
+# GRANDCENTRAL_STORAGE_PATH: where data is kept (must end with /)
+# GRANDCENTRAL_PRIMARY: URL of a primary server, turns this one into a read
+#                       only follower replicating it
+# GRANDCENTRAL_COMPRESSION: gzip or zstd, compresses stored values and
+#                           attachments
+# GRANDCENTRAL_CHUNKING: set to 1 to store attachments as content-defined
+#                        chunks, shared between similar attachments
+storage_path = os.environ.get('GRANDCENTRAL_STORAGE_PATH')
+primary_url = os.environ.get('GRANDCENTRAL_PRIMARY')
+compression = os.environ.get('GRANDCENTRAL_COMPRESSION')
+chunking = os.environ.get('GRANDCENTRAL_CHUNKING') == '1'
+
+kwargs = {'compression': compression} if compression else {}
+if chunking:
+    kwargs['chunking'] = True
+storage = (storage_cls(storage_path, **kwargs) if storage_path
+           else storage_cls(**kwargs))
+app = api.API(storage, read_only=primary_url is not None)
+
+if primary_url:
+    from grandcentral import replication
+    follower = replication.Follower(storage, primary_url)
+    follower.start()
@@ -0,0 +1,384 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2017 Luis López <luis@cuarentaydos.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
+# USA.
+
+
+import grandcentral.storage
+import grandcentral.sqlalchemystorage
+from grandcentral.sqlalchemystorage import Record, Head
+
+
+import argparse
+import concurrent.futures
+import hashlib
+import heapq
+import json
+import os
+import sys
+from os import path
+
+
+import sqlalchemy as sa
+
+
+LAYOUT_FILENAME = 'shards.json'
+
+
+def jump_hash(key, buckets):
+    # Jump consistent hash (Lamping, Veach). Going from N to N+1 buckets
+    # only moves 1/(N+1) of the keys
+    b, j = -1, 0
+    while j < buckets:
+        b = j
+        key = (key * 2862933555777941757 + 1) & 0xFFFFFFFFFFFFFFFF
+        j = int((b + 1) * (float(1 << 31) / float((key >> 33) + 1)))
+
+    return b
+
+
+def shard_for_key(key, shards):
+    digest = hashlib.sha1(key.encode('utf-8')).digest()
+    return jump_hash(int.from_bytes(digest[:8], 'little'), shards)
+
+
+def _read_layout(storage_path):
+    try:
+        with open(path.join(storage_path, LAYOUT_FILENAME)) as fh:
+            return json.load(fh)
+    except FileNotFoundError:
+        return None
+
+
+def _write_layout(storage_path, layout):
+    filepath = path.join(storage_path, LAYOUT_FILENAME)
+    with open(filepath + '.tmp', 'w') as fh:
+        json.dump(layout, fh)
+        fh.flush()
+        os.fsync(fh.fileno())
+    os.replace(filepath + '.tmp', filepath)
+
+
+def _open_shard(storage_path, idx, **kwargs):
+    # All shards share storage_path so they share the files/ attachment
+    # store
+    return grandcentral.sqlalchemystorage.SQLAlchemyStorage(
+        storage_path=path.join(storage_path, ''),
+        dbpath=path.join(storage_path, 'shard-{:02d}.sqlite'.format(idx)),
+        **kwargs)
+
+
+class ShardedStorage(grandcentral.storage.BaseStorage):
+    # Routes each key to one of N SQLAlchemyStorage databases so writes to
+    # different shards commit in parallel. The shard count is recorded in
+    # storage_path and can only be changed with reshard().
+    #
+    # write_many() is atomic per shard, not across shards.
+
+    def __init__(self, storage_path=None, shards=None, **kwargs):
+        if storage_path is None:
+            storage_path = path.realpath(__file__)
+            storage_path = path.dirname(storage_path)
+            storage_path = path.dirname(storage_path)
+            storage_path = storage_path + '/data/sharded/'
+
+        os.makedirs(storage_path, exist_ok=True)
+
+        layout = _read_layout(storage_path)
+        if layout is None:
+            layout = {'shards': shards or 4}
+            _write_layout(storage_path, layout)
+
+        if 'resharding_to' in layout:
+            raise ValueError(
+                "{}: interrupted reshard to {} shards, run it "
+                "again".format(storage_path, layout['resharding_to']))
+
+        if shards is not None and shards != layout['shards']:
+            raise ValueError(
+                "{}: has {} shards, use reshard() to change it to "
+                "{}".format(storage_path, layout['shards'], shards))
+
+        self.storage_path = storage_path
+
+        # The first shard's database tracks the chunks of the shared files/
+        # store for all of them
+        self.shards = [_open_shard(storage_path, 0, **kwargs)]
+        self.shards.extend(
+            _open_shard(storage_path, idx, chunk_index=self.shards[0],
+                        **kwargs)
+            for idx in range(1, layout['shards']))
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=len(self.shards),
+            thread_name_prefix='grandcentral-shard')
+        self._signaler = None
+
+    @property
+    def signaler(self):
+        return self._signaler
+
+    @signaler.setter
+    def signaler(self, value):
+        # Shards notify on their own once their writes are committed
+        self._signaler = value
+        for shard in self.shards:
+            shard.signaler = value
+
+    def shard(self, key):
+        return self.shards[shard_for_key(key, len(self.shards))]
+
+    def _fan_out(self, fn):
+        return [
+            fut.result() for fut in
+            [self._executor.submit(fn, shard) for shard in self.shards]
+        ]
+
+    def close(self):
+        self._executor.shutdown()
+        for shard in self.shards:
+            shard.close()
+
+    def stats(self):
+        return {'shards': [shard.stats() for shard in self.shards]}
+
+    def read(self, key):
+        return self.shard(key).read(key)
+
+    def write(self, key, value, attachment=None):
+        self.shard(key).write(key, value, attachment=attachment)
+
+    def read_many(self, keys):
+        groups = {}
+        for key in keys:
+            groups.setdefault(shard_for_key(key, len(self.shards)), []).append(
+                key)
+
+        futs = [
+            self._executor.submit(self.shards[idx].read_many, group)
+            for (idx, group) in groups.items()
+        ]
+        ret = {}
+        for fut in futs:
+            ret.update(fut.result())
+
+        return ret
+
+    def write_many(self, messages):
+        groups = {}
+        for (key, value) in messages:
+            groups.setdefault(shard_for_key(key, len(self.shards)), []).append(
+                (key, value))
+
+        futs = [
+            self._executor.submit(self.shards[idx].write_many, group)
+            for (idx, group) in groups.items()
+        ]
+        for fut in futs:
+            fut.result()
+
+    def latest_timestamp(self, key):
+        return self.shard(key).latest_timestamp(key)
+
+    def backlog_summary(self, key):
+        return self.shard(key).backlog_summary(key)
+
+    def read_raw(self, key):
+        return self.shard(key).read_raw(key)
+
+    def backlog(self, key, limit=None, before=None, after=None):
+        return self.shard(key).backlog(
+            key, limit=limit, before=before, after=after)
+
+    def backlog_raw(self, key, limit=None, before=None, after=None):
+        return self.shard(key).backlog_raw(
+            key, limit=limit, before=before, after=after)
+
+    def range(self, key, start=None, end=None):
+        return self.shard(key).range(key, start=start, end=end)
+
+    def timeseries(self, key, start=None, end=None):
+        return self.shard(key).timeseries(key, start=start, end=end)
+
+    def open_attachment(self, key, timestamp=None):
+        return self.shard(key).open_attachment(key, timestamp=timestamp)
+
+    def open_attachment_encoded(self, key, timestamp=None):
+        return self.shard(key).open_attachment_encoded(
+            key, timestamp=timestamp)
+
+    def keys(self, prefix=None):
+        results = self._fan_out(lambda shard: list(shard.keys(prefix=prefix)))
+        yield from heapq.merge(*results)
+
+    def export(self, prefix=None, start=None, end=None):
+        # Each key lives in one shard, merging by key keeps the order
+        yield from heapq.merge(
+            *[shard.export(prefix=prefix, start=start, end=end)
+              for shard in self.shards],
+            key=lambda x: x[0])
+
+    def import_records(self, records):
+        groups = {}
+        for record in records:
+            groups.setdefault(
+                shard_for_key(record[0], len(self.shards)), []).append(record)
+
+        futs = [
+            self._executor.submit(self.shards[idx].import_records, group)
+            for (idx, group) in groups.items()
+        ]
+        for fut in futs:
+            fut.result()
+
+    # Shards share the chunk store, like the rest of files/
+
+    def missing_chunks(self, digests):
+        return self.shards[0].missing_chunks(digests)
+
+    def store_chunk(self, digest, data):
+        self.shards[0].store_chunk(digest, data)
+
+    def write_chunked(self, key, value, chunks):
+        self.shard(key).write_chunked(key, value, chunks)
+
+    def expire(self, key, keep_last=None, max_age=None, limit=1000):
+        return self.shard(key).expire(
+            key, keep_last=keep_last, max_age=max_age, limit=limit)
+
+    def collect_attachments(self, digests):
+        # The attachment store is shared, a digest can only go once no shard
+        # references it
+        digests = set(digests) | self.shards[0].pending_attachments()
+        referenced = set().union(*self._fan_out(
+            lambda shard: shard.referenced_attachments(digests)))
+
+        return self.shards[0]._remove_attachments(digests - referenced)
+
+    def vacuum(self, pages=None):
+        return sum(self._fan_out(lambda shard: shard.vacuum(pages=pages)))
+
+
+def _move_key(src, dst, key, batch_size):
+    # Copies first and deletes afterwards, so an interrupted move can just
+    # be run again
+    table = Record.__table__
+    columns = [x for x in table.c if x.name != 'seq']
+    last = None
+    after = None
+
+    # seq is local to each shard, the destination assigns its own
+    while True:
+        stmt = sa.select(columns).where(table.c.key == key)
+        if after is not None:
+            stmt = stmt.where(table.c.timestamp > after)
+        stmt = stmt.order_by(table.c.timestamp.asc()).limit(batch_size)
+
+        with src.session() as sess:
+            rows = [dict(x) for x in sess.execute(stmt).fetchall()]
+
+        if not rows:
+            break
+
+        with dst.session() as sess:
+            sess.execute(table.insert().prefix_with('OR IGNORE'), rows)
+            sess.commit()
+
+        last = rows[-1]
+        after = last['timestamp']
+
+    if last is not None:
+        with dst.session() as sess:
+            dst._update_heads(sess, [last])
+            sess.commit()
+
+    with src.session() as sess:
+        sess.query(Record).filter(Record.key == key).delete(
+            synchronize_session=False)
+        sess.query(Head).filter(Head.key == key).delete(
+            synchronize_session=False)
+        sess.commit()
+
+    src.cache.discard(key)
+    dst.cache.discard(key)
+
+
+def reshard(storage_path, shards, batch_size=1000, **kwargs):
+    # Offline migration: moves every key whose shard changes with the new
+    # count. Nothing else may be using storage_path meanwhile. Returns the
+    # number of keys moved
+    layout = _read_layout(storage_path)
+    if layout is None:
+        raise ValueError("{}: not a sharded storage".format(storage_path))
+
+    target = layout.get('resharding_to', shards)
+    if target != shards:
+        raise ValueError(
+            "{}: interrupted reshard to {} shards, finish it "
+            "first".format(storage_path, target))
+
+    current = layout['shards']
+    _write_layout(storage_path, {'shards': current, 'resharding_to': shards})
+
+    storages = [
+        _open_shard(storage_path, idx, **kwargs)
+        for idx in range(max(current, shards))
+    ]
+
+    moved = 0
+    try:
+        for (idx, src) in enumerate(storages):
+            for key in list(src.keys()):
+                dst = shard_for_key(key, shards)
+                if dst != idx:
+                    _move_key(src, storages[dst], key, batch_size)
+                    moved += 1
+    finally:
+        for storage in storages:
+            storage.close()
+
+    # Shards left over when shrinking are empty by now
+    for idx in range(shards, current):
+        dbpath = path.join(storage_path, 'shard-{:02d}.sqlite'.format(idx))
+        for suffix in ('', '-wal', '-shm'):
+            if path.exists(dbpath + suffix):
+                os.unlink(dbpath + suffix)
+
+    _write_layout(storage_path, {'shards': shards})
+
+    return moved
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Change the number of shards of a sharded storage')
+    parser.add_argument(
+        'storage_path',
+        help='Sharded storage directory')
+    parser.add_argument(
+        '--shards',
+        type=int,
+        required=True,
+        help='New number of shards')
+
+    args = parser.parse_args(sys.argv[1:])
+
+    moved = reshard(args.storage_path, args.shards)
+    print('{} keys moved'.format(moved))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2017 Luis López <luis@cuarentaydos.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
+# USA.
+
+
+
+import collections
+import threading
+
+
+class Signaler:
+    # In-process change notifier. Storages publish the timestamp of each
+    # write and watchers block until a key moves past the timestamp they
+    # already have.
+
+    def __init__(self, maxkeys=100000):
+        self._lock = threading.Lock()
+
+        # Latest timestamp of the maxkeys most recently written keys.
+        # Watchers check storage before waiting, so this only has to cover
+        # writes racing that check, not every key ever written
+        self.maxkeys = maxkeys
+        self._latest = collections.OrderedDict()
+
+        # key -> [condition, number of waiters]. Conditions share _lock and
+        # only exist while someone waits on that key, so a write only wakes
+        # the watchers of its own key.
+        self._conds = {}
+
+        # Callables invoked as fn(key, timestamp) after each publish, from
+        # the publishing thread
+        self._listeners = []
+
+        # Same for expirations, timestamp is the newest expired record's.
+        # Watchers aren't woken, nothing new was written
+        self._expire_listeners = []
+
+    def add_listener(self, fn):
+        self._listeners.append(fn)
+
+    def remove_listener(self, fn):
+        self._listeners.remove(fn)
+
+    def add_expire_listener(self, fn):
+        self._expire_listeners.append(fn)
+
+    def remove_expire_listener(self, fn):
+        self._expire_listeners.remove(fn)
+
+    def publish_expired(self, key, timestamp):
+        for fn in list(self._expire_listeners):
+            fn(key, timestamp)
+
+    def latest(self, key):
+        return self._latest.get(key)
+
+    def publish(self, key, timestamp):
+        with self._lock:
+            if timestamp > self._latest.get(key, float('-inf')):
+                self._latest[key] = timestamp
+            self._latest.move_to_end(key)
+            while len(self._latest) > self.maxkeys:
+                self._latest.popitem(last=False)
+
+            entry = self._conds.get(key)
+            if entry is not None:
+                entry[0].notify_all()
+
+        for fn in list(self._listeners):
+            fn(key, timestamp)
+
+    def wait(self, key, since, timeout=None):
+        # Returns True if key was written after since, False on timeout
+        def _changed():
+            return self._latest.get(key, float('-inf')) > since
+
+        with self._lock:
+            entry = self._conds.get(key)
+            if entry is None:
+                entry = self._conds[key] = [threading.Condition(self._lock), 0]
+
+            entry[1] += 1
+            try:
+                return entry[0].wait_for(_changed, timeout)
+
+            finally:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self._conds[key]
@@ -19,18 +19,34 @@
 
 
 import grandcentral
+from grandcentral import cache
+from grandcentral import chunking as gcchunking
+from grandcentral import codecs
+from grandcentral import compression as gccompression
 
 
+import collections
+import concurrent.futures
+import contextlib
 import datetime
+import functools
 import hashlib
-import os
+import io
 import json
+import os
+import re
+import shutil
+import tempfile
+import threading
 import time
 from os import path
 
 
 import sqlalchemy as sa
+import sqlalchemy.orm
+import sqlalchemy.pool
 from sqlalchemy import event
+from sqlalchemy.dialects import sqlite as sa_sqlite
 from sqlalchemy.ext import declarative
 
 
@@ -44,6 +60,21 @@ Base.metadata.naming_convention = {
 }
 
 
+DIGEST_RE = re.compile(r'[0-9a-f]{40}')
+
+
+# Serializes touching stored files against collecting them. Shared by the
+# storages using the same files/ directory (ie. shards)
+_files_locks = {}
+_files_locks_guard = threading.Lock()
+
+
+def _files_lock(files_path):
+    with _files_locks_guard:
+        return _files_locks.setdefault(
+            path.realpath(files_path), threading.Lock())
+
+
 def now_timestamp(utc=True):
     dt = datetime.datetime.utcnow() if utc else datetime.datetime.now()
     return time.mktime(dt.timetuple())
@@ -59,15 +90,91 @@ class Record(Base):
     timestamp = sa.Column(sa.Float, default=time.time)
 
     value = sa.Column(sa.String, nullable=False)
-    attachment = sa.Column(sa.String, nullable=True, unique=False)
+    attachment = sa.Column(sa.String, nullable=True, unique=False, index=True)
+
+    # Global write order for the change feed. Assigned inside the inserting
+    # transaction, so it follows commit order. Drawn from the sequences
+    # table rather than MAX(seq), which goes down when expire() deletes the
+    # newest row. Followers insert the primary's values instead
+    seq = sa.Column(
+        sa.Integer, nullable=True, unique=True, index=True,
+        default=sa.text(
+            "(SELECT value + 1 FROM sequences WHERE name = 'records')"))
 
     def __repr__(self):
         fmt = r"<Record(key='{key}')>"
         return fmt.format(key=self.key)
 
 
+class Sequence(Base):
+    # Last value handed out per counter. Only ever grows: bumped by a trigger
+    # on every insert, in the same transaction
+    __tablename__ = 'sequences'
+
+    name = sa.Column(sa.String, primary_key=True)
+    value = sa.Column(sa.Integer, nullable=False)
+
+
+class Chunk(Base):
+    # Stored chunks, so the unreferenced ones can be found without walking
+    # files/
+    __tablename__ = 'chunks'
+
+    digest = sa.Column(sa.String, primary_key=True)
+
+
+class ChunkRef(Base):
+    # Chunks listed by the manifest of each chunked attachment
+    __tablename__ = 'chunk_refs'
+    __table_args__ = (
+        sa.PrimaryKeyConstraint('attachment', 'chunk'),
+    )
+
+    attachment = sa.Column(sa.String, nullable=False)
+    chunk = sa.Column(sa.String, nullable=False, index=True)
+
+
+class Head(Base):
+    # Materialized latest record of each key, kept in sync by writes
+    __tablename__ = 'heads'
+
+    key = sa.Column(sa.String, primary_key=True)
+    timestamp = sa.Column(sa.Float, nullable=False)
+    value = sa.Column(sa.String, nullable=False)
+
+    def __repr__(self):
+        fmt = r"<Head(key='{key}')>"
+        return fmt.format(key=self.key)
+
+
 class SQLAlchemyStorage(grandcentral.storage.BaseStorage):
-    def __init__(self, storage_path=None):
+    ATTACHMENT_CHUNK_SIZE = 64 * 1024
+    RANGE_BATCH_SIZE = 500
+
+    # Unreferenced attachments younger than this are not collected, a write
+    # may be about to reference them
+    ATTACHMENT_GRACE_PERIOD = 300
+
+    # Chunked attachments are stored as a manifest next to where the whole
+    # file would be
+    MANIFEST_SUFFIX = '.chunks'
+
+    def __init__(self, storage_path=None, dbpath=None, cache_size=1024,
+                 pool_size=8, synchronous='NORMAL', busy_timeout=5000,
+                 statement_cache_size=256, group_commit=False,
+                 group_commit_interval=0.005, group_commit_size=500,
+                 codec=None, compression=None, compression_threshold=1024,
+                 chunking=False, chunk_size=64 * 1024, chunk_index=None):
+        if storage_path is None and dbpath is not None and dbpath != ':memory:':
+            storage_path = path.dirname(path.realpath(dbpath)) + '/'
+
+        # In-memory databases are meant for tests. Attachments still need a
+        # place on disk, a temporary directory removed by close()
+        self._tmpdir = None
+        if storage_path is None and dbpath == ':memory:':
+            self._tmpdir = tempfile.mkdtemp(prefix='grandcentral-')
+            storage_path = self._tmpdir + '/'
+
         if storage_path is None:
             storage_path = path.realpath(__file__)
             storage_path = path.dirname(storage_path)
@@ -76,16 +183,295 @@ class SQLAlchemyStorage(grandcentral.storage.BaseStorage):
 
         os.makedirs(storage_path, exist_ok=True)
 
-        self._db_uri = 'sqlite:///' + storage_path + 'gc.sqlite'
-        engine = sa.create_engine(self._db_uri)
-        Base.metadata.create_all(bind=engine)
+        if dbpath is None:
+            dbpath = storage_path + 'gc.sqlite'
+
+        self.synchronous = synchronous
+        self.busy_timeout = busy_timeout
 
-        session_factory = sa.orm.sessionmaker(bind=engine)
-        Session = sa.orm.scoped_session(session_factory)
-        self.sess = Session()
+        # Codec for new values, rows written with another one stay readable
+        self.codec = (codecs.default_codec() if codec is None
+                      else codecs.get_codec(codec))
+
+        # Values and attachments at least compression_threshold bytes long
+        # are stored compressed, reads handle both
+        self.compression = (None if compression is None
+                            else gccompression.get_compression(compression))
+        self.compression_threshold = compression_threshold
+
+        # With chunking, attachments are split by content into chunks of
+        # chunk_size bytes on average, each stored once. Versions differing
+        # in a few bytes share most of their chunks. Chunked uploads
+        # (write_chunked()) are accepted either way
+        self.chunker = (gcchunking.Chunker(avg_size=chunk_size)
+                        if chunking else None)
+
+        # Storage whose database tracks stored chunks and which manifests
+        # reference them. Storages sharing files/ (shards) must share it too
+        self._chunk_index = self if chunk_index is None else chunk_index
+        self._memory = dbpath == ':memory:'
+
+        # The pool only hands a connection to one thread at a time, the
+        # sqlite3 same-thread check would reject that anyway.
+        # An in-memory database only lives within its connection so all
+        # threads share a single one, taking turns (meant for tests).
+        connect_args = {
+            'check_same_thread': False,
+            'cached_statements': statement_cache_size
+        }
+        if self._memory:
+            pool_kwargs = dict(poolclass=sa.pool.StaticPool)
+            self._connection_lock = threading.RLock()
+        else:
+            pool_kwargs = dict(
+                poolclass=sa.pool.QueuePool,
+                pool_size=pool_size,
+                max_overflow=pool_size)
+            self._connection_lock = contextlib.nullcontext()
+
+        # auto_vacuum only takes effect before the first table is created
+        self._new_database = self._memory or not path.exists(dbpath)
+
+        self._db_uri = 'sqlite:///' + dbpath
+        self.engine = sa.create_engine(
+            self._db_uri, connect_args=connect_args, **pool_kwargs)
+        event.listen(self.engine, 'connect', self._on_connect)
+        new_chunk_index = not sa.inspect(self.engine).has_table('chunks')
+        Base.metadata.create_all(bind=self.engine)
+
+        # create_all() skips columns and indexes of tables that already
+        # exist
+        with self.engine.begin() as conn:
+            columns = [x[1] for x in conn.execute('PRAGMA table_info(records)')]
+            if 'seq' not in columns:
+                conn.execute('ALTER TABLE records ADD COLUMN seq INTEGER')
+                conn.execute('UPDATE records SET seq = rowid')
+
+            conn.execute(
+                'CREATE INDEX IF NOT EXISTS ix_records_attachment '
+                'ON records (attachment)')
+            conn.execute(
+                'CREATE UNIQUE INDEX IF NOT EXISTS ix_records_seq '
+                'ON records (seq)')
+
+            # Databases from before the sequences table start at their
+            # current high-water mark
+            conn.execute(
+                "INSERT OR IGNORE INTO sequences (name, value) "
+                "SELECT 'records', COALESCE(MAX(seq), 0) FROM records")
+            conn.execute(
+                'CREATE TRIGGER IF NOT EXISTS records_seq '
+                'AFTER INSERT ON records WHEN NEW.seq IS NOT NULL BEGIN '
+                "UPDATE sequences SET value = MAX(value, NEW.seq) "
+                "WHERE name = 'records'; END")
+
+        # Sessions are short lived: one per storage operation, each one
+        # checking a connection out of the pool
+        self.Session = sa.orm.sessionmaker(bind=self.engine)
+
+        self.cache = cache.LRUCache(maxsize=cache_size)
 
         self._files_path = storage_path + 'files/'
+        self._chunks_path = self._files_path + 'chunks/'
         os.makedirs(self._files_path, exist_ok=True)
+        self._files_lock = _files_lock(self._files_path)
+
+        # Unreferenced attachments skipped for being within the grace
+        # period, retried by the next collect_attachments()
+        self._collect_pending = set()
+
+        self._backfill_heads()
+        if new_chunk_index and self._chunk_index is self:
+            self._backfill_chunks()
+
+        # Group commit: writes are queued and a background thread commits
+        # them together every group_commit_interval seconds or
+        # group_commit_size records, whatever comes first
+        self.group_commit = group_commit
+        self.group_commit_interval = group_commit_interval
+        self.group_commit_size = group_commit_size
+        self._gc_cond = threading.Condition()
+        self._gc_queue = collections.deque()
+        self._gc_closed = False
+        self._gc_last_timestamp = 0.0
+        self._gc_stats = {
+            'flushes': 0,
+            'records': 0,
+            'last_flush_latency': 0.0,
+            'max_flush_latency': 0.0,
+            'total_flush_latency': 0.0
+        }
+
+        # key -> [(timestamp, value), ...] queued but not yet committed, so
+        # reads can see their own writes
+        self._pending = {}
+
+        # future -> rows still waiting to be committed. A future spans more
+        # than one batch if its write_many is bigger than group_commit_size
+        self._gc_remaining = {}
+
+        self._gc_thread = None
+        if self.group_commit:
+            self._gc_thread = threading.Thread(
+                target=self._group_committer,
+                name='grandcentral-group-commit',
+                daemon=True)
+            self._gc_thread.start()
+
+    def close(self):
+        if self._gc_thread is not None:
+            with self._gc_cond:
+                self._gc_closed = True
+                self._gc_cond.notify_all()
+
+            self._gc_thread.join()
+            self._gc_thread = None
+
+        self.engine.dispose()
+
+        if self._tmpdir is not None:
+            shutil.rmtree(self._tmpdir, ignore_errors=True)
+            self._tmpdir = None
+
+    def stats(self):
+        with self._gc_cond:
+            gc_stats = dict(self._gc_stats)
+            gc_stats['queue_depth'] = len(self._gc_queue)
+
+        flushes = gc_stats.pop('flushes')
+        total = gc_stats.pop('total_flush_latency')
+        gc_stats['flushes'] = flushes
+        gc_stats['avg_flush_latency'] = total / flushes if flushes else 0.0
+
+        return {
+            'cache': self.cache.stats(),
+            'group_commit': gc_stats
+        }
+
+    def _on_connect(self, dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        try:
+            # First, so the pragmas below wait for a writer holding the lock
+            cursor.execute('PRAGMA busy_timeout={:d}'.format(self.busy_timeout))
+
+            # Lets vacuum() release free pages in steps. Only effective on
+            # databases created after this was set (or after a full VACUUM),
+            # so it's set once, by the connection creating the tables
+            if self._new_database:
+                cursor.execute('PRAGMA auto_vacuum=INCREMENTAL')
+                self._new_database = False
+
+            # WAL lets readers go on while a writer commits
+            if not self._memory:
+                cursor.execute('PRAGMA journal_mode=WAL')
+            cursor.execute('PRAGMA synchronous={}'.format(self.synchronous))
+        finally:
+            cursor.close()
+
+    @contextlib.contextmanager
+    def session(self):
+        # The one connection of an in-memory database is shared by every
+        # thread, sessions on it take turns. Iterators hold theirs until
+        # exhausted or closed
+        with self._connection_lock:
+            sess = self.Session()
+            try:
+                yield sess
+            except BaseException:
+                sess.rollback()
+                raise
+            finally:
+                sess.close()
+
+    def _backfill_heads(self):
+        # Databases created before the heads table existed
+        with self.session() as sess:
+            needs_backfill = (
+                sess.query(Head.key).first() is None and
+                sess.query(Record.key).first() is not None)
+            if not needs_backfill:
+                return
+
+            latest = sess.query(
+                Record.key.label('key'),
+                sa.func.max(Record.timestamp).label('timestamp'))
+            latest = latest.group_by(Record.key).subquery()
+
+            qs = sess.query(Record.key, Record.timestamp, Record.value)
+            qs = qs.join(latest, sa.and_(
+                Record.key == latest.c.key,
+                Record.timestamp == latest.c.timestamp))
+
+            sess.execute(
+                Head.__table__.insert().from_select(
+                    ['key', 'timestamp', 'value'], qs))
+            sess.commit()
+
+
+    def _backfill_chunks(self):
+        # Chunk stores from before the chunk tables existed, walked once
+        if not path.exists(self._chunks_path):
+            return
+
+        chunks, refs = set(), []
+        for (dirpath, dirnames, filenames) in os.walk(self._files_path):
+            for filename in filenames:
+                if path.join(dirpath, '').startswith(self._chunks_path):
+                    # Suffixes of compressed chunks, upload temporary files
+                    digest = filename.split('.')[0]
+                    if DIGEST_RE.fullmatch(digest):
+                        chunks.add(digest)
+
+                elif filename.endswith(self.MANIFEST_SUFFIX):
+                    digest = filename[:-len(self.MANIFEST_SUFFIX)]
+                    try:
+                        refs.extend(
+                            dict(attachment=digest, chunk=chunk)
+                            for (chunk, size) in self._load_manifest(
+                                path.join(dirpath, filename)))
+                    except KeyError:
+                        pass
+
+        with self.session() as sess:
+            if chunks:
+                sess.execute(
+                    Chunk.__table__.insert().prefix_with('OR IGNORE'),
+                    [dict(digest=x) for x in chunks])
+            if refs:
+                sess.execute(
+                    ChunkRef.__table__.insert().prefix_with('OR IGNORE'),
+                    refs)
+            sess.commit()
+    def _update_heads(self, sess, rows):
+        # Heads only move forward. Timestamps are taken before the write
+        # lock, so a writer can commit after another one with a newer
+        # timestamp; its record goes into the history but not into heads
+        heads = {}
+        for row in rows:
+            head = heads.get(row['key'])
+            if head is None or row['timestamp'] >= head['timestamp']:
+                heads[row['key']] = row
+
+        table = Head.__table__
+        stmt = sa_sqlite.insert(table)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[table.c.key],
+            set_=dict(timestamp=stmt.excluded.timestamp,
+                      value=stmt.excluded.value),
+            where=stmt.excluded.timestamp >= table.c.timestamp)
+
+        sess.execute(stmt, [
+            dict(key=x['key'], timestamp=x['timestamp'], value=x['value'])
+            for x in heads.values()
+        ])
+
+    def _encode(self, value):
+        return codecs.encode_stored(
+            self.codec, value, compression=self.compression,
+            threshold=self.compression_threshold)
+
+    def _key_exists(self, sess, key):
+        return sess.query(Head.key).filter(Head.key == key).first() is not None
 
     def _storage_filepath_for_attachment(self, digest):
         return '{base_path}/{digest[0]}/{digest[0]}{digest[1]}/{digest}'.format(
@@ -103,46 +489,1000 @@ class SQLAlchemyStorage(grandcentral.storage.BaseStorage):
 
     #     print('{} -> {}'.format(repr(prev), repr(target.value)))
 
+    def _storage_filepath_for_chunk(self, digest):
+        # digest comes from clients, don't let it wander out of files/
+        if not DIGEST_RE.fullmatch(digest):
+            raise KeyError(digest)
+
+        return '{base_path}{digest[0]}/{digest[0]}{digest[1]}/{digest}'.format(
+            base_path=self._chunks_path,
+            digest=digest
+        )
+
+    def _find_stored(self, filepath, digest):
+        # filepath or its compressed variant, and its compression.
+        # Compressed files keep the uncompressed digest plus a suffix, so
+        # dedup is unaffected
+        if path.exists(filepath):
+            return (filepath, None)
+
+        for compression in gccompression.COMPRESSIONS.values():
+            if path.exists(filepath + compression.suffix):
+                return (filepath + compression.suffix, compression)
+
+        raise KeyError(digest)
+
+    def _find_attachment(self, digest):
+        # Stored file of digest and its compression. For chunked
+        # attachments that's the manifest, with no compression
+        filepath = self._storage_filepath_for_attachment(digest)
+        if path.exists(filepath + self.MANIFEST_SUFFIX):
+            return (filepath + self.MANIFEST_SUFFIX, None)
+
+        return self._find_stored(filepath, digest)
+
+    def _write_file(self, filepath, data):
+        # Atomic, readers see the whole file or nothing
+        os.makedirs(path.dirname(filepath), exist_ok=True)
+        fd, tmp_filepath = tempfile.mkstemp(
+            dir=path.dirname(filepath), prefix='.upload-')
+        try:
+            with os.fdopen(fd, 'wb') as fh:
+                fh.write(data)
+            os.replace(tmp_filepath, filepath)
+
+        except BaseException:
+            if path.exists(tmp_filepath):
+                os.unlink(tmp_filepath)
+            raise
+
+    def _touch(self, filepath):
+        # Restarts the collector's grace period of a stored file. False if
+        # it was collected meanwhile
+        with self._files_lock:
+            try:
+                os.utime(filepath)
+            except FileNotFoundError:
+                return False
+
+        return True
+
+    def _unlink_expired(self, filepath, grace_limit):
+        # Size of filepath if it was removed, None if it's missing or was
+        # touched within the grace period
+        with self._files_lock:
+            try:
+                st = os.stat(filepath)
+                if st.st_mtime > grace_limit:
+                    return None
+                os.unlink(filepath)
+            except FileNotFoundError:
+                return None
+
+        return st.st_size
+
+    def _store_chunk(self, digest, data):
+        try:
+            existing, dummy = self._find_stored(
+                self._storage_filepath_for_chunk(digest), digest)
+        except KeyError:
+            existing = None
+
+        if existing is None or not self._touch(existing):
+            filepath = self._storage_filepath_for_chunk(digest)
+            compression = self.compression
+            if (compression is not None and
+                    len(data) >= self.compression_threshold):
+                compressed = compression.compress(data)
+                if len(compressed) <= len(data) * 0.9:
+                    filepath += compression.suffix
+                    data = compressed
+
+            self._write_file(filepath, data)
+
+        # Recorded once the file is there, see _collect_chunks()
+        self._chunk_index._index_chunks(Chunk, [dict(digest=digest)])
+
+    def _read_chunk(self, digest):
+        filepath, compression = self._find_stored(
+            self._storage_filepath_for_chunk(digest), digest)
+        try:
+            with open(filepath, 'rb') as fh:
+                data = fh.read()
+        except FileNotFoundError as e:
+            raise KeyError(digest) from e
+
+        return data if compression is None else compression.decompress(data)
+
+    def _store_manifest(self, digest, chunks):
+        # Manifest of the attachment with whole content digest, made of
+        # chunks, a list of (chunk digest, size)
+        try:
+            existing, dummy = self._find_attachment(digest)
+        except KeyError:
+            existing = None
+
+        if existing is None or not self._touch(existing):
+            manifest = {
+                'size': sum(size for (chunk, size) in chunks),
+                'chunks': [[chunk, size] for (chunk, size) in chunks]
+            }
+            self._write_file(
+                self._storage_filepath_for_attachment(digest) +
+                self.MANIFEST_SUFFIX,
+                json.dumps(manifest).encode('utf-8'))
+
+        self._chunk_index._index_chunks(ChunkRef, [
+            dict(attachment=digest, chunk=chunk)
+            for chunk in set(chunk for (chunk, size) in chunks)
+        ])
+
+    def _index_chunks(self, model, rows):
+        with self.session() as sess:
+            sess.execute(model.__table__.insert().prefix_with('OR IGNORE'),
+                         rows)
+            sess.commit()
+
+    def _load_manifest(self, filepath):
+        try:
+            with open(filepath, 'rb') as fh:
+                manifest = json.loads(fh.read().decode('utf-8'))
+        except FileNotFoundError as e:
+            raise KeyError(filepath) from e
+
+        return [(chunk, size) for (chunk, size) in manifest['chunks']]
+
+    def _store_chunked_attachment(self, attachment):
+        sha1 = hashlib.sha1()
+        chunks = []
+        for data in self.chunker.split(attachment):
+            sha1.update(data)
+            chunk = hashlib.sha1(data).hexdigest()
+            self._store_chunk(chunk, data)
+            chunks.append((chunk, len(data)))
+
+        digest = sha1.hexdigest()
+        self._store_manifest(digest, chunks)
+        return digest
+
+    def _store_attachment(self, attachment):
+        # attachment can be a bytes-like object or a binary file object. It's
+        # hashed while being copied in chunks into a temporary file, which is
+        # then renamed into its content-addressed location
+        if isinstance(attachment, (bytes, bytearray, memoryview)):
+            attachment = io.BytesIO(attachment)
+
+        if self.chunker is not None:
+            return self._store_chunked_attachment(attachment)
+
+        sha1 = hashlib.sha1()
+        size = 0
+        fd, tmp_filepath = tempfile.mkstemp(
+            dir=self._files_path, prefix='.upload-')
+        compressed_filepath = None
+
+        try:
+            with os.fdopen(fd, 'wb') as fh:
+                read = functools.partial(
+                    attachment.read, self.ATTACHMENT_CHUNK_SIZE)
+                for chunk in iter(read, b''):
+                    sha1.update(chunk)
+                    fh.write(chunk)
+                    size += len(chunk)
+
+            digest = sha1.hexdigest()
+
+            # Same content is already stored, skip the write. Touch it so
+            # the collector's grace period starts over
+            try:
+                existing, dummy = self._find_attachment(digest)
+            except KeyError:
+                existing = None
+
+            if existing is not None and self._touch(existing):
+                os.unlink(tmp_filepath)
+                return digest
+
+            storage_filepath = self._storage_filepath_for_attachment(digest)
+            os.makedirs(path.dirname(storage_filepath), exist_ok=True)
+
+            compressed_filepath = self._compress_attachment(
+                tmp_filepath, size)
+            if compressed_filepath is not None:
+                os.unlink(tmp_filepath)
+                os.replace(compressed_filepath,
+                           storage_filepath + self.compression.suffix)
+            else:
+                os.replace(tmp_filepath, storage_filepath)
+
+        except BaseException:
+            for filepath in (tmp_filepath, compressed_filepath):
+                if filepath is not None and path.exists(filepath):
+                    os.unlink(filepath)
+            raise
+
+        return digest
+
+    def _compress_attachment(self, filepath, size):
+        # Compressed copy of filepath, or None if it isn't worth it. Already
+        # compressed formats barely shrink, keep those as they are
+        compression = self.compression
+        if (compression is None or size < self.compression_threshold or
+                (compression.MAX_SIZE is not None and
+                 size > compression.MAX_SIZE)):
+            return None
+
+        fd, compressed_filepath = tempfile.mkstemp(
+            dir=self._files_path, prefix='.upload-')
+        with open(filepath, 'rb') as src, os.fdopen(fd, 'wb') as dst:
+            compression.copy_stream(
+                src, dst, size, chunk_size=self.ATTACHMENT_CHUNK_SIZE)
+            compressed_size = dst.tell()
+
+        if compressed_size > size * 0.9:
+            os.unlink(compressed_filepath)
+            return None
+
+        return compressed_filepath
+
     def read(self, key):
-        qs = self.sess.query(Record)
-        qs = qs.filter(Record.key == key)
-        qs = qs.order_by(Record.timestamp.desc())
-        record = qs.first()
-        if record is None:
+        if self._pending:
+            with self._gc_cond:
+                pending = self._pending.get(key)
+                if pending:
+                    return codecs.decode_stored(pending[-1][1])
+
+        # The cache holds encoded (codec, bytes) so every read decodes a
+        # value of its own, callers may modify it
+        try:
+            (codec, data) = self.cache.get(key)
+            return codec.decode(data)
+        except KeyError:
+            pass
+
+        epoch = self.cache.epoch
+        with self.session() as sess:
+            head = sess.query(Head.value).filter(Head.key == key).first()
+
+        if head is None:
             raise KeyError(key)
 
-        value = json.loads(record.value)
+        (codec, data) = codecs.stored_bytes(head.value)
+        self.cache.set(key, (codec, data), epoch=epoch)
+
+        return codec.decode(data)
+
+    def read_many(self, keys):
+        ret = {}
+        missing = []
+        for key in dict.fromkeys(keys):
+            if self._pending:
+                with self._gc_cond:
+                    pending = self._pending.get(key)
+                    if pending:
+                        ret[key] = codecs.decode_stored(pending[-1][1])
+                        continue
+
+            try:
+                (codec, data) = self.cache.get(key)
+                ret[key] = codec.decode(data)
+            except KeyError:
+                missing.append(key)
+
+        if not missing:
+            return ret
+
+        # One IN query per batch, SQLite limits bound parameters
+        epoch = self.cache.epoch
+        with self.session() as sess:
+            for idx in range(0, len(missing), self.RANGE_BATCH_SIZE):
+                batch = missing[idx:idx + self.RANGE_BATCH_SIZE]
+                qs = sess.query(Head.key, Head.value)
+                qs = qs.filter(Head.key.in_(batch))
+                for (key, stored) in qs:
+                    (codec, data) = codecs.stored_bytes(stored)
+                    self.cache.set(key, (codec, data), epoch=epoch)
+                    ret[key] = codec.decode(data)
+
+        return ret
+
+    def submit(self, key, value, attachment=None):
+        # Queues a write for group commit. Returns a
+        # concurrent.futures.Future resolved once the write is durable
+        if not self.group_commit:
+            raise TypeError('group commit is disabled')
+
+        row = dict(key=key, value=self._encode(value), attachment=None)
+        if attachment is not None:
+            row['attachment'] = self._store_attachment(attachment)
+
+        return self._enqueue([row])
+
+    def _enqueue(self, rows):
+        fut = concurrent.futures.Future()
+
+        with self._gc_cond:
+            if self._gc_closed:
+                raise ValueError('storage is closed')
+
+            for row in rows:
+                # Strictly increasing timestamps, many writes to the same key
+                # can land within the same clock tick
+                ts = max(time.time(), self._gc_last_timestamp + 1e-6)
+                self._gc_last_timestamp = row['timestamp'] = ts
+
+                # Encoded, reads decode their own copy
+                self._pending.setdefault(row['key'], []).append(
+                    (ts, row['value']))
+                self._gc_queue.append((row, fut))
+
+            self._gc_remaining[fut] = len(rows)
+            self._gc_cond.notify_all()
+
+        return fut
+
+    def _group_committer(self):
+        while True:
+            batch = self._take_batch()
+            if batch is None:
+                return
+
+            rows = [row for (row, fut) in batch]
+            t0 = time.perf_counter()
+
+            try:
+                with self.session() as sess:
+                    sess.execute(Record.__table__.insert(), rows)
+                    self._update_heads(sess, rows)
+                    sess.commit()
+
+            except Exception as e:
+                error = e
+
+            else:
+                error = None
+
+            latency = time.perf_counter() - t0
+
+            done, failed = [], set()
+
+            with self._gc_cond:
+                for (row, fut) in batch:
+                    pending = self._pending[row['key']]
+                    pending.pop(0)
+                    if not pending:
+                        del self._pending[row['key']]
+
+                    if fut not in self._gc_remaining:
+                        continue
 
-        return value
+                    if error is not None:
+                        del self._gc_remaining[fut]
+                        failed.add(fut)
+                        continue
+
+                    self._gc_remaining[fut] -= 1
+                    if not self._gc_remaining[fut]:
+                        del self._gc_remaining[fut]
+                        done.append(fut)
+
+                self._gc_stats['flushes'] += 1
+                self._gc_stats['records'] += len(rows)
+                self._gc_stats['last_flush_latency'] = latency
+                self._gc_stats['total_flush_latency'] += latency
+                self._gc_stats['max_flush_latency'] = max(
+                    latency, self._gc_stats['max_flush_latency'])
+
+            if error is None:
+                heads = {x['key']: x['timestamp'] for x in rows}
+                for (key, timestamp) in heads.items():
+                    self.cache.discard(key)
+                    self._notify(key, timestamp)
+
+            for fut in failed:
+                fut.set_exception(error)
+
+            for fut in done:
+                fut.set_result(None)
+
+    def _take_batch(self):
+        with self._gc_cond:
+            while not self._gc_queue:
+                if self._gc_closed:
+                    return None
+                self._gc_cond.wait()
+
+            # Give other writers the chance to join this batch
+            deadline = time.monotonic() + self.group_commit_interval
+            while (len(self._gc_queue) < self.group_commit_size and
+                   not self._gc_closed):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._gc_cond.wait(remaining)
+
+            n = min(len(self._gc_queue), self.group_commit_size)
+            return [self._gc_queue.popleft() for dummy in range(n)]
 
     def write(self, key, value, attachment=None):
-        record = Record(key=key, value=json.dumps(value))
+        if self.group_commit:
+            self.submit(key, value, attachment).result()
+            return
 
+        digest = None
         if attachment is not None:
-            sha1 = hashlib.sha1()
-            sha1.update(attachment)
-            digest = sha1.hexdigest()
+            digest = self._store_attachment(attachment)
 
-            record.attachment = digest
-            storage_filepath = self._storage_filepath_for_attachment(digest)
+        self._write_record(key, value, digest)
 
-            os.makedirs(path.dirname(storage_filepath), exist_ok=True)
-            with open(storage_filepath, 'wb') as fh:
-                fh.write(attachment)
+    def _write_record(self, key, value, digest):
+        if self.group_commit:
+            row = dict(key=key, value=self._encode(value), attachment=digest)
+            self._enqueue([row]).result()
+            return
+
+        record = Record(key=key, value=self._encode(value), timestamp=time.time(),
+                        attachment=digest)
+
+        head = dict(
+            key=record.key,
+            timestamp=record.timestamp,
+            value=record.value)
+
+        with self.session() as sess:
+            sess.add(record)
+            self._update_heads(sess, [head])
+            sess.commit()
+
+        self.cache.discard(key)
+        self._notify(key, head['timestamp'])
+
+    def write_many(self, messages):
+        if self.group_commit:
+            rows = [
+                dict(key=key, value=self._encode(value), attachment=None)
+                for (key, value) in messages
+            ]
+            if rows:
+                self._enqueue(rows).result()
+            return
 
-        self.sess.add(record)
-        self.sess.commit()
+        # Spread timestamps so repeated keys within a batch keep their order
+        # and don't collide on the (key, timestamp) primary key
+        now = time.time()
+        rows = [
+            dict(key=key, value=self._encode(value), timestamp=now + idx * 1e-6)
+            for (idx, (key, value)) in enumerate(messages)
+        ]
+        if not rows:
+            return
 
-    def backlog(self, key):
-        qs = self.sess.query(Record)
-        qs = qs.filter(Record.key == key)
-        qs = qs.order_by(Record.timestamp.desc())
+        with self.session() as sess:
+            sess.execute(Record.__table__.insert(), rows)
+            self._update_heads(sess, rows)
+            sess.commit()
 
-        # Control if at least one result was yelded instead of using qs.count() for efficience
-        yielded = False
-        for res in qs:
-            yield (res.timestamp, json.loads(res.value))
-            yielded = True
+        heads = {x['key']: x['timestamp'] for x in rows}
+        for (key, timestamp) in heads.items():
+            self.cache.discard(key)
+            self._notify(key, timestamp)
 
-        if not yielded:
+    def range(self, key, start=None, end=None):
+        # A range scan over the (key, timestamp) primary key, rows are
+        # fetched in batches instead of loading the whole result
+        with self.session() as sess:
+            qs = sess.query(Record.timestamp, Record.value)
+            qs = qs.filter(Record.key == key)
+            if start is not None:
+                qs = qs.filter(Record.timestamp >= start)
+            if end is not None:
+                qs = qs.filter(Record.timestamp < end)
+            qs = qs.order_by(Record.timestamp.asc())
+            qs = qs.yield_per(self.RANGE_BATCH_SIZE)
+
+            yielded = False
+            for res in qs:
+                yield (res.timestamp, codecs.decode_stored(res.value))
+                yielded = True
+
+            # An empty range is fine as long as the key exists
+            if not yielded and not self._key_exists(sess, key):
+                raise KeyError(key)
+
+    def timeseries(self, key, start=None, end=None):
+        # Bulk variant of range(): one core query, all rows fetched at once
+        # and without building ORM rows
+        table = Record.__table__
+        stmt = sa.select([table.c.timestamp, table.c.value])
+        stmt = stmt.where(table.c.key == key)
+        if start is not None:
+            stmt = stmt.where(table.c.timestamp >= start)
+        if end is not None:
+            stmt = stmt.where(table.c.timestamp < end)
+        stmt = stmt.order_by(table.c.timestamp.asc())
+
+        with self.session() as sess:
+            rows = sess.execute(stmt).fetchall()
+            if not rows and not self._key_exists(sess, key):
+                raise KeyError(key)
+
+        timestamps = [x[0] for x in rows]
+        values = [codecs.decode_stored(x[1]) for x in rows]
+
+        return timestamps, values
+
+    def _attachment_digest(self, key, timestamp=None):
+        with self.session() as sess:
+            qs = sess.query(Record.attachment)
+            qs = qs.filter(Record.key == key)
+            if timestamp is None:
+                qs = qs.order_by(Record.timestamp.desc())
+            else:
+                qs = qs.filter(Record.timestamp == timestamp)
+
+            row = qs.first()
+
+        if row is None or row.attachment is None:
             raise KeyError(key)
+
+        return row.attachment
+
+    def _open_stored_attachment(self, digest):
+        # (fh, stored size, compression or None) for the file of digest
+        filepath, compression = self._find_attachment(digest)
+        if filepath.endswith(self.MANIFEST_SUFFIX):
+            fh = gcchunking.ChunkedReader(
+                self._load_manifest(filepath), self._read_chunk)
+            return (fh, fh.size, None)
+
+        try:
+            fh = open(filepath, 'rb')
+        except FileNotFoundError as e:
+            raise KeyError(digest) from e
+
+        return (fh, os.fstat(fh.fileno()).st_size, compression)
+
+    def open_attachment(self, key, timestamp=None):
+        digest = self._attachment_digest(key, timestamp)
+        return (digest,) + self.open_attachment_by_digest(digest)
+
+    def open_attachment_encoded(self, key, timestamp=None):
+        digest = self._attachment_digest(key, timestamp)
+        fh, size, compression = self._open_stored_attachment(digest)
+        encoding = compression.name if compression is not None else None
+        return (digest, fh, size, encoding)
+
+    def backlog(self, key, limit=None, before=None, after=None):
+        for (ts, stored) in self._backlog_rows(key, limit, before, after):
+            yield (ts, codecs.decode_stored(stored))
+
+    def backlog_raw(self, key, limit=None, before=None, after=None):
+        for (ts, stored) in self._backlog_rows(key, limit, before, after):
+            yield (ts,) + codecs.stored_bytes(stored)
+
+    def latest_timestamp(self, key):
+        if self._pending:
+            with self._gc_cond:
+                pending = self._pending.get(key)
+                if pending:
+                    return pending[-1][0]
+
+        with self.session() as sess:
+            head = sess.query(Head.timestamp).filter(Head.key == key).first()
+
+        if head is None:
+            raise KeyError(key)
+
+        return head.timestamp
+
+    def backlog_summary(self, key):
+        with self.session() as sess:
+            (oldest, latest, count) = sess.query(
+                sa.func.min(Record.timestamp), sa.func.max(Record.timestamp),
+                sa.func.count()).filter(Record.key == key).one()
+
+        # Group commit rows not flushed yet are newer than any in the table
+        if self._pending:
+            with self._gc_cond:
+                pending = [ts for (ts, value) in self._pending.get(key, ())]
+            if pending:
+                if not count:
+                    oldest = pending[0]
+                latest = pending[-1]
+                count += len(pending)
+
+        if not count:
+            raise KeyError(key)
+
+        return (oldest, latest, count)
+
+    def read_raw(self, key):
+        # Shares read()'s cache, which holds values encoded
+        if self._pending:
+            with self._gc_cond:
+                pending = self._pending.get(key)
+                if pending:
+                    return codecs.stored_bytes(pending[-1][1])
+
+        try:
+            return self.cache.get(key)
+        except KeyError:
+            pass
+
+        epoch = self.cache.epoch
+        with self.session() as sess:
+            head = sess.query(Head.value).filter(Head.key == key).first()
+
+        if head is None:
+            raise KeyError(key)
+
+        (codec, data) = codecs.stored_bytes(head.value)
+        self.cache.set(key, (codec, data), epoch=epoch)
+
+        return (codec, data)
+
+    def _backlog_rows(self, key, limit, before, after):
+        with self.session() as sess:
+            qs = sess.query(Record.timestamp, Record.value)
+            qs = qs.filter(Record.key == key)
+            if before is not None:
+                qs = qs.filter(Record.timestamp < before)
+            if after is not None:
+                qs = qs.filter(Record.timestamp > after)
+            qs = qs.order_by(Record.timestamp.desc())
+            if limit is not None:
+                qs = qs.limit(limit)
+
+            # Control if at least one result was yelded instead of using qs.count() for efficience
+            yielded = False
+            for res in qs:
+                yield (res.timestamp, res.value)
+                yielded = True
+
+            # An empty page is fine as long as the key exists
+            if not yielded and not self._key_exists(sess, key):
+                raise KeyError(key)
+
+    def keys(self, prefix=None):
+        with self.session() as sess:
+            qs = sess.query(Head.key)
+            if prefix is not None:
+                qs = qs.filter(Head.key.startswith(prefix, autoescape=True))
+            qs = qs.order_by(Head.key.asc())
+            qs = qs.yield_per(self.RANGE_BATCH_SIZE)
+
+            for res in qs:
+                yield res.key
+
+    def expire(self, key, keep_last=None, max_age=None, limit=1000):
+        with self.session() as sess:
+            latest = sess.query(Head.timestamp).filter(Head.key == key).first()
+            if latest is None:
+                return (0, set())
+
+            def _nth_newest(n):
+                qs = sess.query(Record.timestamp)
+                qs = qs.filter(Record.key == key)
+                qs = qs.order_by(Record.timestamp.desc())
+                row = qs.offset(n - 1).first()
+                if row is None:
+                    raise IndexError(n)
+
+                return row.timestamp
+
+            cutoff = grandcentral.storage._expire_cutoff(
+                latest.timestamp, keep_last, max_age, _nth_newest)
+
+            qs = sess.query(Record.timestamp, Record.attachment)
+            qs = qs.filter(Record.key == key)
+            qs = qs.filter(Record.timestamp < cutoff)
+            qs = qs.order_by(Record.timestamp.asc())
+            rows = qs.limit(limit).all()
+            if not rows:
+                return (0, set())
+
+            qs = sess.query(Record)
+            qs = qs.filter(Record.key == key)
+            qs = qs.filter(Record.timestamp.in_([x.timestamp for x in rows]))
+            qs.delete(synchronize_session=False)
+            sess.commit()
+
+        self._notify_expired(key, rows[-1].timestamp)
+
+        digests = set(x.attachment for x in rows if x.attachment is not None)
+        return (len(rows), digests)
+
+    def collect_attachments(self, digests):
+        digests = set(digests) | self.pending_attachments()
+        return self._remove_attachments(
+            digests - self.referenced_attachments(digests))
+
+    def pending_attachments(self):
+        # Takes the digests a previous collection skipped for being within
+        # the grace period
+        with self._files_lock:
+            (pending, self._collect_pending) = (self._collect_pending, set())
+
+        return pending
+
+    def referenced_attachments(self, digests):
+        # Subset of digests still referenced by some record
+        referenced = set()
+        with self.session() as sess:
+            for digest in digests:
+                qs = sess.query(Record.key)
+                qs = qs.filter(Record.attachment == digest)
+                if qs.first() is not None:
+                    referenced.add(digest)
+
+        return referenced
+
+    def _remove_attachments(self, digests):
+        removed, reclaimed = 0, 0
+        grace_limit = time.time() - self.ATTACHMENT_GRACE_PERIOD
+
+        for digest in digests:
+            try:
+                filepath, dummy = self._find_attachment(digest)
+            except KeyError:
+                continue
+
+            if filepath.endswith(self.MANIFEST_SUFFIX):
+                size = self._chunk_index._unlink_indexed(
+                    ChunkRef, ChunkRef.attachment == digest, filepath,
+                    grace_limit)
+            else:
+                size = self._unlink_expired(filepath, grace_limit)
+
+            if size is None:
+                if path.exists(filepath):
+                    with self._files_lock:
+                        self._collect_pending.add(digest)
+                continue
+
+            removed += 1
+            reclaimed += size
+
+        (files, size) = self._chunk_index._collect_chunks()
+        return (removed + files, reclaimed + size)
+
+    def _unlink_indexed(self, model, criterion, filepath, grace_limit,
+                        require_rows=False):
+        # _unlink_expired() of a file along with its chunk index rows. The
+        # rows are deleted first and committed after the unlink: meanwhile
+        # the database write lock is held, so a concurrent store of the same
+        # file (which indexes it once written) can't have its rows deleted
+        # from under it. Nothing is deleted if the file stays, nor with
+        # require_rows if no row matched
+        with self.session() as sess:
+            deleted = sess.query(model).filter(criterion).delete(
+                synchronize_session=False)
+            if require_rows and not deleted:
+                return None
+
+            size = self._unlink_expired(filepath, grace_limit)
+            if size is None and path.exists(filepath):
+                sess.rollback()
+            else:
+                sess.commit()
+
+        return size
+
+    def _collect_chunks(self):
+        # Removes the stored chunks no manifest references. Same grace
+        # period as attachments: chunks are touched when stored again or
+        # reported as present by missing_chunks(), before their manifest is
+        # written
+        grace_limit = time.time() - self.ATTACHMENT_GRACE_PERIOD
+
+        unreferenced = ~sa.exists().where(ChunkRef.chunk == Chunk.digest)
+        with self.session() as sess:
+            digests = [
+                x.digest for x in sess.query(Chunk.digest).filter(unreferenced)
+            ]
+
+        removed, reclaimed = 0, 0
+        for digest in digests:
+            try:
+                filepath, dummy = self._find_stored(
+                    self._storage_filepath_for_chunk(digest), digest)
+            except KeyError:
+                # Gone already, drop the row
+                filepath = self._storage_filepath_for_chunk(digest)
+
+            size = self._unlink_indexed(
+                Chunk, sa.and_(Chunk.digest == digest, unreferenced),
+                filepath, grace_limit, require_rows=True)
+            if size is not None:
+                removed += 1
+                reclaimed += size
+
+        return (removed, reclaimed)
+
+    def vacuum(self, pages=None):
+        # Incremental vacuum, returns the bytes given back to the filesystem
+        with self._connection_lock, self.engine.connect() as conn:
+            page_size = conn.execute('PRAGMA page_size').scalar()
+            before = conn.execute('PRAGMA freelist_count').scalar()
+
+            if pages is None:
+                conn.execute('PRAGMA incremental_vacuum')
+            else:
+                conn.execute('PRAGMA incremental_vacuum({:d})'.format(pages))
+
+            after = conn.execute('PRAGMA freelist_count').scalar()
+
+        return max(before - after, 0) * page_size
+
+    def last_seq(self):
+        with self.session() as sess:
+            return sess.query(Sequence.value).filter(
+                Sequence.name == 'records').scalar() or 0
+
+    def changes(self, since=0, limit=None):
+        table = Record.__table__
+        stmt = sa.select([
+            table.c.seq, table.c.key, table.c.timestamp, table.c.value,
+            table.c.attachment])
+        stmt = stmt.where(table.c.seq > since)
+        stmt = stmt.order_by(table.c.seq.asc())
+        if limit is not None:
+            stmt = stmt.limit(limit)
+
+        with self.session() as sess:
+            rows = sess.execute(stmt).fetchall()
+
+        for (seq, key, ts, value, attachment) in rows:
+            yield (seq, key, ts, codecs.decode_stored(value), attachment)
+
+    def export(self, prefix=None, start=None, end=None):
+        # Streamed from the database cursor, RANGE_BATCH_SIZE rows at a time
+        with self.session() as sess:
+            qs = sess.query(Record.key, Record.timestamp, Record.value)
+            if prefix is not None:
+                qs = qs.filter(Record.key.startswith(prefix, autoescape=True))
+            if start is not None:
+                qs = qs.filter(Record.timestamp >= start)
+            if end is not None:
+                qs = qs.filter(Record.timestamp < end)
+            qs = qs.order_by(Record.key.asc(), Record.timestamp.asc())
+            qs = qs.yield_per(self.RANGE_BATCH_SIZE)
+
+            for (key, ts, value) in qs:
+                yield (key, ts, codecs.decode_stored(value))
+
+    def import_records(self, records):
+        rows = [
+            dict(key=key, timestamp=ts, value=self._encode(value))
+            for (key, ts, value) in records
+        ]
+        if not rows:
+            return
+
+        keys = list(dict.fromkeys(x['key'] for x in rows))
+        heads = []
+        with self.session() as sess:
+            sess.execute(Record.__table__.insert().prefix_with('OR IGNORE'),
+                         rows)
+
+            # Imported records can be older than the current heads
+            for idx in range(0, len(keys), self.RANGE_BATCH_SIZE):
+                batch = keys[idx:idx + self.RANGE_BATCH_SIZE]
+                self._refresh_heads(sess, batch)
+                heads.extend(
+                    sess.query(Head.key, Head.timestamp).filter(
+                        Head.key.in_(batch)))
+            sess.commit()
+
+        for (key, timestamp) in heads:
+            self.cache.discard(key)
+            self._notify(key, timestamp)
+
+    def _refresh_heads(self, sess, keys):
+        records = Record.__table__.alias('r')
+        latest = sa.select([sa.func.max(Record.__table__.c.timestamp)])
+        latest = latest.where(Record.__table__.c.key == records.c.key)
+        stmt = sa.select([records.c.key, records.c.timestamp, records.c.value])
+        stmt = stmt.where(records.c.key.in_(keys))
+        stmt = stmt.where(records.c.timestamp == latest.scalar_subquery())
+        sess.execute(
+            Head.__table__.insert().prefix_with('OR REPLACE').from_select(
+                ['key', 'timestamp', 'value'], stmt))
+
+    def apply_changes(self, changes):
+        rows = [
+            dict(seq=seq, key=key, timestamp=ts, value=self._encode(value),
+                 attachment=attachment)
+            for (seq, key, ts, value, attachment) in changes
+        ]
+        if not rows:
+            return
+
+        # Replayed changes are skipped, so a batch can be applied again
+        with self.session() as sess:
+            sess.execute(Record.__table__.insert().prefix_with('OR IGNORE'),
+                         rows)
+            self._update_heads(sess, rows)
+            sess.commit()
+
+        heads = {x['key']: x['timestamp'] for x in rows}
+        for (key, timestamp) in heads.items():
+            self.cache.discard(key)
+            self._notify(key, timestamp)
+
+    def has_attachment(self, digest):
+        try:
+            self._find_attachment(digest)
+        except KeyError:
+            return False
+
+        return True
+
+    def open_attachment_by_digest(self, digest):
+        # digest comes from URLs, don't let it wander out of files/
+        if not DIGEST_RE.fullmatch(digest):
+            raise KeyError(digest)
+
+        fh, size, compression = self._open_stored_attachment(digest)
+        if compression is None:
+            return (fh, size)
+
+        size = compression.uncompressed_size(fh)
+        return (gccompression.DecompressingReader(fh, compression), size)
+
+    def import_attachment(self, digest, attachment):
+        # Stores attachment, which must hash to digest
+        stored = self._store_attachment(attachment)
+        if stored != digest:
+            raise ValueError(
+                "attachment content doesn't match {}".format(digest))
+
+    def missing_chunks(self, digests):
+        # Subset of digests (same order) without a stored chunk. The stored
+        # ones are touched, an upload is about to reference them
+        missing = []
+        for digest in digests:
+            try:
+                filepath, dummy = self._find_stored(
+                    self._storage_filepath_for_chunk(digest), digest)
+            except KeyError:
+                missing.append(digest)
+                continue
+
+            if not self._touch(filepath):
+                missing.append(digest)
+
+        return missing
+
+    def store_chunk(self, digest, data):
+        # Stores data, which must hash to digest, as a chunk
+        if hashlib.sha1(data).hexdigest() != digest:
+            raise ValueError("chunk content doesn't match {}".format(digest))
+
+        self._store_chunk(digest, data)
+
+    def write_chunked(self, key, value, chunks):
+        # Same as write() with an attachment made of stored chunks, a list
+        # of (chunk digest, size). The whole content is hashed again from
+        # the chunks so its digest can be trusted
+        chunks = [(chunk, int(size)) for (chunk, size) in chunks]
+        missing = self.missing_chunks([chunk for (chunk, size) in chunks])
+        if missing:
+            raise ValueError('missing chunks: {}'.format(', '.join(missing)))
+
+        sha1 = hashlib.sha1()
+        for (chunk, size) in chunks:
+            try:
+                data = self._read_chunk(chunk)
+            except KeyError as e:
+                raise ValueError('missing chunks: {}'.format(chunk)) from e
+
+            if len(data) != size:
+                raise ValueError(
+                    'chunk {} is {} bytes, not {}'.format(
+                        chunk, len(data), size))
+            sha1.update(data)
+
+        digest = sha1.hexdigest()
+        self._store_manifest(digest, chunks)
+        self._write_record(key, value, digest)
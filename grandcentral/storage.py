@@ -18,10 +18,18 @@
 # USA.
 
 
+from grandcentral import codecs
+
+
 import abc
+import bisect
+import time
 
 
 class BaseStorage:
+    # Set by the API to a grandcentral.signaler.Signaler
+    signaler = None
+
     @abc.abstractmethod
     def read(self, key):
         raise NotImplementedError()
@@ -31,28 +39,298 @@ class BaseStorage:
         raise NotImplementedError()
 
     @abc.abstractmethod
-    def backlog(self, key):
+    def backlog(self, key, limit=None, before=None, after=None):
+        # Yields (timestamp, value) tuples, newest first, with timestamps
+        # strictly between after and before
+        raise NotImplementedError()
+
+    @abc.abstractmethod
+    def range(self, key, start=None, end=None):
+        # Yields (timestamp, value) tuples, oldest first, with
+        # start <= timestamp < end
+        raise NotImplementedError()
+
+    @abc.abstractmethod
+    def open_attachment(self, key, timestamp=None):
+        # Returns a (digest, binary file object, size) tuple for the latest
+        # record of key (or the one at timestamp)
+        raise NotImplementedError()
+
+    @abc.abstractmethod
+    def keys(self, prefix=None):
+        # Yields stored keys in order
+        raise NotImplementedError()
+
+    @abc.abstractmethod
+    def expire(self, key, keep_last=None, max_age=None, limit=1000):
+        # Deletes up to limit records of key that are not among its last
+        # keep_last ones or are older than max_age seconds. The latest
+        # record is always kept. Returns a (deleted rows, set of attachment
+        # digests they referenced) tuple
         raise NotImplementedError()
 
+    def collect_attachments(self, digests):
+        # Removes the attachments no record references anymore. Ones too
+        # recent to remove are retried by later calls, digests can be empty.
+        # Returns a (removed files, reclaimed bytes) tuple
+        return (0, 0)
+
+    def vacuum(self, pages=None):
+        # Returns reclaimed bytes. Backends reclaiming space in steps do at
+        # most pages of them, all of them if None
+        return 0
+
+    def changes(self, since=0, limit=None):
+        # Yields (seq, key, timestamp, value, attachment digest) tuples of
+        # every record with seq > since, in seq order. Only backends with a
+        # global sequence implement it
+        raise NotImplementedError()
+
+    def open_attachment_by_digest(self, digest):
+        # Returns (file object, size) of the attachment with that digest
+        raise KeyError(digest)
+
+    def open_attachment_encoded(self, key, timestamp=None):
+        # Same as open_attachment() but the file object is the stored one,
+        # with its content coding name (or None) appended to the tuple
+        return self.open_attachment(key, timestamp=timestamp) + (None,)
+
+    def latest_timestamp(self, key):
+        # Timestamp of the latest record of key, without decoding its value
+        for (ts, value) in self.backlog(key, limit=1):
+            return ts
+
+        raise KeyError(key)
+
+    def backlog_summary(self, key):
+        # (oldest timestamp, latest timestamp, number of records) of key,
+        # without decoding values. Any write, import or expire touching the
+        # backlog changes it
+        count = 0
+        for (ts, codec, data) in self.backlog_raw(key):
+            if not count:
+                latest = ts
+            oldest = ts
+            count += 1
+
+        if not count:
+            raise KeyError(key)
+
+        return (oldest, latest, count)
+
+    def read_raw(self, key):
+        # Latest value of key as a (codec, encoded bytes) tuple. Backends
+        # keeping encoded values return them as stored so they can be sent
+        # as is
+        return (codecs.JSON, codecs.JSON.encode(self.read(key)))
+
+    def backlog_raw(self, key, limit=None, before=None, after=None):
+        # Same as backlog() but yielding (timestamp, codec, encoded bytes)
+        for (ts, value) in self.backlog(
+                key, limit=limit, before=before, after=after):
+            yield (ts, codecs.JSON, codecs.JSON.encode(value))
+
+    def read_many(self, keys):
+        # Latest values of keys as a {key: value} dict, missing keys are
+        # left out
+        ret = {}
+        for key in keys:
+            try:
+                ret[key] = self.read(key)
+            except KeyError:
+                pass
+
+        return ret
+
+    def export(self, prefix=None, start=None, end=None):
+        # Yields (key, timestamp, value) of every record, by key and then
+        # timestamp, with start <= timestamp < end
+        for key in self.keys(prefix=prefix):
+            try:
+                for (ts, value) in self.range(key, start=start, end=end):
+                    yield (key, ts, value)
+            except KeyError:
+                # Expired meanwhile
+                pass
+
+    def import_records(self, records):
+        # Stores (key, timestamp, value) tuples keeping their timestamps.
+        # Records already stored (same key and timestamp) are skipped
+        raise NotImplementedError()
+
+    # Chunked attachments: clients split attachments with
+    # grandcentral.chunking.Chunker, upload only the chunks missing_chunks()
+    # reports and then write the record with the list of chunks. Only
+    # backends with a chunk store implement these
+
+    def missing_chunks(self, digests):
+        # Subset of chunk digests not stored yet
+        raise NotImplementedError()
+
+    def store_chunk(self, digest, data):
+        # Stores bytes data, which must hash (sha1) to digest
+        raise NotImplementedError()
+
+    def write_chunked(self, key, value, chunks):
+        # Same as write() with an attachment made of stored chunks, a list
+        # of (chunk digest, size) tuples. Raises ValueError if some chunk is
+        # missing or its size doesn't match
+        raise NotImplementedError()
+
+    def write_many(self, messages):
+        # Fallback for backends without a native bulk path
+        for (key, value) in messages:
+            self.write(key, value)
+
+    def close(self):
+        pass
+
+    def timeseries(self, key, start=None, end=None):
+        # Same rows as range() as two parallel lists, (timestamps, values)
+        timestamps, values = [], []
+        for (ts, value) in self.range(key, start=start, end=end):
+            timestamps.append(ts)
+            values.append(value)
+
+        return timestamps, values
+
+    def _notify(self, key, timestamp):
+        if self.signaler is not None:
+            self.signaler.publish(key, timestamp)
+
+    def _notify_expired(self, key, timestamp):
+        # Records of key up to timestamp are gone
+        if self.signaler is not None:
+            self.signaler.publish_expired(key, timestamp)
+
 
 class MemoryStorage(BaseStorage):
     def __init__(self):
+        # key -> ([timestamps], [values]), both in write order
         self._mem = dict()
 
     def read(self, key):
-        return self._mem[key][-1]
+        return self._mem[key][1][-1]
+
+    def latest_timestamp(self, key):
+        return self._mem[key][0][-1]
+
+    def backlog_summary(self, key):
+        timestamps = self._mem[key][0]
+        return (timestamps[0], timestamps[-1], len(timestamps))
 
     def write(self, key, value, attachment=None):
         if attachment is not None:
             raise NotImplementedError()
 
+        self._notify(key, self._append(key, value))
+
+    def write_many(self, messages):
+        for (key, value) in messages:
+            self._notify(key, self._append(key, value))
+
+    def import_records(self, records):
+        for (key, ts, value) in records:
+            timestamps, values = self._mem.setdefault(key, ([], []))
+            idx = bisect.bisect_left(timestamps, ts)
+            if idx < len(timestamps) and timestamps[idx] == ts:
+                continue
+
+            timestamps.insert(idx, ts)
+            values.insert(idx, value)
+            if idx == len(timestamps) - 1:
+                self._notify(key, ts)
+
+    def _append(self, key, value):
+        timestamps, values = self._mem.setdefault(key, ([], []))
+
+        # Keep timestamps strictly increasing so they can be used as cursors
+        ts = time.time()
+        if timestamps and ts <= timestamps[-1]:
+            ts = timestamps[-1] + 1e-6
+
+        timestamps.append(ts)
+        values.append(value)
+
+        return ts
+
+    def backlog(self, key, limit=None, before=None, after=None):
+        if key not in self._mem:
+            raise KeyError(key)
+
+        timestamps, values = self._mem[key]
+        lo = 0 if after is None else bisect.bisect_right(timestamps, after)
+        hi = (len(timestamps) if before is None
+              else bisect.bisect_left(timestamps, before))
+        if limit is not None:
+            lo = max(lo, hi - limit)
+
+        for idx in range(hi - 1, lo - 1, -1):
+            yield (timestamps[idx], values[idx])
+
+    def range(self, key, start=None, end=None):
         if key not in self._mem:
-            self._mem[key] = []
+            raise KeyError(key)
 
-        self._mem[key].append(value)
+        timestamps, values = self._mem[key]
+        lo = 0 if start is None else bisect.bisect_left(timestamps, start)
+        hi = (len(timestamps) if end is None
+              else bisect.bisect_left(timestamps, end))
 
-    def backlog(self, key):
+        for idx in range(lo, hi):
+            yield (timestamps[idx], values[idx])
+
+    def timeseries(self, key, start=None, end=None):
         if key not in self._mem:
             raise KeyError(key)
 
-        yield from reversed(self._mem[key])
+        timestamps, values = self._mem[key]
+        lo = 0 if start is None else bisect.bisect_left(timestamps, start)
+        hi = (len(timestamps) if end is None
+              else bisect.bisect_left(timestamps, end))
+
+        return timestamps[lo:hi], values[lo:hi]
+
+    def open_attachment(self, key, timestamp=None):
+        # Attachments are not supported, so there is never one to open
+        raise KeyError(key)
+
+    def keys(self, prefix=None):
+        for key in sorted(self._mem):
+            if prefix is None or key.startswith(prefix):
+                yield key
+
+    def expire(self, key, keep_last=None, max_age=None, limit=1000):
+        if key not in self._mem:
+            return (0, set())
+
+        timestamps, values = self._mem[key]
+        cutoff = _expire_cutoff(timestamps[-1], keep_last, max_age,
+                                lambda n: timestamps[-n])
+        n = min(bisect.bisect_left(timestamps, cutoff), limit)
+        if n:
+            self._notify_expired(key, timestamps[n - 1])
+
+        del timestamps[:n]
+        del values[:n]
+
+        return (n, set())
+
+
+def _expire_cutoff(latest, keep_last, max_age, nth_newest):
+    # Records older than the returned timestamp are out of the retention
+    # policy. nth_newest(n) returns the timestamp of the nth newest record
+    # or raises IndexError
+    cutoff = float('-inf')
+
+    if keep_last is not None:
+        try:
+            cutoff = max(cutoff, nth_newest(max(keep_last, 1)))
+        except IndexError:
+            pass
+
+    if max_age is not None:
+        cutoff = max(cutoff, time.time() - max_age)
+
+    # Never expire the latest record
+    return min(cutoff, latest)
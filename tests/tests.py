@@ -23,20 +23,50 @@ import unittest.mock
 
 import asyncio
 import binascii
+import email.utils
+import gzip
+import hashlib
+import io
 import json
+import os
+import pathlib
+import random
+import socketserver
+import sqlite3
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
 import warnings
+import wsgiref.simple_server
 
 import grandcentral
+from grandcentral import aioserver
+from grandcentral import asyncstorage
 from grandcentral import asyncutils
+from grandcentral import cache
+from grandcentral import chunking
+from grandcentral import codecs
+from grandcentral import compaction
+from grandcentral import logstorage
+from grandcentral import metrics
+from grandcentral import replication
+from grandcentral import ringstorage
+from grandcentral import series
+from grandcentral import signaler
 
 try:
+    import sqlalchemy
     import grandcentral.sqlalchemystorage
+    from grandcentral import shardedstorage
     _sqlalchemy_storage_enabled = True
 except ImportError:
     _sqlalchemy_storage_enabled = False
     warnings.warn('sqlalchemy storage disabled, install sqlalchemy')
 
 
+import aiohttp.web
 import falcon.testing
 
 
@@ -63,6 +93,178 @@ class TestUtils(unittest.TestCase):
         )
 
 
+class TestLRUCache(unittest.TestCase):
+    def test_eviction(self):
+        c = cache.LRUCache(maxsize=2)
+        c.set('a', 1)
+        c.set('b', 2)
+        c.get('a')
+        c.set('c', 3)
+
+        with self.assertRaises(KeyError):
+            c.get('b')
+
+        self.assertEqual(c.get('a'), 1)
+        self.assertEqual(c.get('c'), 3)
+        self.assertEqual((c.hits, c.misses), (3, 1))
+
+    def test_stale_epoch_is_not_cached(self):
+        c = cache.LRUCache()
+        epoch = c.epoch
+        c.discard('a')
+        c.set('a', 1, epoch=epoch)
+
+        with self.assertRaises(KeyError):
+            c.get('a')
+
+
+class TestSignaler(unittest.TestCase):
+    def test_wait_timeout(self):
+        s = signaler.Signaler()
+        self.assertFalse(s.wait('x', 0, timeout=0.01))
+
+    def test_wait_already_changed(self):
+        s = signaler.Signaler()
+        s.publish('x', 2.0)
+        self.assertTrue(s.wait('x', 1.0, timeout=0))
+        self.assertFalse(s.wait('x', 2.0, timeout=0))
+
+    def test_wake_up(self):
+        s = signaler.Signaler()
+        threading.Timer(0.05, s.publish, args=('x', 1.0)).start()
+        self.assertTrue(s.wait('x', 0, timeout=5))
+        self.assertEqual(s._conds, {})
+
+    def test_maxkeys(self):
+        s = signaler.Signaler(maxkeys=2)
+        s.publish('x', 1.0)
+        s.publish('y', 1.0)
+        s.publish('x', 2.0)
+        s.publish('z', 1.0)
+        self.assertEqual(s.latest('x'), 2.0)
+        self.assertIsNone(s.latest('y'))
+        self.assertEqual(len(s._latest), 2)
+
+
+class TestDownsample(unittest.TestCase):
+    TIMESTAMPS = [0, 10, 59, 60, 61, 185]
+    VALUES = [1, 2, 3, 10, 20, 7]
+
+    def assertDownsample(self, agg, expected):
+        for impl in [series._downsample_python, series._downsample_numpy]:
+            if impl is series._downsample_numpy and series.numpy is None:
+                continue
+
+            self.assertEqual(
+                impl(self.TIMESTAMPS, self.VALUES, 60, agg), expected)
+
+    def test_aggregations(self):
+        self.assertDownsample(
+            'mean', [(0.0, 2.0), (60.0, 15.0), (180.0, 7.0)])
+        self.assertDownsample('min', [(0.0, 1), (60.0, 10), (180.0, 7)])
+        self.assertDownsample('max', [(0.0, 3), (60.0, 20), (180.0, 7)])
+        self.assertDownsample('last', [(0.0, 3), (60.0, 20), (180.0, 7)])
+        self.assertDownsample('count', [(0.0, 3), (60.0, 2), (180.0, 1)])
+
+    def test_invalid(self):
+        with self.assertRaises(TypeError):
+            series.downsample([0], ['x'], 60)
+
+        with self.assertRaises(ValueError):
+            series.downsample([0], [1], 60, agg='median')
+
+    def test_cache_invalidation(self):
+        s = signaler.Signaler()
+        c = series.SeriesCache(s)
+        c.set('x', 60, 'mean', 0, 100, [], c.generation('x'))
+        c.set('x', 60, 'mean', 100, None, [], c.generation('x'))
+
+        s.publish('x', 150)
+        self.assertEqual(c.get('x', 60, 'mean', 0, 100), [])
+        with self.assertRaises(KeyError):
+            c.get('x', 60, 'mean', 100, None)
+
+        # Computations that raced with a write are not cached
+        generation = c.generation('x')
+        s.publish('x', 160)
+        c.set('x', 60, 'mean', 100, None, [], generation)
+        with self.assertRaises(KeyError):
+            c.get('x', 60, 'mean', 100, None)
+
+        # Bounded bookkeeping, forgotten keys can't pass for unchanged
+        c = series.SeriesCache(signaler.Signaler(), maxsize=2,
+                               max_generations=2)
+        generation = c.generation('x')
+        c.invalidate('x', 10)
+        c.invalidate('y', 10)
+        c.invalidate('z', 10)
+        self.assertNotEqual(c.generation('x'), generation)
+        c.set('x', 60, 'mean', 0, 100, [], generation)
+        with self.assertRaises(KeyError):
+            c.get('x', 60, 'mean', 0, 100)
+
+        for n in range(10):
+            c.set(str(n), 60, 'mean', 0, 100, [], c.generation(str(n)))
+        self.assertLessEqual(len(c._generations), 2)
+        self.assertLessEqual(len(c._windows), 4)
+
+        c = series.SeriesCache(s)
+
+        # Expirations drop the windows starting at or before the newest
+        # expired record
+        c.set('x', 60, 'mean', 0, 100, [], c.generation('x'))
+        c.set('x', 60, 'mean', 100, 200, [], c.generation('x'))
+        s.publish_expired('x', 50)
+        with self.assertRaises(KeyError):
+            c.get('x', 60, 'mean', 0, 100)
+        self.assertEqual(c.get('x', 60, 'mean', 100, 200), [])
+
+
+def _random_bytes(size, seed=0):
+    return random.Random(seed).getrandbits(size * 8).to_bytes(size, 'little')
+
+
+class TestChunker(unittest.TestCase):
+    def setUp(self):
+        self.chunker = chunking.Chunker(avg_size=1024)
+        self.data = _random_bytes(64 * 1024)
+
+    def test_split(self):
+        chunks = list(self.chunker.split(io.BytesIO(self.data)))
+        self.assertEqual(b''.join(chunks), self.data)
+        self.assertTrue(all(len(x) <= 4096 for x in chunks))
+        self.assertTrue(all(len(x) >= 256 for x in chunks[:-1]))
+
+        chunks, digest = self.chunker.manifest(io.BytesIO(self.data))
+        self.assertEqual(digest, hashlib.sha1(self.data).hexdigest())
+        self.assertEqual(sum(size for (d, size) in chunks), len(self.data))
+
+    def test_insertion_keeps_other_chunks(self):
+        chunks, dummy = self.chunker.manifest(io.BytesIO(self.data))
+        edited = self.data[:30000] + b'inserted' + self.data[30000:]
+        edited_chunks, dummy = self.chunker.manifest(io.BytesIO(edited))
+
+        changed = set(edited_chunks) - set(chunks)
+        self.assertLessEqual(len(changed), 2)
+        self.assertLess(sum(size for (d, size) in changed), 8192)
+
+    def test_reader(self):
+        parts = {hashlib.sha1(x).hexdigest(): x
+                 for x in self.chunker.split(io.BytesIO(self.data))}
+        chunks, dummy = self.chunker.manifest(io.BytesIO(self.data))
+
+        with chunking.ChunkedReader(chunks, parts.__getitem__) as fh:
+            self.assertEqual(fh.size, len(self.data))
+            self.assertEqual(fh.read(), self.data)
+            self.assertEqual(fh.read(), b'')
+
+            fh.seek(1000)
+            self.assertEqual(fh.read(5000), self.data[1000:6000])
+            self.assertEqual(fh.tell(), 6000)
+            fh.seek(-10, 2)
+            self.assertEqual(fh.read(100), self.data[-10:])
+
+
 class StorageTestMixin:
     def setUp(self):
         super().setUp()
@@ -89,21 +291,341 @@ class StorageTestMixin:
         self.storage.write('x', 1)
         self.storage.write('x', 2)
         self.assertEqual(
-            list(self.storage.backlog('x')),
+            [value for (ts, value) in self.storage.backlog('x')],
             [2, 1]
         )
 
+    def test_backlog_pagination(self):
+        for x in range(5):
+            self.storage.write('x', x)
+
+        timestamps = [ts for (ts, value) in self.storage.backlog('x')]
+        self.assertEqual(timestamps, sorted(timestamps, reverse=True))
+
+        page = list(self.storage.backlog('x', limit=2))
+        self.assertEqual([value for (ts, value) in page], [4, 3])
+
+        page = list(self.storage.backlog('x', limit=2, before=page[-1][0]))
+        self.assertEqual([value for (ts, value) in page], [2, 1])
+
+        page = list(self.storage.backlog('x', after=timestamps[2]))
+        self.assertEqual([value for (ts, value) in page], [4, 3])
+
+        # Empty pages of existing keys are not errors
+        self.assertEqual(
+            list(self.storage.backlog('x', before=timestamps[-1])),
+            [])
+
     def test_backlog_missing(self):
         with self.assertRaises(KeyError) as cm:
             list(self.storage.backlog('x'))
 
         self.assertEqual(cm.exception.args[0], 'x')
 
+    def test_range(self):
+        for x in range(5):
+            self.storage.write('x', x)
+
+        timestamps = [ts for (ts, value) in self.storage.range('x')]
+        self.assertEqual(timestamps, sorted(timestamps))
+
+        self.assertEqual(
+            [value for (ts, value) in self.storage.range(
+                'x', start=timestamps[1], end=timestamps[3])],
+            [1, 2])
+        self.assertEqual(
+            list(self.storage.range('x', start=timestamps[-1] + 1)),
+            [])
+
+    def test_timeseries(self):
+        for x in range(3):
+            self.storage.write('x', x)
+
+        timestamps, values = self.storage.timeseries('x')
+        self.assertEqual(values, [0, 1, 2])
+        self.assertEqual(
+            self.storage.timeseries('x', start=timestamps[1]),
+            (timestamps[1:], [1, 2]))
+
+        with self.assertRaises(KeyError):
+            self.storage.timeseries('y')
+
+    def test_range_missing(self):
+        with self.assertRaises(KeyError) as cm:
+            list(self.storage.range('x'))
+
+        self.assertEqual(cm.exception.args[0], 'x')
+
+    def test_write_many(self):
+        self.storage.write_many([('x', 1), ('y', 2), ('x', 3)])
+        self.assertEqual(self.storage.read('x'), 3)
+        self.assertEqual(self.storage.read('y'), 2)
+
+    def test_read_many(self):
+        self.storage.write_many([('x', 1), ('y', 2), ('x', 3)])
+        self.assertEqual(self.storage.read_many(['x', 'z', 'y', 'x']),
+                         {'x': 3, 'y': 2})
+        self.assertEqual(self.storage.read_many([]), {})
+
+    def test_export(self):
+        self.storage.write_many([('b', 1), ('a:1', 2), ('a:2', 3), ('b', 4)])
+        records = list(self.storage.export())
+        self.assertEqual([(key, value) for (key, ts, value) in records],
+                         [('a:1', 2), ('a:2', 3), ('b', 1), ('b', 4)])
+
+        self.assertEqual(
+            [value for (key, ts, value) in self.storage.export(prefix='a:')],
+            [2, 3])
+        self.assertEqual(
+            [value for (key, ts, value) in self.storage.export(
+                start=records[3][1])],
+            [4])
+
+    def test_import_records(self):
+        self.storage.write('x', 'current')
+        try:
+            self.storage.import_records(
+                [('x', 1.0, 'old'), ('y', 2.0, 'y'), ('x', 1.0, 'dup')])
+        except NotImplementedError:
+            self.skipTest("storage can't import")
+
+        # Older records don't replace the latest value
+        self.assertEqual(self.storage.read('x'), 'current')
+        self.assertEqual(self.storage.read('y'), 'y')
+        self.assertEqual(list(self.storage.backlog('x'))[1:], [(1.0, 'old')])
+
+    def test_latest_timestamp(self):
+        self.storage.write('x', 1)
+        self.storage.write('x', 2)
+        self.assertEqual(self.storage.latest_timestamp('x'),
+                         next(self.storage.backlog('x'))[0])
+
+        with self.assertRaises(KeyError):
+            self.storage.latest_timestamp('y')
+
+    def test_keys(self):
+        self.storage.write_many([('b', 1), ('a:1', 2), ('a:2', 3)])
+        self.assertEqual(list(self.storage.keys()), ['a:1', 'a:2', 'b'])
+        self.assertEqual(list(self.storage.keys(prefix='a:')), ['a:1', 'a:2'])
+        self.assertEqual(list(self.storage.keys(prefix='c')), [])
+
+    def test_expire(self):
+        for x in range(5):
+            self.storage.write('x', x)
+
+        self.assertEqual(self.storage.expire('x', keep_last=3, limit=1),
+                         (1, set()))
+        self.assertEqual(self.storage.expire('x', keep_last=3), (1, set()))
+        self.assertEqual(
+            [value for (ts, value) in self.storage.range('x')],
+            [2, 3, 4])
+
+        # The latest record always survives
+        self.assertEqual(self.storage.expire('x', max_age=-60), (2, set()))
+        self.assertEqual(self.storage.read('x'), 4)
+        self.assertEqual(self.storage.expire('y', keep_last=1), (0, set()))
+
+    def test_expire_notifies(self):
+        expired = []
+        self.storage.signaler = signaler.Signaler()
+        self.storage.signaler.add_expire_listener(
+            lambda key, ts: expired.append((key, ts)))
+
+        for x in range(3):
+            self.storage.write('x', x)
+        timestamps = [ts for (ts, value) in self.storage.range('x')]
+
+        self.storage.expire('x', keep_last=1)
+        self.storage.expire('x', keep_last=1)
+        self.assertEqual(expired, [('x', timestamps[1])])
+
+    def test_backlog_summary(self):
+        with self.assertRaises(KeyError):
+            self.storage.backlog_summary('x')
+
+        for x in range(3):
+            self.storage.write('x', x)
+        timestamps = [ts for (ts, value) in self.storage.range('x')]
+        self.assertEqual(self.storage.backlog_summary('x'),
+                         (timestamps[0], timestamps[2], 3))
+
+        self.storage.expire('x', keep_last=2)
+        self.assertEqual(self.storage.backlog_summary('x'),
+                         (timestamps[1], timestamps[2], 2))
+
 
 class TestMemoryStorage(StorageTestMixin, unittest.TestCase):
     STORAGE_CLASS = grandcentral.storage.MemoryStorage
 
 
+class TestRingStorage(StorageTestMixin, unittest.TestCase):
+    STORAGE_CLASS = ringstorage.RingStorage
+
+    def test_capacity(self):
+        storage = ringstorage.RingStorage(capacity=3)
+        for x in range(10):
+            storage.write('x', x)
+
+        self.assertEqual(storage.read('x'), 9)
+        self.assertEqual(
+            [value for (ts, value) in storage.range('x')], [7, 8, 9])
+
+        timestamps = [ts for (ts, value) in storage.range('x')]
+        self.assertEqual(
+            [value for (ts, value) in storage.backlog(
+                'x', before=timestamps[-1])],
+            [8, 7])
+        self.assertEqual(
+            storage.timeseries('x', start=timestamps[1]),
+            (timestamps[1:], [8, 9]))
+
+        self.assertEqual(storage.expire('x', keep_last=1), (2, set()))
+        storage.write('x', 10)
+        self.assertEqual(
+            [value for (ts, value) in storage.range('x')], [9, 10])
+
+    def test_memory_budget(self):
+        storage = ringstorage.RingStorage(capacity=10, memory_budget=4096)
+        for key in ('a', 'b', 'c'):
+            storage.write(key, 'x' * 1000)
+
+        # Reading 'a' makes 'b' the coldest key
+        storage.read('a')
+        storage.write('d', 'x' * 1000)
+
+        self.assertEqual(list(storage.keys()), ['a', 'c', 'd'])
+        self.assertEqual(storage.stats()['evictions'], 1)
+        self.assertLessEqual(storage.stats()['bytes'], 4096)
+        with self.assertRaises(KeyError):
+            storage.read('b')
+
+
+class TestLogStorage(StorageTestMixin, unittest.TestCase):
+    class TemporaryLogStorage(logstorage.LogStorage):
+        def __init__(self, **kwargs):
+            self.tmpdir = tempfile.TemporaryDirectory()
+            super().__init__(storage_path=self.tmpdir.name, **kwargs)
+
+    STORAGE_CLASS = TemporaryLogStorage
+
+    def tearDown(self):
+        self.storage.close()
+        self.storage.tmpdir.cleanup()
+        super().tearDown()
+
+    def reopen(self, **kwargs):
+        self.storage.close()
+        return logstorage.LogStorage(
+            storage_path=self.storage.tmpdir.name, **kwargs)
+
+    def test_persistence(self):
+        self.storage.write_many([('x', 1), ('y', {'a': 2}), ('x', 3)])
+
+        storage = self.reopen()
+        self.addCleanup(storage.close)
+        self.assertEqual(list(storage.keys()), ['x', 'y'])
+        self.assertEqual(storage.read('y'), {'a': 2})
+        self.assertEqual(
+            [value for (ts, value) in storage.backlog('x')], [3, 1])
+
+    def test_segment_roll(self):
+        self.storage.segment_size = 50
+        for x in range(10):
+            self.storage.write('x', 'v' * 50)
+
+        self.assertEqual(self.storage.stats()['segments'], 11)
+        self.assertEqual(len(list(self.storage.range('x'))), 10)
+
+        self.storage.expire('x', keep_last=2)
+        self.assertGreater(self.storage.vacuum(), 0)
+        self.assertEqual(self.storage.stats()['segments'], 3)
+        self.assertEqual(len(list(self.storage.range('x'))), 2)
+
+    def test_torn_tail_recovery(self):
+        self.storage.write_many([('x', 1), ('x', 2), ('y', 3)])
+        active = self.storage._segment_filepath(
+            self.storage.stats()['active_segment'])
+        size = os.path.getsize(active)
+
+        # Half written record at the end of the log
+        with open(active, 'r+b') as fh:
+            fh.truncate(size - 3)
+
+        storage = self.reopen()
+        self.addCleanup(storage.close)
+        self.assertEqual(storage.read('x'), 2)
+        with self.assertRaises(KeyError):
+            storage.read('y')
+
+        # New writes go right after the last good record
+        storage.write('y', 4)
+        self.assertEqual(storage.read('y'), 4)
+        self.assertEqual(
+            [value for (ts, value) in storage.range('x')], [1, 2])
+
+    def test_corrupt_record_recovery(self):
+        self.storage.write('x', 1)
+        self.storage.write('x', 2)
+        active = self.storage._segment_filepath(
+            self.storage.stats()['active_segment'])
+
+        with open(active, 'r+b') as fh:
+            fh.seek(-1, os.SEEK_END)
+            fh.write(b'!')
+
+        storage = self.reopen()
+        self.addCleanup(storage.close)
+        self.assertEqual(storage.read('x'), 1)
+
+    def test_lost_index_entries_are_rebuilt(self):
+        self.storage.write_many([('x', 1), ('x', 2)])
+        self.storage._index('x').truncate(0)
+
+        storage = self.reopen()
+        self.addCleanup(storage.close)
+        self.assertEqual(
+            [value for (ts, value) in storage.range('x')], [1, 2])
+
+
+class TestCompactor(unittest.TestCase):
+    def setUp(self):
+        self.storage = grandcentral.storage.MemoryStorage()
+        for x in range(5):
+            self.storage.write_many([('a:1', x), ('a:2', x), ('b', x)])
+
+    def test_policy_for(self):
+        c = compaction.Compactor(self.storage, [
+            compaction.RetentionPolicy('a'),
+            compaction.RetentionPolicy('a:'),
+            compaction.RetentionPolicy('a:1')])
+        self.assertEqual(c.policy_for('a:1').prefix, 'a:1')
+        self.assertEqual(c.policy_for('a:2').prefix, 'a:')
+        self.assertIsNone(c.policy_for('b'))
+
+    def test_run_once(self):
+        c = compaction.Compactor(self.storage, [
+            compaction.RetentionPolicy('a:', keep_last=2),
+            compaction.RetentionPolicy('a:1', keep_last=4)],
+            batch_size=1)
+
+        report = c.run_once()
+        self.assertEqual(report['keys'], 2)
+        self.assertEqual(report['rows'], 4)
+        self.assertEqual(len(list(self.storage.backlog('a:1'))), 4)
+        self.assertEqual(len(list(self.storage.backlog('a:2'))), 2)
+        self.assertEqual(len(list(self.storage.backlog('b'))), 5)
+
+        self.assertEqual(c.run_once()['rows'], 0)
+
+    def test_background(self):
+        c = compaction.Compactor(
+            self.storage, [compaction.RetentionPolicy('', keep_last=1)],
+            interval=60)
+        c.start()
+        c.stop()
+        self.assertEqual(c.last_report['rows'], 12)
+
+
 if _sqlalchemy_storage_enabled:
     class TestSQLAlchemyStorage(StorageTestMixin, unittest.TestCase):
         class SQLAlchemyMemoryStorage(grandcentral.sqlalchemystorage.SQLAlchemyStorage):
@@ -112,6 +634,723 @@ if _sqlalchemy_storage_enabled:
 
         STORAGE_CLASS = SQLAlchemyMemoryStorage
 
+        def test_threads_share_connection(self):
+            self.storage.write('y', 1, b'data')
+            errors = []
+
+            def _worker(n):
+                try:
+                    for x in range(50):
+                        self.storage.write('w{}'.format(n), x)
+                        self.storage.cache.clear()
+                        self.storage.read('w{}'.format(n))
+                        list(self.storage.backlog('y'))
+                except Exception as e:
+                    errors.append(e)
+
+            threads = [threading.Thread(target=_worker, args=(n,))
+                       for n in range(4)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+
+            self.assertEqual(errors, [])
+            self.assertEqual(self.storage.read_many(['w0', 'w3']),
+                             {'w0': 49, 'w3': 49})
+
+            # Its attachments directory goes with it
+            files_path = self.storage._files_path
+            self.storage.close()
+            self.assertFalse(os.path.exists(files_path))
+
+    class TestSQLAlchemyGroupCommitStorage(StorageTestMixin,
+                                           unittest.TestCase):
+        class SQLAlchemyGroupCommitStorage(
+                grandcentral.sqlalchemystorage.SQLAlchemyStorage):
+            def __init__(self):
+                super().__init__(dbpath=':memory:', group_commit=True)
+
+        STORAGE_CLASS = SQLAlchemyGroupCommitStorage
+
+        def tearDown(self):
+            self.storage.close()
+            super().tearDown()
+
+        def test_writes_are_grouped(self):
+            self.storage.group_commit_interval = 0.05
+
+            threads = [
+                threading.Thread(target=self.storage.write, args=('x', n))
+                for n in range(20)
+            ]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+
+            stats = self.storage.stats()['group_commit']
+            self.assertEqual(stats['records'], 20)
+            self.assertLess(stats['flushes'], 20)
+            self.assertEqual(stats['queue_depth'], 0)
+            self.assertEqual(len(list(self.storage.backlog('x'))), 20)
+
+        def test_read_your_writes(self):
+            self.storage.group_commit_interval = 0.2
+            self.storage.write('x', 1)
+
+            fut = self.storage.submit('x', 2)
+            self.assertFalse(fut.done())
+            self.assertEqual(self.storage.read('x'), 2)
+
+            fut.result()
+            self.assertEqual(self.storage.read('x'), 2)
+            self.assertEqual(self.storage._pending, {})
+
+        def test_large_batch_spans_flushes(self):
+            self.storage.group_commit_size = 10
+            self.storage.write_many([('x', n) for n in range(25)])
+            self.assertEqual(self.storage.read('x'), 24)
+            self.assertEqual(self.storage.stats()['group_commit']['records'], 25)
+
+    class TestShardedStorage(StorageTestMixin, unittest.TestCase):
+        class TemporaryShardedStorage(shardedstorage.ShardedStorage):
+            def __init__(self, **kwargs):
+                self.tmpdir = tempfile.TemporaryDirectory()
+                super().__init__(storage_path=self.tmpdir.name, shards=3,
+                                 **kwargs)
+
+        STORAGE_CLASS = TemporaryShardedStorage
+
+        def tearDown(self):
+            self.storage.close()
+            self.storage.tmpdir.cleanup()
+            super().tearDown()
+
+        def test_jump_hash(self):
+            keys = ['key-{}'.format(x) for x in range(1000)]
+            before = [shardedstorage.shard_for_key(x, 4) for x in keys]
+            after = [shardedstorage.shard_for_key(x, 5) for x in keys]
+
+            self.assertEqual(set(before), {0, 1, 2, 3})
+
+            # Growing only moves keys into the new shard
+            moved = [(a, b) for (a, b) in zip(before, after) if a != b]
+            self.assertTrue(all(b == 4 for (a, b) in moved))
+            self.assertLess(len(moved), 300)
+
+        def test_routing(self):
+            keys = ['key-{}'.format(x) for x in range(30)]
+            self.storage.write_many([(key, key) for key in keys])
+
+            for key in keys:
+                self.assertEqual(self.storage.shard(key).read(key), key)
+            self.assertTrue(all(
+                list(shard.keys()) for shard in self.storage.shards))
+            self.assertEqual(list(self.storage.keys()), sorted(keys))
+
+        def test_shared_attachments(self):
+            for shard in self.storage.shards:
+                shard.ATTACHMENT_GRACE_PERIOD = 0
+
+            keys = ['key-{}'.format(x) for x in range(30)]
+            for key in keys:
+                self.storage.write(key, 1, b'data')
+                self.storage.write(key, 2)
+
+            digest = hashlib.sha1(b'data').hexdigest()
+
+            (n, digests) = self.storage.expire(keys[0], keep_last=1)
+            self.assertEqual(digests, {digest})
+            self.assertEqual(self.storage.collect_attachments(digests), (0, 0))
+
+            for key in keys[1:]:
+                self.storage.expire(key, keep_last=1)
+            self.assertEqual(self.storage.collect_attachments(digests),
+                             (1, 4))
+
+        def test_shared_chunks(self):
+            for shard in self.storage.shards:
+                shard.ATTACHMENT_GRACE_PERIOD = -1
+                self.assertIs(shard._chunk_index, self.storage.shards[0])
+
+            chunker = chunking.Chunker(avg_size=1024)
+            data = _random_bytes(8 * 1024)
+            chunks = []
+            for part in chunker.split(io.BytesIO(data)):
+                chunks.append((hashlib.sha1(part).hexdigest(), len(part)))
+                self.storage.store_chunk(chunks[-1][0], part)
+
+            # Referenced from a manifest written through another shard
+            key = next('key-{}'.format(x) for x in range(30)
+                       if self.storage.shard('key-{}'.format(x)) is not
+                       self.storage.shards[0])
+            self.storage.write_chunked(key, 1, chunks)
+            self.assertEqual(self.storage.collect_attachments(set()), (0, 0))
+
+            (d, fh, size) = self.storage.open_attachment(key)
+            with fh:
+                self.assertEqual(fh.read(), data)
+
+        def test_shard_count_mismatch(self):
+            with self.assertRaises(ValueError):
+                shardedstorage.ShardedStorage(
+                    storage_path=self.storage.tmpdir.name, shards=4)
+
+        def test_reshard(self):
+            keys = ['key-{}'.format(x) for x in range(50)]
+            for x in range(3):
+                self.storage.write_many([(key, x) for key in keys])
+            self.storage.close()
+
+            tmpdir = self.storage.tmpdir.name
+            for shards in (5, 2):
+                self.assertGreater(
+                    shardedstorage.reshard(tmpdir, shards, batch_size=2), 0)
+
+                storage = shardedstorage.ShardedStorage(storage_path=tmpdir)
+                self.assertEqual(len(storage.shards), shards)
+                self.assertEqual(list(storage.keys()), sorted(keys))
+                for key in keys:
+                    self.assertEqual(storage.read(key), 2)
+                    self.assertEqual(
+                        [value for (ts, value) in storage.backlog(key)],
+                        [2, 1, 0])
+                storage.close()
+
+            self.assertFalse(
+                os.path.exists(os.path.join(tmpdir, 'shard-04.sqlite')))
+
+    class TestSQLAlchemyStorageOnDisk(unittest.TestCase):
+        def setUp(self):
+            super().setUp()
+            self.tmpdir = tempfile.TemporaryDirectory()
+            self.addCleanup(self.tmpdir.cleanup)
+            self.storage = grandcentral.sqlalchemystorage.SQLAlchemyStorage(
+                storage_path=self.tmpdir.name + '/')
+
+        def test_write_many_single_transaction(self):
+            commits = []
+            sqlalchemy.event.listen(
+                self.storage.Session, 'after_commit', commits.append)
+
+            self.storage.write_many([('x', 1), ('y', 2), ('x', 3)])
+
+            self.assertEqual(len(commits), 1)
+            self.assertEqual(self.storage.read('x'), 3)
+            self.assertEqual(
+                [value for (ts, value) in self.storage.backlog('x')],
+                [3, 1])
+
+        def test_read_many_single_query(self):
+            self.storage.write_many([('k{}'.format(n), n) for n in range(10)])
+            self.storage.read('k0')
+
+            statements = []
+            sqlalchemy.event.listen(
+                self.storage.engine, 'before_cursor_execute',
+                lambda conn, cursor, statement, *args: statements.append(
+                    statement))
+
+            keys = ['k{}'.format(n) for n in range(12)]
+            self.assertEqual(self.storage.read_many(keys),
+                             {'k{}'.format(n): n for n in range(10)})
+            self.assertEqual(
+                len([x for x in statements if x.startswith('SELECT')]), 1)
+
+            # Now cached
+            del statements[:]
+            self.storage.read_many(keys[:10])
+            self.assertEqual(statements, [])
+
+        def test_read_uses_heads_and_cache(self):
+            self.storage.write('x', {'a': 1})
+            self.assertEqual(self.storage.read('x'), {'a': 1})
+            self.assertEqual(self.storage.read('x'), {'a': 1})
+            self.assertEqual(self.storage.cache.hits, 1)
+
+            self.storage.write('x', {'a': 2})
+            self.assertEqual(self.storage.read('x'), {'a': 2})
+
+            self.storage.write_many([('x', 3), ('x', 4)])
+            self.assertEqual(self.storage.read('x'), 4)
+
+            with self.storage.session() as sess:
+                head = sess.query(
+                    grandcentral.sqlalchemystorage.Head).get('x')
+                self.assertEqual(codecs.decode_stored(head.value), 4)
+
+        def test_heads_backfill(self):
+            self.storage.write('x', 1)
+            self.storage.write('x', 2)
+            with self.storage.session() as sess:
+                sess.query(grandcentral.sqlalchemystorage.Head).delete()
+                sess.commit()
+
+            storage = grandcentral.sqlalchemystorage.SQLAlchemyStorage(
+                storage_path=self.tmpdir.name + '/')
+            self.assertEqual(storage.read('x'), 2)
+
+        def test_wal_mode(self):
+            with self.storage.session() as sess:
+                mode = sess.execute('PRAGMA journal_mode').scalar()
+            self.assertEqual(mode, 'wal')
+
+        def test_new_connection_waits_for_lock(self):
+            self.storage.write('x', 1)
+
+            # Another process holds the write lock for a while
+            conn = sqlite3.connect(
+                self.tmpdir.name + '/gc.sqlite', isolation_level=None,
+                check_same_thread=False)
+            self.addCleanup(conn.close)
+            conn.execute('BEGIN IMMEDIATE')
+            timer = threading.Timer(0.2, conn.execute, args=('COMMIT',))
+            timer.start()
+            self.addCleanup(timer.join)
+
+            # Forces new pool connections
+            self.storage.engine.dispose()
+            self.storage.write('x', 2)
+            self.assertEqual(self.storage.read('x'), 2)
+
+            # Set when the database was created, not on every connect
+            with self.storage.engine.connect() as conn:
+                self.assertEqual(
+                    conn.execute('PRAGMA auto_vacuum').scalar(), 2)
+            self.assertFalse(self.storage._new_database)
+
+        def test_heads_never_move_backwards(self):
+            # Writer A takes its timestamp, B writes and commits, then A
+            # commits
+            session = self.storage.session
+            built, resume = threading.Event(), threading.Event()
+
+            def _session():
+                if threading.current_thread() is writer:
+                    built.set()
+                    resume.wait()
+                return session()
+
+            writer = threading.Thread(
+                target=self.storage.write, args=('x', 'old'))
+            with unittest.mock.patch.object(self.storage, 'session', _session):
+                writer.start()
+                built.wait()
+                self.storage.write('x', 'new')
+                resume.set()
+                writer.join()
+
+            self.storage.cache.clear()
+            self.assertEqual(self.storage.read('x'), 'new')
+            self.assertEqual(
+                [value for (ts, value) in self.storage.backlog('x')],
+                ['new', 'old'])
+
+            # Replicated changes arriving out of order too
+            self.storage.apply_changes([
+                (100, 'y', 2.0, 'new', None),
+                (101, 'y', 1.0, 'old', None)])
+            self.storage.cache.clear()
+            self.assertEqual(self.storage.read('y'), 'new')
+
+        def test_concurrent_access(self):
+            errors = []
+
+            def _writer(n):
+                try:
+                    for x in range(50):
+                        self.storage.write('w{}'.format(n), x)
+                except Exception as e:
+                    errors.append(e)
+
+            def _reader():
+                for x in range(50):
+                    try:
+                        self.storage.read('w0')
+                        list(self.storage.backlog('w1', limit=5))
+                    except KeyError:
+                        pass
+                    except Exception as e:
+                        errors.append(e)
+
+            threads = [threading.Thread(target=_writer, args=(n,))
+                       for n in range(3)]
+            threads += [threading.Thread(target=_reader) for x in range(4)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+
+            self.assertEqual(errors, [])
+            for n in range(3):
+                self.assertEqual(self.storage.read('w{}'.format(n)), 49)
+                self.assertEqual(
+                    len(list(self.storage.backlog('w{}'.format(n)))), 50)
+
+        def test_attachment_streaming_and_dedup(self):
+            data = b'\x00\x01' * 100000
+            self.storage.write('x', 1, io.BytesIO(data))
+            self.storage.write('y', 2, data)
+
+            with self.storage.session() as sess:
+                records = sess.query(
+                    grandcentral.sqlalchemystorage.Record).all()
+            digests = set(x.attachment for x in records)
+            self.assertEqual(digests, {hashlib.sha1(data).hexdigest()})
+
+            filepath = self.storage._storage_filepath_for_attachment(
+                digests.pop())
+            with open(filepath, 'rb') as fh:
+                self.assertEqual(fh.read(), data)
+
+            # No stray temporary files
+            self.assertEqual(
+                [x for x in os.listdir(self.storage._files_path)
+                 if x.startswith('.')],
+                [])
+
+        def test_attachment_collection(self):
+            self.storage.ATTACHMENT_GRACE_PERIOD = 0
+            self.storage.write('x', 1, b'shared')
+            self.storage.write('y', 1, b'shared')
+            self.storage.write('x', 2, b'private')
+            self.storage.write('x', 3)
+
+            (n, digests) = self.storage.expire('x', keep_last=1)
+            self.assertEqual(n, 2)
+            self.assertEqual(
+                digests,
+                {hashlib.sha1(b'shared').hexdigest(),
+                 hashlib.sha1(b'private').hexdigest()})
+
+            # 'shared' is still referenced by y
+            self.assertEqual(self.storage.collect_attachments(digests),
+                             (1, len(b'private')))
+            self.assertEqual(self.storage.open_attachment('y')[2], 6)
+
+        def test_attachment_collection_grace_period(self):
+            self.storage.write('x', 1, b'data')
+            self.storage.write('x', 2)
+            compactor = compaction.Compactor(
+                self.storage, [compaction.RetentionPolicy('', keep_last=1)])
+
+            report = compactor.run_once()
+            self.assertEqual((report['rows'], report['attachments']), (1, 0))
+
+            # Retried by a later run once the grace period is over, even
+            # with nothing new expired
+            self.storage.ATTACHMENT_GRACE_PERIOD = -1
+            report = compactor.run_once()
+            self.assertEqual(
+                (report['rows'], report['attachments'], report['bytes']),
+                (0, 1, 4))
+            self.assertFalse(self.storage.has_attachment(
+                hashlib.sha1(b'data').hexdigest()))
+
+            # Referenced again meanwhile, it's dropped from the retries
+            self.storage.ATTACHMENT_GRACE_PERIOD = 300
+            self.storage.write('y', 1, b'other')
+            self.storage.write('y', 2)
+            self.storage.expire('y', keep_last=1)
+            self.storage.collect_attachments(
+                {hashlib.sha1(b'other').hexdigest()})
+            self.storage.write('z', 1, b'other')
+            self.storage.ATTACHMENT_GRACE_PERIOD = -1
+            self.assertEqual(self.storage.collect_attachments(set()), (0, 0))
+            self.assertTrue(self.storage.has_attachment(
+                hashlib.sha1(b'other').hexdigest()))
+
+        def test_compression(self):
+            storage = grandcentral.sqlalchemystorage.SQLAlchemyStorage(
+                storage_path=self.tmpdir.name + '/', compression='gzip',
+                compression_threshold=100)
+            value = ['x' * 10] * 100
+            storage.write('x', value)
+            storage.write('y', 1)
+
+            with storage.session() as sess:
+                rows = dict(sess.query(
+                    grandcentral.sqlalchemystorage.Record.key,
+                    grandcentral.sqlalchemystorage.Record.value))
+            self.assertEqual(rows['x'][0], codecs.COMPRESSED_MARKER)
+            self.assertNotEqual(rows['y'][:1], b'\xc1')
+
+            storage.cache.clear()
+            self.assertEqual(storage.read('x'), value)
+            self.assertEqual(storage.read_raw('x')[1],
+                             storage.codec.encode(value))
+
+            # Stored compressed, addressed by the uncompressed digest
+            data = b'abcd' * 10000
+            digest = hashlib.sha1(data).hexdigest()
+            storage.write('z', 1, data)
+            storage.write('w', 1, io.BytesIO(data))
+            filepath = storage._storage_filepath_for_attachment(digest)
+            self.assertFalse(os.path.exists(filepath))
+            self.assertLess(os.path.getsize(filepath + '.gz'), len(data))
+            self.assertTrue(storage.has_attachment(digest))
+
+            (d, fh, size) = storage.open_attachment('w')
+            with fh:
+                self.assertEqual((d, size, fh.read()),
+                                 (digest, len(data), data))
+
+            (d, fh, size, encoding) = storage.open_attachment_encoded('w')
+            with fh:
+                self.assertEqual(encoding, 'gzip')
+                self.assertEqual(gzip.decompress(fh.read()), data)
+
+            # Incompressible data is kept as is
+            noise = os.urandom(4096)
+            storage.write('v', 1, noise)
+            self.assertTrue(os.path.exists(
+                storage._storage_filepath_for_attachment(
+                    hashlib.sha1(noise).hexdigest())))
+
+        def test_chunked_attachments(self):
+            storage = grandcentral.sqlalchemystorage.SQLAlchemyStorage(
+                storage_path=self.tmpdir.name + '/', chunking=True,
+                chunk_size=1024)
+            data = _random_bytes(64 * 1024)
+            edited = data[:30000] + b'inserted' + data[30000:]
+
+            def _chunk_bytes():
+                return sum(
+                    os.path.getsize(os.path.join(dirpath, x))
+                    for (dirpath, dirnames, filenames)
+                    in os.walk(storage._chunks_path)
+                    for x in filenames)
+
+            storage.write('x', 1, data)
+            self.assertEqual(_chunk_bytes(), len(data))
+
+            # Only the chunks around the insertion are new
+            storage.write('x', 2, io.BytesIO(edited))
+            self.assertLess(_chunk_bytes(), len(data) + 8192)
+
+            digest = hashlib.sha1(edited).hexdigest()
+            self.assertTrue(storage.has_attachment(digest))
+            self.assertFalse(os.path.exists(
+                storage._storage_filepath_for_attachment(digest)))
+
+            (d, fh, size) = storage.open_attachment('x')
+            with fh:
+                self.assertEqual((d, size, fh.read()),
+                                 (digest, len(edited), edited))
+
+            (fh, size) = storage.open_attachment_by_digest(
+                hashlib.sha1(data).hexdigest())
+            with fh:
+                fh.seek(29990)
+                self.assertEqual(fh.read(20), data[29990:30010])
+
+            # Chunks of the expired version go, shared ones stay
+            storage.ATTACHMENT_GRACE_PERIOD = -1
+            (n, digests) = storage.expire('x', keep_last=1)
+            (files, reclaimed) = storage.collect_attachments(digests)
+            self.assertGreater(files, 1)
+            self.assertLess(_chunk_bytes(), len(edited) + 1024)
+
+            (d, fh, size) = storage.open_attachment('x')
+            with fh:
+                self.assertEqual(fh.read(), edited)
+
+        def test_write_chunked(self):
+            chunker = chunking.Chunker(avg_size=1024)
+            data = _random_bytes(16 * 1024)
+            chunks = []
+            for part in chunker.split(io.BytesIO(data)):
+                digest = hashlib.sha1(part).hexdigest()
+                chunks.append((digest, len(part)))
+                self.assertEqual(self.storage.missing_chunks([digest]),
+                                 [digest])
+                self.storage.store_chunk(digest, part)
+
+            self.assertEqual(
+                self.storage.missing_chunks([x for (x, size) in chunks]), [])
+
+            with self.assertRaises(ValueError):
+                self.storage.store_chunk(chunks[0][0], b'other')
+            with self.assertRaises(ValueError):
+                self.storage.write_chunked('x', 1, [(chunks[0][0], 1)])
+            with self.assertRaises(ValueError):
+                self.storage.write_chunked('x', 1, [('0' * 40, 1)])
+
+            self.storage.write_chunked('x', 1, chunks)
+            (d, fh, size) = self.storage.open_attachment('x')
+            with fh:
+                self.assertEqual((d, fh.read()),
+                                 (hashlib.sha1(data).hexdigest(), data))
+
+            # Whole content dedups against regular writes too
+            self.storage.write('y', 1, data)
+            self.assertFalse(os.path.exists(
+                self.storage._storage_filepath_for_attachment(d)))
+
+        def test_reads_return_copies(self):
+            self.storage.write('x', {'a': [1]})
+            for fn in (self.storage.read,
+                       lambda key: self.storage.read_many([key])[key]):
+                fn('x')['a'].append(2)
+                self.assertEqual(fn('x'), {'a': [1]})
+
+            storage = grandcentral.sqlalchemystorage.SQLAlchemyStorage(
+                dbpath=':memory:', group_commit=True,
+                group_commit_interval=60)
+            self.addCleanup(storage.close)
+            value = {'a': [1]}
+            storage.submit('x', value)
+            value['a'].append(2)
+            storage.read('x')['a'].append(3)
+            self.assertEqual(storage.read('x'), {'a': [1]})
+
+        def test_chunk_index(self):
+            storage = grandcentral.sqlalchemystorage.SQLAlchemyStorage(
+                storage_path=self.tmpdir.name + '/', chunking=True,
+                chunk_size=1024)
+            storage.ATTACHMENT_GRACE_PERIOD = -1
+            data = _random_bytes(16 * 1024)
+            digest = hashlib.sha1(data).hexdigest()
+            storage.write('x', 1, data)
+
+            def _index():
+                with storage.session() as sess:
+                    return (
+                        set(sess.query(
+                            grandcentral.sqlalchemystorage.Chunk.digest)),
+                        set(sess.query(
+                            grandcentral.sqlalchemystorage.ChunkRef.attachment,
+                            grandcentral.sqlalchemystorage.ChunkRef.chunk)))
+
+            (chunks, refs) = _index()
+            self.assertGreater(len(chunks), 1)
+            self.assertEqual(
+                refs, set((digest, chunk) for (chunk,) in chunks))
+
+            # Uploaded but never referenced
+            storage.store_chunk(hashlib.sha1(b'orphan').hexdigest(), b'orphan')
+            self.assertEqual(storage.collect_attachments(set()), (1, 6))
+            self.assertEqual(_index(), (chunks, refs))
+
+            # Stores from before the index are walked once
+            storage.close()
+            conn = sqlite3.connect(self.tmpdir.name + '/gc.sqlite')
+            conn.execute('DROP TABLE chunks')
+            conn.execute('DROP TABLE chunk_refs')
+            conn.commit()
+            conn.close()
+            storage = grandcentral.sqlalchemystorage.SQLAlchemyStorage(
+                storage_path=self.tmpdir.name + '/')
+            self.assertEqual(_index(), (chunks, refs))
+
+            storage.write('x', 2)
+            (n, digests) = storage.expire('x', keep_last=1)
+            storage.ATTACHMENT_GRACE_PERIOD = -1
+            (files, reclaimed) = storage.collect_attachments(digests)
+            self.assertEqual(files, len(chunks) + 1)
+            self.assertEqual(_index(), (set(), set()))
+
+        @unittest.skipIf(codecs.MSGPACK is None, 'msgpack not installed')
+        def test_mixed_codecs(self):
+            storage = grandcentral.sqlalchemystorage.SQLAlchemyStorage(
+                storage_path=self.tmpdir.name + '/', codec='json')
+            storage.write('x', {'a': 1})
+            self.assertEqual(storage.read_raw('x'),
+                             (codecs.JSON, b'{"a": 1}'))
+
+            self.storage.write('x', {'a': 2})
+            self.assertEqual(self.storage.read_raw('x'),
+                             (codecs.MSGPACK, b'\x81\xa1a\x02'))
+            self.assertEqual(
+                [value for (ts, value) in self.storage.backlog('x')],
+                [{'a': 2}, {'a': 1}])
+            self.assertEqual(
+                [(codec, data) for (ts, codec, data)
+                 in self.storage.backlog_raw('x')],
+                [(codecs.MSGPACK, b'\x81\xa1a\x02'),
+                 (codecs.JSON, b'{"a": 1}')])
+
+        @unittest.skipIf(codecs.MSGPACK is None, 'msgpack not installed')
+        def test_msgpack_fallback(self):
+            # Valid JSON values msgpack can't encode
+            self.storage.write('x', 2 ** 70)
+            self.storage.write_many([('y', {'a': 2 ** 64})])
+            self.assertEqual(self.storage.read_raw('x'),
+                             (codecs.JSON, str(2 ** 70).encode('utf-8')))
+
+            self.storage.cache.clear()
+            self.assertEqual(self.storage.read('x'), 2 ** 70)
+            self.assertEqual(self.storage.read('y'), {'a': 2 ** 64})
+
+            client = falcon.testing.TestClient(grandcentral.API(self.storage))
+            resp = client.simulate_post(
+                '/message', json={'key': 'z', 'value': -2 ** 65})
+            self.assertEqual(resp.status_code, 204)
+            resp = client.simulate_get(
+                '/message/z', headers={'Accept': 'application/json'})
+            self.assertEqual(resp.json['value'], -2 ** 65)
+
+        def test_changes(self):
+            self.storage.write('x', 1)
+            self.storage.write_many([('y', 2), ('x', 3)])
+            self.storage.write('z', 4, b'data')
+
+            changes = list(self.storage.changes())
+            self.assertEqual([x[0] for x in changes], [1, 2, 3, 4])
+            self.assertEqual(
+                [(key, value) for (seq, key, ts, value, att) in changes],
+                [('x', 1), ('y', 2), ('x', 3), ('z', 4)])
+            self.assertEqual(changes[-1][4], hashlib.sha1(b'data').hexdigest())
+
+            self.assertEqual(
+                [x[0] for x in self.storage.changes(since=1, limit=2)],
+                [2, 3])
+            self.assertEqual(self.storage.last_seq(), 4)
+
+        def test_seq_not_reused(self):
+            Record = grandcentral.sqlalchemystorage.Record
+            self.storage.write('x', 1)
+            self.storage.write('y', 2)
+            with self.storage.session() as sess:
+                sess.query(Record).filter(Record.seq == 2).delete()
+                sess.commit()
+
+            self.storage.write('z', 3)
+            self.storage.write_many([('z', 4), ('w', 5)])
+            self.assertEqual(
+                [x[0] for x in self.storage.changes()], [1, 3, 4, 5])
+            self.assertEqual(self.storage.last_seq(), 5)
+
+        def test_seq_backfill(self):
+            dbpath = self.tmpdir.name + '/old.sqlite'
+            conn = sqlite3.connect(dbpath)
+            conn.execute(
+                'CREATE TABLE records (key VARCHAR NOT NULL, timestamp FLOAT, '
+                'value VARCHAR NOT NULL, attachment VARCHAR, '
+                'PRIMARY KEY (key, timestamp))')
+            conn.execute("INSERT INTO records VALUES ('x', 1.0, '1', NULL)")
+            conn.execute("INSERT INTO records VALUES ('x', 2.0, '2', NULL)")
+            conn.commit()
+            conn.close()
+
+            storage = grandcentral.sqlalchemystorage.SQLAlchemyStorage(
+                dbpath=dbpath)
+            storage.write('x', 3)
+            self.assertEqual(
+                [(seq, value) for (seq, key, ts, value, att)
+                 in storage.changes()],
+                [(1, 1), (2, 2), (3, 3)])
+
+        def test_vacuum(self):
+            with self.storage.session() as sess:
+                mode = sess.execute('PRAGMA auto_vacuum').scalar()
+            self.assertEqual(mode, 2)
+
+            self.storage.write_many([('x', 'x' * 1000)] * 500)
+            self.storage.expire('x', keep_last=1)
+            self.assertGreater(self.storage.vacuum(), 0)
+
 
 # Useless, doesn't work nor test anything
 #
@@ -142,17 +1381,1007 @@ if _sqlalchemy_storage_enabled:
 #         self.assertWrite('foo', 'bar')
 
 
+class _QuietHandler(wsgiref.simple_server.WSGIRequestHandler):
+    def log_message(self, *args, **kwargs):
+        pass
+
+
+class _ThreadingWSGIServer(socketserver.ThreadingMixIn,
+                           wsgiref.simple_server.WSGIServer):
+    daemon_threads = True
+
+
+class LiveServerTestMixin:
+    SERVER_CLASS = _ThreadingWSGIServer
+
+    def create_storage(self):
+        return grandcentral.storage.MemoryStorage()
+
+    def setUp(self):
+        super().setUp()
+        self.storage = self.create_storage()
+        self.url = self.start_server(self.storage)
+
+    def start_server(self, storage, **kwargs):
+        httpd = wsgiref.simple_server.make_server(
+            '127.0.0.1', 0, grandcentral.API(storage, **kwargs),
+            server_class=self.SERVER_CLASS,
+            handler_class=_QuietHandler)
+        thread = threading.Thread(target=httpd.serve_forever)
+        thread.start()
+
+        def _stop():
+            httpd.shutdown()
+            httpd.server_close()
+            thread.join()
+
+        self.addCleanup(_stop)
+        return 'http://127.0.0.1:{}/'.format(httpd.server_port)
+
+
+class LiveAsyncServerTestMixin(LiveServerTestMixin):
+    MAX_WORKERS = 8
+
+    def start_server(self, storage):
+        loop = asyncio.new_event_loop()
+        api = aioserver.AsyncAPI(storage, max_workers=self.MAX_WORKERS)
+        runner = aiohttp.web.AppRunner(api.app)
+        loop.run_until_complete(runner.setup())
+        site = aiohttp.web.TCPSite(runner, '127.0.0.1', 0)
+        loop.run_until_complete(site.start())
+        port = runner.addresses[0][1]
+
+        thread = threading.Thread(target=loop.run_forever)
+        thread.start()
+
+        def _stop():
+            asyncio.run_coroutine_threadsafe(runner.cleanup(), loop).result()
+            loop.call_soon_threadsafe(loop.stop)
+            thread.join()
+            loop.close()
+            api.storage.close()
+
+        self.addCleanup(_stop)
+        return 'http://127.0.0.1:{}/'.format(port)
+
+
+if _sqlalchemy_storage_enabled:
+    class TestExportImport(LiveServerTestMixin, unittest.TestCase):
+        def create_storage(self):
+            self.tmpdir = tempfile.TemporaryDirectory()
+            self.addCleanup(self.tmpdir.cleanup)
+            return grandcentral.sqlalchemystorage.SQLAlchemyStorage(
+                storage_path=self.tmpdir.name + '/src/')
+
+        def test_round_trip(self):
+            self.storage.write_many(
+                [('k{}'.format(n % 7), n) for n in range(50)])
+            dest = grandcentral.sqlalchemystorage.SQLAlchemyStorage(
+                storage_path=self.tmpdir.name + '/dest/')
+            dest_url = self.start_server(dest)
+
+            buf = io.BytesIO()
+            with grandcentral.client.SyncClient(self.url) as client:
+                client.export(buf)
+
+            buf.seek(0)
+            with grandcentral.client.SyncClient(dest_url) as client:
+                client.IMPORT_BATCH_SIZE = 8
+                self.assertEqual(client.import_records(buf), 50)
+
+            self.assertEqual(list(dest.export()), list(self.storage.export()))
+            self.assertEqual(dest.read('k0'), self.storage.read('k0'))
+
+    class TestReplication(LiveServerTestMixin, unittest.TestCase):
+        def create_storage(self):
+            self.tmpdir = tempfile.TemporaryDirectory()
+            self.addCleanup(self.tmpdir.cleanup)
+            return grandcentral.sqlalchemystorage.SQLAlchemyStorage(
+                storage_path=self.tmpdir.name + '/primary/')
+
+        def setUp(self):
+            super().setUp()
+            self.replica = grandcentral.sqlalchemystorage.SQLAlchemyStorage(
+                storage_path=self.tmpdir.name + '/replica/')
+            self.replica_url = self.start_server(self.replica, read_only=True)
+            self.follower = replication.Follower(
+                self.replica, self.url, batch_size=2)
+            self.addCleanup(self.follower.stop)
+
+        def test_follow(self):
+            self.storage.write('x', 1)
+            self.storage.write('y', 2, b'data')
+            self.storage.write_many([('x', 3), ('z', 4)])
+
+            self.assertEqual(self.follower.sync_once(), 2)
+            self.assertEqual(self.follower.sync_once(), 2)
+            self.assertEqual(self.follower.sync_once(), 0)
+
+            with grandcentral.client.SyncClient(self.replica_url) as client:
+                self.assertEqual(client.read('x'), 3)
+                self.assertEqual(client.read('z'), 4)
+
+                buff = io.BytesIO()
+                client.read_attachment('y', buff)
+                self.assertEqual(buff.getvalue(), b'data')
+
+                self.assertEqual(
+                    [x['seq'] for x in client.changes()], [1, 2, 3, 4])
+
+                with self.assertRaises(TypeError):
+                    client.write('x', 5)
+
+        def test_background(self):
+            self.follower.interval = 0.01
+            self.follower.start()
+            self.storage.write_many([('x', n) for n in range(5)])
+
+            deadline = time.monotonic() + 5
+            while self.replica.last_seq() < 5:
+                self.assertLess(time.monotonic(), deadline)
+                time.sleep(0.01)
+
+            self.assertEqual(self.replica.read('x'), 4)
+
+        def test_attachment_by_digest(self):
+            with grandcentral.client.SyncClient(self.url) as client:
+                with self.assertRaises(KeyError):
+                    client.read_attachment_by_digest('0' * 40, io.BytesIO())
+                with self.assertRaises(KeyError):
+                    client.read_attachment_by_digest('..', io.BytesIO())
+
+
+class TestClient(LiveServerTestMixin, unittest.TestCase):
+    def test_session_is_reused(self):
+        async def _test():
+            async with grandcentral.Client(self.url) as client:
+                await client.write('foo', 'bar')
+                sess = client.session
+                self.assertEqual(await client.read('foo'), 'bar')
+                self.assertIs(client.session, sess)
+
+            self.assertTrue(sess.closed)
+
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        asyncutils.wait_for(_test(), loop=loop)
+
+    def test_sync_client(self):
+        with grandcentral.client.SyncClient(self.url) as client:
+            client.write('foo', 1)
+            client.write('foo', 2)
+            self.assertEqual(client.read('foo'), 2)
+
+            with self.assertRaises(KeyError):
+                client.read('bar')
+
+    def test_iter_backlog(self):
+        self.storage.write_many([('foo', x) for x in range(7)])
+
+        async def _test():
+            async with grandcentral.Client(self.url) as client:
+                return [
+                    x['message']['value']
+                    async for x in client.iter_backlog('foo', page_size=3)
+                ]
+
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        self.assertEqual(
+            asyncutils.wait_for(_test(), loop=loop),
+            [6, 5, 4, 3, 2, 1, 0])
+
+    def test_watch(self):
+        self.storage.write('foo', 0)
+
+        async def _test():
+            async with grandcentral.Client(self.url) as client:
+                watch = client.watch('foo')
+                # First poll blocks until a writer shows up
+                loop.call_later(0.2, self.storage.write, 'foo', 1)
+                first = await watch.__anext__()
+
+                self.storage.write_many([('foo', 2), ('foo', 3)])
+                rest = [await watch.__anext__(), await watch.__anext__()]
+                await watch.aclose()
+
+            return [x['message']['value'] for x in [first] + rest]
+
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        self.assertEqual(asyncutils.wait_for(_test(), loop=loop), [1, 2, 3])
+
+    def test_query(self):
+        self.storage.write_many([('foo', x) for x in range(1200)])
+        timestamps = [ts for (ts, value) in self.storage.range('foo')]
+
+        with grandcentral.client.SyncClient(self.url) as client:
+            res = client.query('foo')
+            self.assertEqual(
+                [x['message']['value'] for x in res], list(range(1200)))
+
+            res = client.query('foo', min=timestamps[10], max=timestamps[20])
+            self.assertEqual(
+                [x['message']['value'] for x in res], list(range(10, 20)))
+
+            with self.assertRaises(KeyError):
+                client.query('bar')
+
+    def test_write_many(self):
+        with grandcentral.client.SyncClient(self.url) as client:
+            client.write_many([('foo', 1), ('bar', 2)])
+            self.assertEqual(self.storage.read('foo'), 1)
+            self.assertEqual(self.storage.read('bar'), 2)
+
+    def test_read_many(self):
+        self.storage.write_many([('foo', 1), ('bar', 2), ('a,b', 3)])
+
+        with grandcentral.client.SyncClient(self.url) as client:
+            self.assertEqual(client.read_many(['foo', 'bar', 'baz']),
+                             {'foo': 1, 'bar': 2})
+
+            # Keys with commas go in a POST body
+            self.assertEqual(client.read_many(['a,b', 'foo']),
+                             {'a,b': 3, 'foo': 1})
+
+            self.assertEqual(
+                client.backlog_many(['foo', 'bar', 'baz'], concurrency=2),
+                {'foo': [{'timestamp': self.storage.latest_timestamp('foo'),
+                          'message': {'key': 'foo', 'value': 1}}],
+                 'bar': [{'timestamp': self.storage.latest_timestamp('bar'),
+                          'message': {'key': 'bar', 'value': 2}}]})
+
+    def test_read_revalidates(self):
+        self.storage.write('foo', 'bar')
+
+        with unittest.mock.patch.object(
+                self.storage, 'read', wraps=self.storage.read) as read:
+            with grandcentral.client.SyncClient(self.url) as client:
+                self.assertEqual(client.read('foo'), 'bar')
+                self.assertEqual(client.read('foo'), 'bar')
+                self.assertEqual(read.call_count, 1)
+
+                self.storage.write('foo', 'baz')
+                self.assertEqual(client.read('foo'), 'baz')
+                self.assertEqual(read.call_count, 2)
+
+    def test_read_cache_returns_copies(self):
+        self.storage.write('foo', {'a': [1]})
+
+        with grandcentral.client.SyncClient(self.url) as client:
+            client.read('foo')['a'].append(2)
+            self.assertEqual(client.read('foo'), {'a': [1]})
+
+
+class TestAsyncClient(LiveAsyncServerTestMixin, TestClient):
+    pass
+
+
+class TestThreadPoolStorage(unittest.TestCase):
+    def test_range_batches(self):
+        storage = grandcentral.storage.MemoryStorage()
+        storage.write_many([('x', n) for n in range(7)])
+        pool = asyncstorage.ThreadPoolStorage(storage)
+        self.addCleanup(pool.close)
+        pool.RANGE_BATCH_SIZE = 3
+
+        async def _collect(key, **kwargs):
+            return [value async for (ts, value) in pool.range(key, **kwargs)]
+
+        with unittest.mock.patch.object(
+                storage, 'range', wraps=storage.range) as range_:
+            self.assertEqual(asyncio.run(_collect('x')), list(range(7)))
+            self.assertEqual(range_.call_count, 3)
+
+        timestamps = [ts for (ts, value) in storage.range('x')]
+        self.assertEqual(
+            asyncio.run(_collect('x', start=timestamps[2],
+                                 end=timestamps[6])),
+            [2, 3, 4, 5])
+
+        with self.assertRaises(KeyError):
+            asyncio.run(_collect('y'))
+
+
+class TestAsyncAPIParity(LiveAsyncServerTestMixin, unittest.TestCase):
+    # Routes served by both APIs answer the same out of the same storage
+
+    def setUp(self):
+        super().setUp()
+        self.wsgi_url = LiveServerTestMixin.start_server(self, self.storage)
+        for x in range(1, 4):
+            self.storage.write('foo', x)
+        self.storage.write('bar', {'a': [1, 2]})
+
+    def _fetch(self, url, path, body=None, headers={}):
+        req = urllib.request.Request(
+            url + path.lstrip('/'), data=body, headers=headers)
+        try:
+            with urllib.request.urlopen(req) as resp:
+                return (resp.status, resp.headers, resp.read())
+        except urllib.error.HTTPError as e:
+            with e:
+                return (e.code, e.headers, e.read())
+
+    def _both(self, path, **kwargs):
+        return [self._fetch(url, path, **kwargs)
+                for url in (self.wsgi_url, self.url)]
+
+    def _doc(self, headers, body):
+        if headers.get_content_type() == 'application/x-ndjson':
+            return [json.loads(x) for x in body.splitlines()]
+        return json.loads(body) if body else None
+
+    def test_reads(self):
+        paths = [
+            '/message/foo',
+            '/message/nope',
+            '/message?keys=foo,nope,bar',
+            '/message',
+            '/message/bar/backlog',
+            '/message/foo/backlog?limit=2',
+            '/message/nope/backlog',
+            '/message/foo/backlog?limit=0',
+            '/message/foo/range',
+            '/message/nope/range',
+            '/message/foo/series?bucket=60&agg=max',
+            '/message/foo/series?bucket=0',
+            '/message/foo/watch?timeout=0&since=0',
+            '/message/foo/watch?timeout=0',
+            '/message/foo/attachment',
+        ]
+        for path in paths:
+            with self.subTest(path=path):
+                (wsgi, aio) = self._both(path)
+                self.assertEqual(wsgi[0], aio[0])
+                if wsgi[0] < 400:
+                    self.assertEqual(self._doc(wsgi[1], wsgi[2]),
+                                     self._doc(aio[1], aio[2]))
+                    self.assertEqual(wsgi[1]['ETag'], aio[1]['ETag'])
+                    self.assertEqual('Link' in wsgi[1], 'Link' in aio[1])
+
+    def test_conditional_get(self):
+        for path in ('/message/foo', '/message/foo/backlog'):
+            etag = self._fetch(self.wsgi_url, path)[1]['ETag']
+            for (status, headers, body) in self._both(
+                    path, headers={'If-None-Match': etag}):
+                self.assertEqual(status, 304)
+
+    def test_writes(self):
+        requests = [
+            ('/message', {'key': 'a', 'value': 1}),
+            ('/message/batch', [{'key': 'b', 'value': 2}]),
+            ('/message/batch/read', {'keys': ['a', 'b', 'c']}),
+            ('/message/batch/read', {'keys': 'a'}),
+        ]
+        for (path, doc) in requests:
+            with self.subTest(path=path, doc=doc):
+                (wsgi, aio) = self._both(
+                    path, body=json.dumps(doc).encode('utf-8'),
+                    headers={'Content-Type': 'application/json'})
+                self.assertEqual(wsgi[0], aio[0])
+                if wsgi[0] == 200:
+                    self.assertEqual(json.loads(wsgi[2]), json.loads(aio[2]))
+
+    def test_unsupported_routes(self):
+        for path in ('/changes', '/export', '/attachment/' + '0' * 40,
+                     '/chunks/missing', '/metrics'):
+            with self.subTest(path=path):
+                (status, headers, body) = self._fetch(self.url, path)
+                self.assertEqual(status, 501)
+
+
+if _sqlalchemy_storage_enabled:
+    class TestAttachments(falcon.testing.TestCase):
+        def setUp(self):
+            super().setUp()
+            self.tmpdir = tempfile.TemporaryDirectory()
+            self.addCleanup(self.tmpdir.cleanup)
+            self.storage = grandcentral.sqlalchemystorage.SQLAlchemyStorage(
+                storage_path=self.tmpdir.name + '/')
+            self.app = grandcentral.API(self.storage)
+
+            self.data = bytes(range(256)) * 10
+            self.storage.write('foo', 1, self.data)
+            self.digest = hashlib.sha1(self.data).hexdigest()
+
+        def test_download(self):
+            resp = self.simulate_get('/message/foo/attachment')
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.content, self.data)
+            self.assertEqual(resp.headers['etag'], '"{}"'.format(self.digest))
+
+        def test_download_by_timestamp(self):
+            self.storage.write('foo', 2, b'newer')
+            ts = [ts for (ts, value) in self.storage.backlog('foo')][-1]
+
+            resp = self.simulate_get(
+                '/message/foo/attachment',
+                query_string='timestamp=' + repr(ts))
+            self.assertEqual(resp.content, self.data)
+
+        def test_not_modified(self):
+            resp = self.simulate_get(
+                '/message/foo/attachment',
+                headers={'If-None-Match': '"{}"'.format(self.digest)})
+            self.assertEqual(resp.status_code, 304)
+            self.assertEqual(resp.content, b'')
+
+        def test_range(self):
+            resp = self.simulate_get(
+                '/message/foo/attachment',
+                headers={'Range': 'bytes=10-19'})
+            self.assertEqual(resp.status_code, 206)
+            self.assertEqual(resp.content, self.data[10:20])
+            self.assertEqual(
+                resp.headers['content-range'],
+                'bytes 10-19/{}'.format(len(self.data)))
+
+            resp = self.simulate_get(
+                '/message/foo/attachment',
+                headers={'Range': 'bytes=-5'})
+            self.assertEqual(resp.content, self.data[-5:])
+
+        def test_range_not_satisfiable(self):
+            resp = self.simulate_get(
+                '/message/foo/attachment',
+                headers={'Range': 'bytes=100000-'})
+            self.assertEqual(resp.status_code, 416)
+
+        def test_missing(self):
+            resp = self.simulate_get('/message/bar/attachment')
+            self.assertEqual(resp.status_code, 404)
+
+        def test_compressed_passthrough(self):
+            storage = grandcentral.sqlalchemystorage.SQLAlchemyStorage(
+                storage_path=self.tmpdir.name + '/', compression='gzip')
+            self.app = grandcentral.API(storage)
+            data = b'abcd' * 10000
+            storage.write('bar', 1, data)
+
+            resp = self.simulate_get(
+                '/message/bar/attachment',
+                headers={'Accept-Encoding': 'gzip'})
+            self.assertEqual(resp.headers['content-encoding'], 'gzip')
+            self.assertLess(len(resp.content), len(data))
+            self.assertEqual(gzip.decompress(resp.content), data)
+
+            resp = self.simulate_get('/message/bar/attachment')
+            self.assertNotIn('content-encoding', resp.headers)
+            self.assertEqual(resp.content, data)
+
+            resp = self.simulate_get(
+                '/message/bar/attachment',
+                headers={'Accept-Encoding': 'gzip', 'Range': 'bytes=4-7'})
+            self.assertEqual(resp.status_code, 206)
+            self.assertEqual(resp.content, b'abcd')
+
+        def test_chunked_upload(self):
+            data = _random_bytes(16 * 1024)
+            chunks, digest = chunking.Chunker(avg_size=1024).manifest(
+                io.BytesIO(data))
+            parts = list(chunking.Chunker(avg_size=1024).split(
+                io.BytesIO(data)))
+            digests = [x for (x, size) in chunks]
+
+            resp = self.simulate_post(
+                '/chunks/missing', json={'digests': digests})
+            self.assertEqual(resp.json, {'missing': digests})
+
+            message = {'key': 'bar', 'value': 1, 'chunks': chunks}
+            resp = self.simulate_post('/message', json=message)
+            self.assertEqual(resp.status_code, 409)
+            self.assertEqual(resp.json, {'missing': digests})
+
+            resp = self.simulate_put(
+                '/chunks/' + digests[0], body=b'other',
+                headers={'Content-Type': 'application/octet-stream'})
+            self.assertEqual(resp.status_code, 400)
+
+            for (x, part) in zip(digests, parts):
+                resp = self.simulate_put(
+                    '/chunks/' + x, body=part,
+                    headers={'Content-Type': 'application/octet-stream'})
+                self.assertEqual(resp.status_code, 204)
+
+            resp = self.simulate_post(
+                '/chunks/missing', json={'digests': digests})
+            self.assertEqual(resp.json, {'missing': []})
+
+            resp = self.simulate_post('/message', json=message)
+            self.assertEqual(resp.status_code, 204)
+
+            resp = self.simulate_get('/message/bar/attachment')
+            self.assertEqual(resp.content, data)
+            self.assertEqual(resp.headers['etag'], '"{}"'.format(digest))
+
+            resp = self.simulate_get(
+                '/message/bar/attachment', headers={'Range': 'bytes=100-'})
+            self.assertEqual(resp.content, data[100:])
+
+        def test_chunked_upload_not_implemented(self):
+            self.app = grandcentral.API(grandcentral.storage.MemoryStorage())
+            resp = self.simulate_post(
+                '/chunks/missing', json={'digests': ['0' * 40]})
+            self.assertEqual(resp.status_code, 501)
+
+    class TestChunkedClient(LiveServerTestMixin, unittest.TestCase):
+        def create_storage(self):
+            self.tmpdir = tempfile.TemporaryDirectory()
+            self.addCleanup(self.tmpdir.cleanup)
+            return grandcentral.sqlalchemystorage.SQLAlchemyStorage(
+                storage_path=self.tmpdir.name + '/')
+
+        def test_write_chunked(self):
+            chunker = chunking.Chunker(avg_size=1024)
+            data = _random_bytes(64 * 1024)
+            edited = data[:30000] + b'inserted' + data[30000:]
+            src = pathlib.Path(self.tmpdir.name) / 'src'
+            src.write_bytes(edited)
+
+            with grandcentral.client.SyncClient(self.url) as client:
+                self.assertEqual(
+                    client.write_chunked('foo', 1, data, chunker=chunker),
+                    len(data))
+                # Only the chunks around the insertion are sent
+                self.assertLess(
+                    client.write_chunked('foo', 2, src, chunker=chunker),
+                    8192)
+
+                buff = io.BytesIO()
+                client.read_attachment('foo', buff)
+
+            self.assertEqual(buff.getvalue(), edited)
+            self.assertEqual(
+                self.storage.open_attachment('foo')[0],
+                hashlib.sha1(edited).hexdigest())
+
+        def test_write_chunked_collected_meanwhile(self):
+            chunker = chunking.Chunker(avg_size=1024)
+            data = _random_bytes(16 * 1024)
+            first = next(iter(chunker.split(io.BytesIO(data))))
+            missing_chunks = self.storage.missing_chunks
+            calls = []
+
+            def _missing_chunks(digests):
+                calls.append(digests)
+                if len(calls) == 2:
+                    # Collected right after its upload
+                    os.unlink(self.storage._storage_filepath_for_chunk(
+                        hashlib.sha1(first).hexdigest()))
+                return missing_chunks(digests)
+
+            with unittest.mock.patch.object(
+                    self.storage, 'missing_chunks',
+                    side_effect=_missing_chunks):
+                with grandcentral.client.SyncClient(self.url) as client:
+                    self.assertEqual(
+                        client.write_chunked('foo', 1, data, chunker=chunker),
+                        len(data) + len(first))
+
+            (d, fh, size) = self.storage.open_attachment('foo')
+            with fh:
+                self.assertEqual(fh.read(), data)
+
+    class TestClientAttachments(LiveServerTestMixin, unittest.TestCase):
+        def create_storage(self):
+            self.tmpdir = tempfile.TemporaryDirectory()
+            self.addCleanup(self.tmpdir.cleanup)
+            return grandcentral.sqlalchemystorage.SQLAlchemyStorage(
+                storage_path=self.tmpdir.name + '/')
+
+        def test_read_attachment(self):
+            data = b'0123456789' * 20000
+            src = pathlib.Path(self.tmpdir.name) / 'src'
+            dest = pathlib.Path(self.tmpdir.name) / 'dest'
+            src.write_bytes(data)
+
+            with grandcentral.client.SyncClient(self.url) as client:
+                client.write('foo', 'bar', src)
+                client.read_attachment('foo', dest)
+
+                buff = io.BytesIO()
+                client.read_attachment('foo', buff)
+
+                with self.assertRaises(KeyError):
+                    client.read_attachment('bar', buff)
+
+            self.assertEqual(dest.read_bytes(), data)
+            self.assertEqual(buff.getvalue(), data)
+
+        def test_read_attachment_range(self):
+            data = b'0123456789'
+
+            async def _test():
+                async with grandcentral.Client(self.url) as client:
+                    await client.write('foo', 'bar', data)
+                    resp = await client._request(
+                        'GET', '/message/foo/attachment',
+                        headers={'Range': 'bytes=2-4'})
+                    try:
+                        return resp.status, await resp.read()
+                    finally:
+                        resp.release()
+
+            loop = asyncio.new_event_loop()
+            self.addCleanup(loop.close)
+            self.assertEqual(
+                asyncutils.wait_for(_test(), loop=loop), (206, b'234'))
+
+    class TestAsyncClientAttachments(LiveAsyncServerTestMixin,
+                                     TestClientAttachments):
+        pass
+
+
+class TestAPIWithStorage(falcon.testing.TestCase):
+    def setUp(self):
+        super().setUp()
+        self.storage = grandcentral.storage.MemoryStorage()
+        self.app = grandcentral.API(self.storage)
+
+    def test_conditional_get(self):
+        self.storage.write('foo', 1)
+        ts = self.storage.latest_timestamp('foo')
+
+        for path in ('/message/foo', '/message/foo/backlog'):
+            resp = self.simulate_get(path)
+            etag = resp.headers['etag']
+            if path.endswith('/backlog'):
+                self.assertEqual(
+                    etag, '"{0}-{0}-1-json"'.format(repr(ts)))
+                self.assertNotIn('last-modified', resp.headers)
+            else:
+                self.assertEqual(etag, '"{}-json"'.format(repr(ts)))
+                self.assertEqual(
+                    resp.headers['last-modified'],
+                    email.utils.formatdate(int(ts), usegmt=True))
+
+            resp = self.simulate_get(path, headers={'If-None-Match': etag})
+            self.assertEqual(resp.status_code, 304)
+            self.assertEqual(resp.content, b'')
+
+            resp = self.simulate_get(path, headers={
+                'If-Modified-Since': email.utils.formatdate(
+                    int(ts), usegmt=True)})
+            self.assertEqual(
+                resp.status_code,
+                200 if path.endswith('/backlog') else 304)
+
+            # Another representation
+            if codecs.MSGPACK is not None:
+                resp = self.simulate_get(path, headers={
+                    'If-None-Match': etag,
+                    'Accept': 'application/msgpack'})
+                self.assertEqual(resp.status_code, 200)
+
+        self.storage.write('foo', 2)
+        resp = self.simulate_get(
+            '/message/foo', headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.json['value'], 2)
+
+        # Expiring older records leaves the latest one alone but still
+        # changes the backlog
+        resp = self.simulate_get('/message/foo/backlog')
+        etag = resp.headers['etag']
+        self.storage.expire('foo', keep_last=1)
+        resp = self.simulate_get(
+            '/message/foo/backlog', headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual([x['message']['value'] for x in resp.json], [2])
+
+        resp = self.simulate_get(
+            '/message/bar', headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, 404)
+
+    def test_compression(self):
+        body = gzip.compress(
+            json.dumps({'key': 'foo', 'value': 'x' * 5000}).encode('utf-8'))
+        resp = self.simulate_post(
+            '/message', body=body,
+            headers={'Content-Type': falcon.MEDIA_JSON,
+                     'Content-Encoding': 'gzip'})
+        self.assertEqual(resp.status_code, 204)
+
+        resp = self.simulate_get(
+            '/message/foo', headers={'Accept-Encoding': 'br, gzip'})
+        self.assertEqual(resp.headers['content-encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', resp.headers['vary'])
+        self.assertTrue(resp.headers['etag'].startswith('W/'))
+        self.assertEqual(
+            json.loads(gzip.decompress(resp.content).decode('utf-8')),
+            {'key': 'foo', 'value': 'x' * 5000})
+
+        # Streamed responses too
+        resp = self.simulate_get(
+            '/message/foo/range', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(resp.headers['content-encoding'], 'gzip')
+        self.assertIn(b'"foo"', gzip.decompress(resp.content))
+
+        resp = self.simulate_get('/message/foo')
+        self.assertNotIn('content-encoding', resp.headers)
+
+        resp = self.simulate_post(
+            '/message', body=b'not gzip',
+            headers={'Content-Type': falcon.MEDIA_JSON,
+                     'Content-Encoding': 'gzip'})
+        self.assertEqual(resp.status_code, 400)
+
+    def test_read_many(self):
+        self.storage.write_many([('foo', 1), ('bar', 2)])
+
+        resp = self.simulate_get('/message', query_string='keys=foo,baz,bar')
+        self.assertEqual(resp.json, {
+            'messages': [{'key': 'foo', 'value': 1},
+                         {'key': 'bar', 'value': 2}],
+            'missing': ['baz']})
+
+        resp = self.simulate_post(
+            '/message/batch/read', body=json.dumps({'keys': ['bar']}))
+        self.assertEqual(resp.json['messages'], [{'key': 'bar', 'value': 2}])
+
+        self.assertEqual(self.simulate_get('/message').status_code, 400)
+        resp = self.simulate_post(
+            '/message/batch/read', body=json.dumps({'keys': [1]}))
+        self.assertEqual(resp.status_code, 400)
+
+    def test_export_import(self):
+        self.storage.write_many([('foo', 1), ('bar', {'a': 2}), ('foo', 3)])
+
+        resp = self.simulate_get('/export', query_string='prefix=fo')
+        self.assertEqual(resp.headers['content-type'], 'application/x-ndjson')
+        lines = resp.content.splitlines()
+        self.assertEqual(
+            [json.loads(x.decode('utf-8'))['message']['value'] for x in lines],
+            [1, 3])
+
+        other = grandcentral.storage.MemoryStorage()
+        app = grandcentral.API(other)
+        resp = falcon.testing.TestClient(app).simulate_post(
+            '/import', body=self.simulate_get('/export').content)
+        self.assertEqual(resp.json, {'records': 3})
+        self.assertEqual(list(other.export()), list(self.storage.export()))
+
+        resp = falcon.testing.TestClient(app).simulate_post(
+            '/import', body=b'{"timestamp": 1}\n')
+        self.assertEqual(resp.status_code, 400)
+
+    def test_range_ndjson(self):
+        self.storage.write_many([('foo', 1), ('foo', 2)])
+        resp = self.simulate_get('/message/foo/range')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.headers['content-type'], 'application/x-ndjson')
+        self.assertEqual(
+            [json.loads(x)['message']['value']
+             for x in resp.text.splitlines()],
+            [1, 2])
+
+        resp = self.simulate_get('/message/bar/range')
+        self.assertEqual(resp.status_code, 404)
+
+    def test_series(self):
+        self.storage.write_many([('foo', 1), ('foo', 3)])
+        resp = self.simulate_get(
+            '/message/foo/series', query_string='bucket=1e12&agg=max')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(
+            [value for (ts, value) in resp.json['points']], [3])
+
+        # Open-ended windows are invalidated by new writes
+        self.storage.write('foo', 5)
+        resp = self.simulate_get(
+            '/message/foo/series', query_string='bucket=1e12&agg=max')
+        self.assertEqual(
+            [value for (ts, value) in resp.json['points']], [5])
+
+    def test_series_invalid(self):
+        self.storage.write('foo', 'bar')
+        resp = self.simulate_get('/message/foo/series')
+        self.assertEqual(resp.status_code, 400)
+
+        resp = self.simulate_get(
+            '/message/foo/series', query_string='agg=median')
+        self.assertEqual(resp.status_code, 400)
+
+        for bucket in ('0', '-1', 'nan', 'inf'):
+            resp = self.simulate_get(
+                '/message/foo/series', query_string='bucket=' + bucket)
+            self.assertEqual(resp.status_code, 400)
+
+        resp = self.simulate_get('/message/bar/series')
+        self.assertEqual(resp.status_code, 404)
+
+
+class TestWatch(falcon.testing.TestCase):
+    def setUp(self):
+        super().setUp()
+        self.storage = grandcentral.storage.MemoryStorage()
+        self.app = grandcentral.API(self.storage)
+
+    def test_long_poll_since(self):
+        self.storage.write_many([('foo', 1), ('foo', 2)])
+        resp = self.simulate_get(
+            '/message/foo/watch', query_string='since=-inf&timeout=0')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(
+            [x['message']['value'] for x in resp.json], [1, 2])
+
+        resp = self.simulate_get(
+            '/message/foo/watch',
+            query_string='since={!r}&timeout=0'.format(
+                resp.json[0]['timestamp']))
+        self.assertEqual(
+            [x['message']['value'] for x in resp.json], [2])
+
+    def test_long_poll_limit(self):
+        self.storage.write_many([('foo', x) for x in range(150)])
+        resp = self.simulate_get(
+            '/message/foo/watch', query_string='since=-inf&timeout=0')
+        self.assertEqual(
+            [x['message']['value'] for x in resp.json], list(range(100)))
+
+        link = resp.headers['link']
+        (path, query) = link[1:link.index('>')].split('?')
+        resp = self.simulate_get(path, query_string=query)
+        self.assertEqual(
+            [x['message']['value'] for x in resp.json], list(range(100, 150)))
+        self.assertNotIn('link', resp.headers)
+
+    def test_long_poll_timeout(self):
+        self.storage.write('foo', 1)
+        resp = self.simulate_get(
+            '/message/foo/watch', query_string='timeout=0')
+        self.assertEqual(resp.status_code, 204)
+
+    def test_long_poll_wakes_on_write(self):
+        threading.Timer(0.1, self.storage.write, args=('foo', 1)).start()
+        resp = self.simulate_get(
+            '/message/foo/watch', query_string='timeout=5')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.json[0]['message']['value'], 1)
+
+    def test_event_stream(self):
+        self.storage.write('foo', 1)
+        rsrc = grandcentral.api.MessageWatchResource(
+            self.storage, self.app.signaler)
+        stream = rsrc._event_stream('foo', float('-inf'))
+
+        event = next(stream).decode('utf-8')
+        ts, value = next(self.storage.backlog('foo'))
+        self.assertTrue(event.startswith('id: {!r}\n'.format(ts)))
+        self.assertEqual(
+            json.loads(event.split('data: ')[1])['message']['value'], 1)
+
+        threading.Timer(0.1, self.storage.write, args=('foo', 2)).start()
+        event = next(stream).decode('utf-8')
+        self.assertEqual(
+            json.loads(event.split('data: ')[1])['message']['value'], 2)
+
+
+class TestMetrics(falcon.testing.TestCase):
+    def setUp(self):
+        super().setUp()
+        self.storage = grandcentral.storage.MemoryStorage()
+        self.app = grandcentral.API(self.storage)
+
+    def test_histogram(self):
+        hist = metrics.Histogram([1, 10])
+        for value in (0.5, 1, 5, 50):
+            hist.observe(value)
+
+        self.assertEqual(list(hist.cumulative()),
+                         [(1, 2), (10, 3), (float('inf'), 4)])
+        self.assertEqual(hist.sum, 56.5)
+
+    def test_endpoint(self):
+        self.simulate_post(
+            '/message',
+            headers={'content-type': falcon.MEDIA_JSON},
+            body=json.dumps({'key': 'foo', 'value': 1}))
+        self.simulate_get('/message/foo')
+        self.simulate_get('/message/bar')
+        list(self.app.storage.backlog('foo'))
+
+        resp = self.simulate_get('/metrics')
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue(resp.headers['content-type'].startswith('text/plain'))
+
+        lines = resp.text.splitlines()
+        self.assertIn(
+            'grandcentral_http_requests_total'
+            '{method="GET",route="/message/{key}",status="200"} 1',
+            lines)
+        self.assertIn(
+            'grandcentral_http_requests_total'
+            '{method="GET",route="/message/{key}",status="404"} 1',
+            lines)
+        self.assertIn(
+            'grandcentral_http_request_duration_seconds_count'
+            '{method="POST",route="/message"} 1',
+            lines)
+        self.assertIn(
+            'grandcentral_storage_rows_total{op="write"} 1', lines)
+        self.assertIn(
+            'grandcentral_storage_rows_total{op="backlog"} 1', lines)
+        # Missing keys aren't errors
+        self.assertIn(
+            'grandcentral_storage_errors_total{op="latest_timestamp"} 0',
+            lines)
+
+    def test_disabled(self):
+        app = grandcentral.API(self.storage, metrics=False)
+        self.assertIs(app.storage, self.storage)
+        self.assertEqual(
+            falcon.testing.TestClient(app).simulate_get(
+                '/metrics').status_code,
+            404)
+
+
 class TestAPI(falcon.testing.TestCase):
     def setUp(self):
         super().setUp()
         self.storage = unittest.mock.create_autospec(grandcentral.BaseStorage)
+        self.storage.backlog_summary.return_value = (1.0, 3.0, 3)
         self.app = grandcentral.API(self.storage)
 
     def test_read(self):
-        self.storage.read.return_value = 'bar'
+        self.storage.read_raw.return_value = (codecs.JSON, b'"bar"')
         resp = self.simulate_get('/message/foo')
-        self.storage.read.assert_called_with('foo')
+        self.storage.read_raw.assert_called_with('foo')
         self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.json, {'key': 'foo', 'value': 'bar'})
+
+    @unittest.skipIf(codecs.MSGPACK is None, 'msgpack not installed')
+    def test_read_msgpack(self):
+        self.storage.read_raw.return_value = (
+            codecs.MSGPACK, codecs.MSGPACK.encode({'a': [1, 2]}))
+
+        resp = self.simulate_get(
+            '/message/foo',
+            headers={'Accept': 'application/msgpack, application/json;q=0.5'})
+        self.assertEqual(resp.headers['content-type'], 'application/msgpack')
+        self.assertEqual(
+            codecs.MSGPACK.decode(resp.content),
+            {'key': 'foo', 'value': {'a': [1, 2]}})
+
+        # Re-encoded when the stored codec isn't the requested one
+        resp = self.simulate_get('/message/foo')
+        self.assertEqual(resp.json, {'key': 'foo', 'value': {'a': [1, 2]}})
+
+    @unittest.skipIf(codecs.MSGPACK is None, 'msgpack not installed')
+    def test_backlog_msgpack(self):
+        self.storage.backlog_raw.return_value = iter(
+            [(2.0, codecs.JSON, b'"b"'), (1.0, codecs.MSGPACK, b'\xa1a')])
+        resp = self.simulate_get(
+            '/message/foo/backlog',
+            headers={'Accept': 'application/x-msgpack'})
+        self.assertEqual(
+            codecs.MSGPACK.decode(resp.content),
+            [{'timestamp': 2.0, 'message': {'key': 'foo', 'value': 'b'}},
+             {'timestamp': 1.0, 'message': {'key': 'foo', 'value': 'a'}}])
+
+    def test_backlog_next_link(self):
+        self.storage.backlog_raw.return_value = iter(
+            [(3.0, codecs.JSON, b'"c"'), (2.0, codecs.JSON, b'"b"')])
+        resp = self.simulate_get(
+            '/message/foo/backlog', query_string='limit=1&after=1.0')
+        self.storage.backlog_raw.assert_called_with(
+            'foo', limit=2, before=None, after=1.0)
+        self.assertEqual(
+            [x['message']['value'] for x in resp.json], ['c'])
+        self.assertIn('before=3.0', resp.headers['link'])
+        self.assertIn('rel=next', resp.headers['link'])
+
+        self.storage.backlog_raw.return_value = iter(
+            [(3.0, codecs.JSON, b'"c"')])
+        resp = self.simulate_get(
+            '/message/foo/backlog', query_string='limit=1')
+        self.assertNotIn('link', resp.headers)
+
+    def test_backlog_invalid_limit(self):
+        resp = self.simulate_get(
+            '/message/foo/backlog', query_string='limit=0')
+        self.assertEqual(resp.status_code, 400)
 
     def test_write(self):
         self.simulate_post(
@@ -164,6 +2393,53 @@ class TestAPI(falcon.testing.TestCase):
             ))
         self.storage.write.assert_called_with('foo', 'bar', None)
 
+    def test_write_batch(self):
+        resp = self.simulate_post(
+            '/message/batch',
+            headers={'content-type': falcon.MEDIA_JSON},
+            body=json.dumps([
+                {'key': 'foo', 'value': 1},
+                {'key': 'bar', 'value': 2}
+            ]))
+        self.assertEqual(resp.status_code, 204)
+        self.storage.write_many.assert_called_with([('foo', 1), ('bar', 2)])
+
+    def test_write_batch_ndjson(self):
+        resp = self.simulate_post(
+            '/message/batch',
+            headers={'content-type': 'application/x-ndjson'},
+            body='{"key": "foo", "value": 1}\n{"key": "bar", "value": 2}\n')
+        self.assertEqual(resp.status_code, 204)
+        self.storage.write_many.assert_called_with([('foo', 1), ('bar', 2)])
+
+    def test_write_with_attachment_is_streamed(self):
+        boundary = 'xxBOUNDARYxx'
+        body = (
+            '--{b}\r\n'
+            'Content-Disposition: form-data; name="message"\r\n\r\n'
+            '{{"key": "foo", "value": "bar"}}\r\n'
+            '--{b}\r\n'
+            'Content-Disposition: form-data; name="attachment"; '
+            'filename="f"\r\n'
+            'Content-Type: application/octet-stream\r\n\r\n'
+            'payload\r\n'
+            '--{b}--\r\n'
+        ).format(b=boundary)
+
+        written = []
+        self.storage.write.side_effect = \
+            lambda key, value, attachment: written.append(
+                (key, value, attachment.read()))
+
+        self.simulate_post(
+            '/message',
+            headers={
+                'content-type': 'multipart/form-data; boundary=' + boundary
+            },
+            body=body)
+
+        self.assertEqual(written, [('foo', 'bar', b'payload')])
+
     # def test_write_with_attachment(self):
     #     payload = json.dumps({
     #         'key': 'foo',